@@ -1,88 +1,410 @@
-from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal, Slot
-from PySide6.QtWidgets import QApplication, QWidget
-from radar_volume import RadarVolume
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Qt, Signal, Slot
+from PySide6.QtWidgets import QApplication
+from radar_volume import RadarVolume, add_timing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import itertools
+import multiprocessing
 import threading
+import heapq
+import time
+import os
 
 class VolumeLoaderTask(QRunnable):
     """
     QRunnable task for concurrent loading of volume data files.
     """
-    def __init__(self, filename, callback, stop_flag):
+    def __init__(self, filename, callback, stop_flag, cancel_flag=None, spill_cache=None, timings=None):
         super().__init__()
         self.filename = filename
         self.callback = callback
         self.stop_flag = stop_flag
+        # Set when this particular load is no longer needed
+        self.cancel_flag = cancel_flag if cancel_flag is not None else CancelFlag()
+        # Where volumes evicted from memory earlier can be restored from (optional)
+        self.spill_cache = spill_cache
+        # Time spent in each loading stage, see RadarVolume.build_radar_volume_from_matlab_file
+        self.timings = timings if timings is not None else {}
 
     def run(self):
         if self.stop_flag.is_set():
             # If the stop flag was set while this task was queued to run, exit immediately.
             return
-        
-        # Load the volume
-        r_volume = RadarVolume.build_radar_volume_from_matlab_file(self.filename)
+
+        r_volume = None
+        if not self.cancel_flag.is_set() and self.spill_cache is not None:
+            # A volume which was evicted from memory earlier comes back without parsing the .mat file
+            start = time.perf_counter()
+            r_volume = self.spill_cache.restore(self.filename)
+            if r_volume is not None:
+                add_timing(self.timings, 'read_s', start)
+                self.timings['source'] = 'spill'
+        if r_volume is None and not self.cancel_flag.is_set():
+            # Load the volume
+            r_volume = RadarVolume.build_radar_volume_from_matlab_file(self.filename, cancel_flag=self.cancel_flag, timings=self.timings)
         
         if self.stop_flag.is_set():
             # Exit early if the application is closing. 
             # A more advance approach would break the file loading up into sections and test this flag repeatedly to exit sooner.
             return
         
-        # Invoke the callback
-        self.callback(r_volume)
+        # Invoke the callback, also when the load was cancelled so the loader can free up the slot.
+        self.callback(self.filename, r_volume)
+
+def convert_volume_in_worker(filename):
+    """
+    Worker process entry point of the 'process' backend. Returns (converted, timings), the
+    timings can't be shared with the worker so they travel back with the result.
+    """
+    timings = {}
+    converted = RadarVolume.convert_matlab_file_to_cache(filename, timings=timings)
+    return (converted, timings)
+
+class VolumeSpillTask(QRunnable):
+    """
+    QRunnable task which writes a volume evicted from memory to the spill cache.
+    `callback()` is invoked once the task is done with the volume.
+    """
+    def __init__(self, r_volume: RadarVolume, spill_cache, stop_flag, callback):
+        super().__init__()
+        self.r_volume = r_volume
+        self.spill_cache = spill_cache
+        self.stop_flag = stop_flag
+        self.callback = callback
+
+    def run(self):
+        try:
+            if not self.stop_flag.is_set() and self.spill_cache.put(self.r_volume):
+                print(f'Background Loader: spilled "{self.r_volume.filename}"')
+        finally:
+            self.r_volume = None
+            self.callback()
+
+class CancelFlag(object):
+    """
+    Cancellation flag of a single load, polled by the load with is_set() like a threading.Event.
+    Unlike an Event, a cancellation can be withdrawn with revive() until the load acts on it:
+    once is_set() returned True the load is giving up, and the flag stays set.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cancelled = False
+        # Whether the load has seen the cancellation
+        self.observed = False
+
+    def set(self):
+        with self.lock:
+            self.cancelled = True
+
+    def is_set(self) -> bool:
+        with self.lock:
+            self.observed |= self.cancelled
+            return self.cancelled
+
+    def revive(self) -> bool:
+        """Withdraw the cancellation, returns False if the load already gave up."""
+        with self.lock:
+            if self.observed:
+                return False
+            self.cancelled = False
+            return True
+
+class LoadRequest(object):
+    """
+    Bookkeeping for a single file requested from the background loader.
+    """
+    def __init__(self, filename, priority):
+        self.filename = filename
+        self.priority = priority
+        self.cancel_flag = CancelFlag()
+        # perf_counter() when the file was requested, and when the request was handed to the pool
+        self.created = time.perf_counter()
+        self.started = None
+        # Time spent in each loading stage, filled in by the loader task (and worker process)
+        self.timings = {}
+        # Set when the file is requested again after its cancelled load gave up, but before it completed
+        self.requeue_priority = None
 
 class BackgroundLoader(QObject):
     """
     Background loader class. Can be used to submit volume file loading tasks to
     a thread pool. The thread pool saves on the cost of starting and stopping
     QThreads all the time.
+
+    Requests are queued by priority (lower values load first) and only handed to
+    the pool when a worker is free, so a high priority request never waits behind
+    a backlog of less important ones. Queued requests can be cancelled outright,
+    in-progress loads are cancelled cooperatively. A cancelled load which finished
+    anyway still emits volume_loaded, the work is done and the volume may be useful.
+    Requests are keyed by file path, so a file is never loaded twice at the same
+    time: requesting a file which is already queued or loading just updates its
+    priority (or revives a cancelled load).
+
+    Two backends are available:
+
+    'thread'  - volumes are decoded on the thread pool. Most of loadmat's struct
+                parsing holds the GIL, so extra threads hardly help.
+    'process' - volumes are decoded by a pool of worker processes (one per core),
+                which write the product cubes to the volume file cache. The thread
+                pool then only has to memory-map the cached arrays back in, so no
+                product data is ever pickled between processes. Workers are spawned
+                rather than forked, the GUI process is full of threads.
+
+    With a spill cache, volumes which were spilled to disk are restored from there
+    (on the thread pool) before falling back to either backend.
     """
-    # Signal emitted when a volume is loaded
+    # Signal emitted when a volume is loaded, with None if it failed to load
     volume_loaded = Signal(RadarVolume)
+    # Emitted with the filename after volume_loaded(None), when a load failed rather than being cancelled
+    volume_failed = Signal(object)
+    # Number of spills which may wait for the pool at once. Every waiting spill holds on to an
+    # evicted volume, beyond this evicted volumes are dropped instead of spilled.
+    MAX_PENDING_SPILLS = 2
 
-    def __init__(self):
+    BACKENDS = ('thread', 'process')
+
+    def __init__(self, backend='thread', max_workers=None, spill_cache=None, telemetry=None):
         super().__init__()
+        if backend not in BackgroundLoader.BACKENDS:
+            raise ValueError(f'Unknown background loader backend "{backend}", expected one of {BackgroundLoader.BACKENDS}')
+        self.backend = backend
+        self.spill_cache = spill_cache
+        # Optional LoadTelemetry which receives the queue wait and stage timings of every load
+        self.telemetry = telemetry
         self.thread_pool = QThreadPool.globalInstance()
         self.thread_pool.setMaxThreadCount(5)
         self.stop_flag = threading.Event()
+        if backend == 'process':
+            max_workers = max_workers or os.cpu_count()
+            # Forking a process which runs Qt (and loader) threads can leave the child with locks held by
+            # threads which don't exist there, workers are started from a fresh interpreter instead.
+            self.process_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            max_workers = self.thread_pool.maxThreadCount()
+            self.process_pool = None
+        # Number of requests handed to the pool at once, the rest wait in the priority queue
+        self.max_in_flight = max_workers
+
+        # Scheduler state, shared with the worker threads.
+        self.lock = threading.Lock()
+        # Heap of (priority, sequence, filename). Entries whose request was cancelled or
+        # re-prioritized are left in the heap and skipped when popped.
+        self.queue = []
+        self.sequence = itertools.count()
+        self.queued = {}
+        self.in_flight = {}
+        # Spill tasks started but not done yet
+        self.pending_spills = 0
+
+    def load_volume(self, filename, priority=0):
+        """Request a volume. Lower priorities load first."""
+        with self.lock:
+            request = self.in_flight.get(filename)
+            if request is not None:
+                request.priority = priority
+                if request.cancel_flag.cancelled and not request.cancel_flag.revive():
+                    # Wanted again after all, but the load already gave up. It is queued again when it completes.
+                    request.requeue_priority = priority
+                return
+            previous = self.queued.get(filename)
+            if previous is not None and previous.priority == priority:
+                return
+            request = LoadRequest(filename, priority)
+            if previous is not None:
+                # Re-prioritized, it has been waiting since the original request
+                request.created = previous.created
+            self.queued[filename] = request
+            heapq.heappush(self.queue, (priority, next(self.sequence), filename))
+        self._dispatch()
+
+    def spill_volume(self, r_volume: RadarVolume):
+        """
+        Write a volume to the spill cache in the background. Spills run after any pending loads,
+        and are skipped while MAX_PENDING_SPILLS are still waiting, so evictions free memory.
+        """
+        if self.spill_cache is None or self.stop_flag.is_set():
+            return
+        with self.lock:
+            if self.pending_spills >= BackgroundLoader.MAX_PENDING_SPILLS:
+                print(f'Background Loader: spill queue is full, dropping "{r_volume.filename}"')
+                return
+            self.pending_spills += 1
+        self.thread_pool.start(VolumeSpillTask(r_volume, self.spill_cache, self.stop_flag, self._on_volume_spilled), -1)
+
+    def _on_volume_spilled(self):
+        with self.lock:
+            self.pending_spills -= 1
+
+    def cancel(self, filename):
+        """Drop a queued request, or ask an in-progress load to abort."""
+        with self.lock:
+            self._cancel_locked(filename)
+
+    def retain(self, filenames):
+        """Cancel every queued or in-progress request which is not for one of `filenames`."""
+        filenames = set(filenames)
+        with self.lock:
+            for filename in [f for f in list(self.queued) + list(self.in_flight) if f not in filenames]:
+                self._cancel_locked(filename)
 
-    def load_volume(self, filename):
+    def is_loading(self, filename) -> bool:
+        """True if the file is queued or being loaded."""
+        with self.lock:
+            return filename in self.queued or filename in self.in_flight
+
+    def shutdown(self):
+        """Stop loading. Queued tasks exit immediately, worker processes are shut down."""
+        self.stop_flag.set()
+        with self.lock:
+            self.queue.clear()
+            self.queued.clear()
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _cancel_locked(self, filename):
+        if self.queued.pop(filename, None) is not None:
+            print(f'Background Loader: dropped queued load of "{filename}"')
+        request = self.in_flight.get(filename)
+        if request is not None:
+            request.requeue_priority = None
+        if request is not None and not request.cancel_flag.cancelled:
+            print(f'Background Loader: cancelling load of "{filename}"')
+            request.cancel_flag.set()
+
+    def _dispatch(self):
+        """Hand the most important queued requests to the pool while there are free workers."""
+        to_start = []
+        with self.lock:
+            while self.queue and len(self.in_flight) + len(to_start) < self.max_in_flight and not self.stop_flag.is_set():
+                (priority, _, filename) = heapq.heappop(self.queue)
+                request = self.queued.get(filename)
+                if request is None or request.priority != priority:
+                    # Cancelled, or superseded by a request with another priority
+                    continue
+                del self.queued[filename]
+                self.in_flight[filename] = request
+                to_start.append(request)
+
+        for request in to_start:
+            request.started = time.perf_counter()
+            if self.process_pool is not None and not (self.spill_cache is not None and self.spill_cache.contains(request.filename)):
+                # Decode the volume into the cache in a worker process, then map it in on the thread pool
+                future = self.process_pool.submit(convert_volume_in_worker, request.filename)
+                future.add_done_callback(partial(self._on_volume_converted, request))
+            else:
+                self._start_loader_task(request)
+
+    def _start_loader_task(self, request: LoadRequest):
         # Create a new VolumeLoaderTask for the file
-        task = VolumeLoaderTask(filename, self._on_volume_loaded, self.stop_flag)
+        task = VolumeLoaderTask(request.filename, self._on_volume_loaded, self.stop_flag, request.cancel_flag, self.spill_cache, request.timings)
         self.thread_pool.start(task)
+
+    def _on_volume_converted(self, request: LoadRequest, future):
+        # Invoked on an executor thread once a worker process has finished with the file.
+        if self.stop_flag.is_set() or future.cancelled():
+            return
+        try:
+            (converted, timings) = future.result()
+            request.timings.update(timings)
+        except Exception as e:
+            print(f'Background Loader: worker process failed on "{request.filename}": {e}')
+            converted = False
+
+        if not converted:
+            # E.g. the cache directory isn't writable. The loader task decodes the file in-process instead.
+            print(f'Background Loader: falling back to in-process loading for "{request.filename}"')
+
+        # With an up-to-date cache entry this is just a memory-map of the product arrays.
+        self._start_loader_task(request)
         
-    @Slot(RadarVolume)
-    def _on_volume_loaded(self, r_volume: RadarVolume):
+    def _on_volume_loaded(self, filename, r_volume: RadarVolume):
+        # Invoked on a worker thread when a load task has finished (or given up).
+        with self.lock:
+            request = self.in_flight.pop(filename, None)
+            aborted = request is None or (r_volume is None and request.cancel_flag.cancelled)
+            if aborted and request is not None and request.requeue_priority is not None:
+                requeued = LoadRequest(filename, request.requeue_priority)
+                self.queued[filename] = requeued
+                heapq.heappush(self.queue, (requeued.priority, next(self.sequence), filename))
+        self._dispatch()
+
+        if aborted:
+            # The load was cancelled before it produced a volume
+            return
+        if r_volume is not None:
+            r_volume.load_time_s = time.perf_counter() - request.started
+            if self.telemetry is not None:
+                self.telemetry.record_load(request.started - request.created, r_volume.load_time_s, request.timings)
         self.volume_loaded.emit(r_volume)
+        if r_volume is None:
+            self.volume_failed.emit(filename)
 
 
-# Test code:
-if __name__ == "__main__":
-    import sys
+def benchmark_backends(app, files, backends=BackgroundLoader.BACKENDS):
+    """
+    Load `files` from their .mat files with each backend. Returns backend -> (seconds until every
+    volume was loaded, worst and 95th percentile delay of a 10 ms GUI timer while loading, in ms).
+    """
+    import shutil
+    import numpy as np
+    from PySide6.QtCore import QEventLoop, QTimer
+    from volume_file_cache import VolumeFileCache
+    results = {}
+    for backend in backends:
+        for filename in files:
+            # Every backend starts from the .mat files
+            shutil.rmtree(VolumeFileCache.cache_dir_for(filename), ignore_errors=True)
+        loader = BackgroundLoader(backend=backend)
+        loop = QEventLoop()
+        loaded = []
+        def on_volume_loaded(r_volume):
+            loaded.append(r_volume)
+            if len(loaded) == len(files):
+                loop.quit()
+        loader.volume_loaded.connect(on_volume_loaded)
+
+        # How late the GUI thread gets around to a timer which should fire every 10 ms
+        delays_ms = []
+        last_tick = [time.perf_counter()]
+        def on_tick():
+            now = time.perf_counter()
+            delays_ms.append((now - last_tick[0]) * 1000 - 10)
+            last_tick[0] = now
+        ticker = QTimer()
+        ticker.setTimerType(Qt.TimerType.PreciseTimer)
+        ticker.timeout.connect(on_tick)
 
+        start = time.perf_counter()
+        ticker.start(10)
+        for (i, filename) in enumerate(files):
+            loader.load_volume(filename, priority=i)
+        loop.exec()
+        elapsed = time.perf_counter() - start
+        ticker.stop()
+        if loader.process_pool is not None:
+            # Let the workers exit before the next backend is measured
+            loader.process_pool.shutdown(wait=True)
+        loader.shutdown()
+        results[backend] = (elapsed, max(delays_ms), float(np.percentile(delays_ms, 95)))
+        loaded.clear()
+    return results
+
+def main():
+    """Compare the loader backends on a set of volume files."""
+    import sys
+    from pathlib import Path
     app = QApplication(sys.argv)
-    window = QWidget()
-    window.setWindowTitle("Test Background Loader")
 
-    def on_volume_loaded(volume):
-        if volume is not None:
-            print(f"Volume loaded: {volume.filename} {volume.products['Z'].shape}")
-        else:
-            print("Failed to load volume.")
-
-    # Create the background loader
-    loader = BackgroundLoader()
-    loader.volume_loaded.connect(on_volume_loaded)
-
-    file_name = 'D:/cs5093/20240428/Scan 12/MATLAB/HRUS_240428_020051000_100.mat'
-    # Queue up some loading tasks
-    loader.load_volume(file_name)
-    loader.load_volume(file_name)
-    loader.load_volume(file_name)
-    loader.load_volume(file_name)
-    loader.load_volume("file5.dat")
-
-    # Start the application event loop
-    window.show()
-    try:
-        sys.exit(app.exec())
-    except KeyboardInterrupt:
-        pass
+    # Time to load a set of files, and how responsive the GUI thread stays meanwhile:
+    #   python ./background_loader.py --benchmark path/to/*.mat
+    files = [Path(arg) for arg in sys.argv[1:] if arg != '--benchmark']
+    if '--benchmark' not in sys.argv or not files:
+        print('Usage: python ./background_loader.py --benchmark FILE.mat [FILE.mat ...]')
+        sys.exit(1)
+    print(f'{len(files)} files, {os.cpu_count()} cores')
+    for (backend, (seconds, worst_ms, p95_ms)) in benchmark_backends(app, files).items():
+        print(f'{backend:>8}: {seconds:.2f} s, GUI timer late by up to {worst_ms:.0f} ms (95%: {p95_ms:.0f} ms)')
+    sys.exit(0)
+
+if __name__ == "__main__":
+    main()
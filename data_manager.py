@@ -1,10 +1,21 @@
 from PySide6.QtCore import QObject, Signal, Slot
+import os
 from scan_set import ScanSet
 from scan import Scan
 from pathlib import Path
 from radar_volume import RadarVolume
 from background_loader import BackgroundLoader
+from resident_volume_cache import ResidentVolumeCache
+from spill_cache import SpillCache
+from volume_file_cache import VolumeFileCache
+from prefetch_policy import PrefetchPolicy
+from memory_governor import MemoryGovernor
+from load_telemetry import LoadTelemetry
+from volume_metadata import ScanIndex, VolumeMetadata
 import numpy as np
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 class Data_Manager(QObject):
     """
@@ -14,82 +25,297 @@ class Data_Manager(QObject):
     num_volumes_changed = Signal(int)
     # volume_loaded = Signal(str, object)
     render_volume = Signal(RadarVolume)
+    # Emitted with the volume after the current one (in the direction of travel) once both are resident,
+    # so the views can get it ready before it is rendered
+    next_volume_ready = Signal(RadarVolume)
+    # Emitted with the index of a volume of the selected scan which failed to load
+    volume_failed = Signal(int)
+    # Emitted with the ScanIndex of the selected scan when it is built, and whenever entries are filled in
+    scan_index_changed = Signal(object)
+    # Metadata read on the indexing thread: (scan index, [VolumeMetadata])
+    _indexed = Signal(object, object)
 
-    def __init__(self, num_files_to_load=2):
+    # Fraction of the prefetch window and cache budget kept at each memory pressure level
+    MEMORY_PRESSURE_SCALE = {MemoryGovernor.NORMAL: 1.0, MemoryGovernor.ELEVATED: 0.5, MemoryGovernor.CRITICAL: 0.0}
+    # Seconds of indexing the scan index entries are collected over before they are handed to the GUI thread
+    INDEX_BATCH_S = 0.1
+
+    def __init__(self, num_files_to_load=2, loader_backend='thread', cache_budget_bytes=2 * 1024**3,
+                 spill_dir=None, spill_budget_bytes=8 * 1024**3, memory_limit_bytes=None):
         super().__init__()
         self.selected_scan = None
+        # Absolute paths of the files in the selected scan. Volumes are cached and requested by absolute
+        # path, so they are shared between scans of the scanset which reference the same file.
         self.mat_files = []
+        # filename -> index in mat_files
+        self.file_positions = {}
+        self.scan_index = ScanIndex([], [])
         self.current_index = 0
-        # Number of files "around" the current file to load, i.e. the total number of mat files loaded at a given time will be (2 * num_files_to_load + 1).
-        # E.g. num_files_to_load = 2 -> matfiles loaded = (2 * 2 + 1) = 5
+        # Direction the user last moved through the scan (1 forward, -1 backward). Files ahead of the cursor load first.
+        self.direction = 1
+        # Number of files "around" the current file to prefetch, i.e. at most (2 * num_files_to_load + 1) files are requested at a time.
+        # E.g. num_files_to_load = 2 -> matfiles requested = (2 * 2 + 1) = 5
+        # Fewer files are prefetched if they wouldn't fit into the cache budget.
         self.num_files_to_load = num_files_to_load
-        self.loaded_volumes = {}
-        self.loader = BackgroundLoader()
+        # The configured window and budget, num_files_to_load and the cache budget shrink below these under memory pressure.
+        self.base_num_files_to_load = num_files_to_load
+        self.base_cache_budget_bytes = cache_budget_bytes
+        # Loaded volumes are kept until the cache runs over its byte budget, not just while they are near the cursor.
+        self.volume_cache = ResidentVolumeCache(cache_budget_bytes)
+        # Files the data manager currently wants loaded
+        self.prefetch_window = set()
+        # Files whose last load failed. They are only requested again when they are the current index.
+        self.failed_files = set()
+        # Products shown by at least one view. Products are decoded lazily, and built products
+        # outside of this set are released from the loaded volumes.
+        self.visible_products = {'Z'}
+        # Second tier: volumes evicted from memory are compressed to a local spill directory
+        # (unless they can be mapped back in from the volume file cache anyway).
+        self.spill_cache = SpillCache(spill_dir, spill_budget_bytes)
+        # Load stage timings, queue waits, index -> render latency and resident bytes
+        self.telemetry = LoadTelemetry()
+        # perf_counter() when the current index was requested, until its volume is rendered
+        self.index_requested_at = None
+        self.loader = BackgroundLoader(backend=loader_backend, spill_cache=self.spill_cache, telemetry=self.telemetry)
         self.loader.volume_loaded.connect(self.on_volume_loaded)
+        self.loader.volume_failed.connect(self.on_volume_failed)
+        # Decides how far ahead/behind to prefetch based on the playback state and measured load times
+        self.prefetch_policy = PrefetchPolicy(num_workers=self.loader.max_in_flight)
+        # Shrinks the prefetch window and the cache when the process or the machine runs low on memory
+        self.memory_governor = MemoryGovernor(rss_limit_bytes=memory_limit_bytes)
+        self.memory_governor.pressure_changed.connect(self.on_memory_pressure_changed)
+        self.memory_governor.start()
+        # Reads the metadata of a newly selected scan off the GUI thread, see _index_scan
+        self.index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='scan_index')
+        self.index_stop_flag = threading.Event()
+        self._indexed.connect(self._on_indexed)
+
+    def shutdown(self):
+        """Stop the background loading and indexing, e.g. when the application closes."""
+        self.index_stop_flag.set()
+        self.index_executor.shutdown(wait=False, cancel_futures=True)
+        self.loader.shutdown()
+        self.memory_governor.stop()
 
     def get_current_index(self):
         return self.current_index
 
     def set_current_index(self, index):
         print(f"Data Manger: Index {index} requested")
-        if 0 <= index <= len(self.mat_files):
+        if 0 <= index < len(self.mat_files):
+            if self.prefetch_policy.playing:
+                # Playback wraps around at the end of the scan, the direction comes from the timeline.
+                self.direction = self.prefetch_policy.direction
+            elif index != self.current_index:
+                self.direction = 1 if index > self.current_index else -1
             self.current_index = index
-            # Remove files outside the range
-            self._cleanup_distant_files()
+            self.index_requested_at = time.perf_counter()
             self._load_surrounding_files()
 
-            if self.mat_files[index] in self.loaded_volumes:
-                self.render_volume.emit(self.loaded_volumes[self.mat_files[index]])
+            r_volume = self.volume_cache.get(self.mat_files[index])
+            if r_volume is not None:
+                self._render(r_volume)
+
+            # Make room, volumes far away from the new index go first
+            self._enforce_cache_budget()
+
+    def is_volume_ready(self, index) -> bool:
+        """Whether the volume at `index` is resident, i.e. set_current_index(index) renders it right away."""
+        return 0 <= index < len(self.mat_files) and self.volume_cache.peek(self.mat_files[index]) is not None
+
+    def is_volume_failed(self, index) -> bool:
+        """Whether the last load of the volume at `index` failed, i.e. it won't become ready by waiting."""
+        return 0 <= index < len(self.mat_files) and self.mat_files[index] in self.failed_files
+
+    def _render(self, r_volume: RadarVolume):
+        self.render_volume.emit(r_volume)
+        if self.index_requested_at is not None:
+            # Includes the time the views took to draw the volume
+            self.telemetry.record('index_to_render_s', time.perf_counter() - self.index_requested_at)
+            self.index_requested_at = None
+
+        next_index = self._next_index()
+        next_volume = self.volume_cache.peek(self.mat_files[next_index]) if next_index is not None else None
+        if next_volume is not None:
+            self.next_volume_ready.emit(next_volume)
+
+    def _next_index(self):
+        """The index after the current one in the direction of travel (wrapping around while playing), None at the end of the scan."""
+        index = self.current_index + self.direction
+        if self.prefetch_policy.playing:
+            index %= len(self.mat_files)
+        return index if 0 <= index < len(self.mat_files) and index != self.current_index else None
+
+    def _prefetch_order(self):
+        """
+        Indices to keep loaded, most important first: the current index, then by distance from
+        it, alternating between ahead and behind in the direction of travel (ahead first).
+        How far to go either way is up to the prefetch policy. While playing, the files ahead
+        wrap around to the start of the scan like the playback does.
+        """
+        num_files = len(self.mat_files)
+        (behind, ahead) = self.prefetch_policy.window(self._files_per_side())
+        ahead = min(ahead, num_files - 1)
+
+        order = [self.current_index]
+        for distance in range(1, max(behind, ahead) + 1):
+            if distance <= ahead:
+                index = self.current_index + distance * self.direction
+                if self.prefetch_policy.playing:
+                    index %= num_files
+                if 0 <= index < num_files:
+                    order.append(index)
+            if distance <= behind:
+                index = self.current_index - distance * self.direction
+                if 0 <= index < num_files:
+                    order.append(index)
+        # Wrapped indices may meet the ones behind the cursor on short scans
+        return list(dict.fromkeys(order))
+
+    def _estimated_volume_bytes(self):
+        """
+        Expected resident size of a volume: the average of the loaded volumes, or the size of the
+        visible products according to the scan index if nothing has been built yet. 0 if unknown.
+        """
+        sizes = [r_volume.nbytes for r_volume in self.volume_cache.values() if r_volume.nbytes > 0]
+        if sizes:
+            return int(np.mean(sizes))
+
+        metadata = self.scan_index.get(self.current_index) or self.scan_index.first_known()
+        if metadata is None:
+            return 0
+        return metadata.num_elevations * metadata.num_azimuths * metadata.num_ranges * np.dtype(np.float32).itemsize * len(self.visible_products)
+
+    def _files_per_side(self):
+        """Number of files to prefetch on either side of the current index, limited by the cache budget."""
+        volume_bytes = self._estimated_volume_bytes()
+        if volume_bytes <= 0:
+            return self.num_files_to_load
+        max_files = self.volume_cache.budget_bytes // volume_bytes
+        return int(max(0, min(self.num_files_to_load, (max_files - 1) // 2)))
 
     def _load_surrounding_files(self):
         """
-        Load files within the range of `num_files_to_load` around the current index.
+        Load the files around the current index, as decided by the prefetch policy.
         """
-        start_index = max(0, self.current_index - self.num_files_to_load)
-        end_index = min(len(self.mat_files), self.current_index + self.num_files_to_load + 1)
+        order = self._prefetch_order()
+        self.prefetch_window = {self.mat_files[i] for i in order}
 
-        for i in range(start_index, end_index):
+        # Drop queued loads which fell out of the window and abort the ones in progress
+        self.loader.retain(self.prefetch_window)
+
+        # Queue up the rest, the loader re-prioritizes files which are already queued
+        for (priority, i) in enumerate(order):
             filename = self.mat_files[i]
-            # Avoid reloading already loaded files
-            if filename not in self.loaded_volumes and self.files_state[i] == 0:
-                # Set the state tracker to loading
-                self.files_state[i] = 1 
-                self.loader.load_volume(filename)
+            # Avoid reloading already loaded files, and files which just failed to load unless they are on screen
+            if filename not in self.volume_cache and (filename not in self.failed_files or i == self.current_index):
+                self.loader.load_volume(filename, priority)
+
+    def _distance_from_cursor(self, filename):
+        """Distance (in files) of a volume from the current index. Volumes of other scans are farthest away."""
+        index = self.file_positions.get(filename)
+        return abs(index - self.current_index) if index is not None else len(self.mat_files)
 
-    def _cleanup_distant_files(self):
+    def _enforce_cache_budget(self):
         """
-        Remove files from the loaded volumes that are not within the range of the current index.
+        Evict volumes until the cache fits its byte budget. Volumes in the prefetch window (including
+        the current one) are never evicted, otherwise they would just be requested again.
+        Evicted volumes which can't be mapped back in from the volume file cache are spilled, unless
+        the loader is still busy spilling earlier ones.
         """
-        start_index = max(0, self.current_index - self.num_files_to_load)
-        end_index = min(len(self.mat_files), self.current_index + self.num_files_to_load + 1)
-        nearby_files = set(self.mat_files[start_index:end_index])
-
-        # Identify and remove files that are not "nearby"
-        files_to_remove = [filename for filename in self.loaded_volumes if filename not in nearby_files]
-        for filename in files_to_remove:
-            index = self.mat_files.index(filename)
-            print(f'Data Manager: Unloaded index {self.mat_files.index(filename)} {filename}')
-            self.files_state[index] = 0
-            del self.loaded_volumes[filename]
+        pinned = self.prefetch_window
+        for (filename, r_volume) in self.volume_cache.evict(self._distance_from_cursor, pinned):
+            print(f'Data Manager: Unloaded index {self.file_positions.get(filename)} {filename}')
+            if not VolumeFileCache.is_valid(filename):
+                self.loader.spill_volume(r_volume)
+        self.telemetry.record('resident_bytes', self.volume_cache.total_bytes())
+
+    def get_cache_stats(self) -> dict:
+        """Hit/miss/eviction counters and the resident size of the volume cache, and the spill tier's counters."""
+        stats = self.volume_cache.stats()
+        stats['spill'] = self.spill_cache.stats()
+        return stats
 
     @Slot(RadarVolume)
     def on_volume_loaded(self, r_volume: RadarVolume):
         """
         Slot to handle when a volume is loaded.
         """
-        index = self.mat_files.index(r_volume.filename)
-        self.loaded_volumes[r_volume.filename] = r_volume
-        print(f"Data Manager: Loaded index {index} {r_volume.filename} {r_volume.products['Z'].shape}")
+        if r_volume is None:
+            # The loader already reported the failure
+            return
+
+        # Volumes requested for a scan which is no longer selected still go into the cache, they are
+        # reused if that scan is selected again (or evicted first if the cache runs out of room).
+        index = self.file_positions.get(r_volume.filename)
+        self.failed_files.discard(r_volume.filename)
+        self.volume_cache.put(r_volume.filename, r_volume)
+        if r_volume.load_time_s is not None:
+            self.prefetch_policy.record_load_time(r_volume.load_time_s)
+        if index is None:
+            print(f"Data Manager: Loaded {r_volume.filename} {r_volume.shape} (not in the selected scan)")
+        else:
+            print(f"Data Manager: Loaded index {index} {r_volume.filename} {r_volume.shape}")
         # self.volume_loaded.emit(filename, r_volume)
-        
-        # Set the state tracker to loaded
-        self.files_state[index] = 2
+
+        # Fill in the scan index if the metadata of this volume wasn't known up front
+        if index is not None and self.scan_index.get(index) is None and self.scan_index.set(VolumeMetadata.from_radar_volume(r_volume)):
+            self.scan_index_changed.emit(self.scan_index)
 
         # This covers the case when a scan is first selected. The first volume will be loaded asynchronously but everyone will need to be notified when it is loaded.
-        if self.mat_files[self.current_index] == r_volume.filename:
+        if index == self.current_index:
             print(f"Just loaded volume for current index, requesting rendering! {r_volume.filename}")
-            self.render_volume.emit(r_volume)
+            self._render(r_volume)
+        elif index is not None and index == self._next_index() and self.volume_cache.peek(self.mat_files[self.current_index]) is not None:
+            self.next_volume_ready.emit(r_volume)
+
+        self._enforce_cache_budget()
+
 
+    @Slot(object)
+    def on_volume_failed(self, filename):
+        """Slot to handle when a volume failed to load, so playback can skip it instead of waiting for it."""
+        self.failed_files.add(filename)
+        index = self.file_positions.get(filename)
+        if index is not None:
+            self.volume_failed.emit(index)
+
+    @Slot(bool, int, int)
+    def on_playback_state_changed(self, playing: bool, direction: int, interval_ms: int):
+        """Slot to adapt the prefetching to playback starting, stopping or changing speed."""
+        self.prefetch_policy.set_playback(playing, direction, interval_ms)
+        if playing:
+            self.direction = self.prefetch_policy.direction
+        if self.current_index < len(self.mat_files):
+            self._load_surrounding_files()
+
+    @Slot(int)
+    def on_memory_pressure_changed(self, level: int):
+        """
+        Slot to degrade gracefully under memory pressure instead of swapping: the prefetch window
+        and the cache budget shrink (down to just the volume on screen), products which aren't on
+        screen are released (or downcast to float16 if they can't be) and volumes are evicted. Both
+        grow back when the pressure clears.
+        """
+        scale = Data_Manager.MEMORY_PRESSURE_SCALE[level]
+        self.num_files_to_load = int(self.base_num_files_to_load * scale)
+        self.volume_cache.budget_bytes = int(self.base_cache_budget_bytes * scale)
+        print(f'Data Manager: memory pressure {MemoryGovernor.LEVEL_NAMES[level]}, prefetching {self.num_files_to_load} files per side'
+              f' with a {self.volume_cache.budget_bytes / 1024**2:.0f} MB cache budget')
+
+        if level > MemoryGovernor.NORMAL:
+            for r_volume in self.volume_cache.values():
+                r_volume.downcast_products(self.visible_products)
+        if self.current_index < len(self.mat_files):
+            # Cancels the loads which fell out of the smaller window, or requests the files of the larger one
+            self._load_surrounding_files()
+        self._enforce_cache_budget()
+
+    @Slot(list)
+    def on_visible_products_changed(self, products: list):
+        self.visible_products = set(products)
+        for r_volume in self.volume_cache.values():
+            r_volume.drop_products(self.visible_products)
 
     @Slot(ScanSet)
     def on_scanset_load(self, scanset: ScanSet):
@@ -118,24 +344,64 @@ class Data_Manager(QObject):
 
                 # if timestamp is not None:
 
-                mat_file = base_dir / Path(filename)
+                mat_file = Path(os.path.abspath(base_dir / Path(filename)))
 
                 # self.scan_times.append((timestamp, mat_file))
                 self.mat_files.append(mat_file)
-            
-            # This 1-D numpy array tracks the current state of each file:
-            #
-            # 0 - unloaded
-            # 1 - loading
-            # 2 - loaded
-            #
-            # The data manager will use this array to avoid requesting to load the same file multiple times.
-            self.files_state = np.zeros(len(self.mat_files))
+
+            self.file_positions = {mat_file: i for (i, mat_file) in enumerate(self.mat_files)}
+            resident = sum(1 for mat_file in self.mat_files if mat_file in self.volume_cache)
+            print(f'Data Manager: {resident}/{len(self.mat_files)} volumes of "{self.selected_scan.get_name()}" already resident.')
+
+            # Index the time and geometry of the cached volumes in the background, so the timeline, slice
+            # selector and plots can be laid out as entries come in, before any volume has been loaded.
+            self.scan_index = ScanIndex(self.mat_files, [None] * len(self.mat_files))
+            self.scan_index_changed.emit(self.scan_index)
+            self.index_executor.submit(self._index_scan, self.scan_index)
             
             self.set_current_index(0)
             self.num_volumes_changed.emit(len(self.mat_files))
 
 
+    def _index_scan(self, scan_index: ScanIndex):
+        # Runs on the indexing thread, reading only the cache headers (small JSON files). Volumes without a
+        # cache entry stay unknown until they are loaded: parsing their .mat files up front would decode every
+        # product just for a few scalars. Meanwhile the timeline places them by their filename times and the
+        # grid and plots use the geometry of the first volume which is known.
+        (batch, found) = ([], 0)
+        batch_start = time.perf_counter()
+        for (index, filename) in enumerate(scan_index.files):
+            if self.index_stop_flag.is_set() or scan_index is not self.scan_index:
+                # Shutting down, or another scan was selected
+                return
+            if scan_index.get(index) is not None:
+                continue
+            metadata = VolumeMetadata.from_cache_header(filename)
+            if metadata is not None:
+                batch.append(metadata)
+                found += 1
+            if batch and time.perf_counter() - batch_start >= Data_Manager.INDEX_BATCH_S:
+                self._indexed.emit(scan_index, batch)
+                (batch, batch_start) = ([], time.perf_counter())
+        if batch:
+            self._indexed.emit(scan_index, batch)
+        print(f'Data Manager: Indexed {found}/{len(scan_index)} volumes from cache headers.')
+
+    @Slot(object, object)
+    def _on_indexed(self, scan_index: ScanIndex, entries: list):
+        if scan_index is not self.scan_index:
+            # Indexed before another scan was selected
+            return
+        changed = False
+        for metadata in entries:
+            index = scan_index.positions.get(metadata.filename)
+            # Volumes which were loaded meanwhile are already known
+            if index is not None and scan_index.get(index) is None:
+                changed |= scan_index.set(metadata)
+        if changed:
+            self.scan_index_changed.emit(scan_index)
+
+
     # def extract_timestamp_from_filename(self, filename):
     #     try:
     #         timestamp_str = filename.split('_')[1] + filename.split('_')[2][:6]
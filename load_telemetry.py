@@ -0,0 +1,95 @@
+import json
+import time
+import threading
+import numpy as np
+from collections import deque
+
+class LoadTelemetry(object):
+    """
+    Rolling record of how the loading pipeline performs, shared between the loader
+    threads and the GUI. Every metric keeps its most recent `history` samples.
+
+    Load stages (seconds, per volume):
+      queue_wait_s - time between the request and a worker picking it up
+      read_s       - reading the file: loadmat (I/O and MAT parsing), or mapping in
+                     a volume file cache / spill entry
+      decode_s     - unpacking the MATLAB structs into metadata and raw sweeps
+      assemble_s   - building the product cubes (and writing them to the volume cache)
+      load_s       - total, from a worker picking the request up to the volume arriving
+    Interaction:
+      index_to_render_s - from a new timeline index to render_volume being emitted
+    Memory:
+      resident_bytes    - bytes held by the resident volume cache, after every change
+    """
+    STAGES = ('read_s', 'decode_s', 'assemble_s')
+    METRICS = ('queue_wait_s',) + STAGES + ('load_s', 'index_to_render_s', 'resident_bytes')
+
+    def __init__(self, history=500):
+        self.history = history
+        self.lock = threading.Lock()
+        self.samples = {metric: deque(maxlen=history) for metric in LoadTelemetry.METRICS}
+        # How each load was satisfied, e.g. 'matlab', 'cache' or 'spill'
+        self.sources = {}
+        self.started = time.time()
+
+    def record(self, metric, value):
+        with self.lock:
+            self.samples[metric].append(float(value))
+
+    def record_load(self, queue_wait_s, load_s, timings: dict):
+        """Record one finished load. `timings` holds the stages the loader measured and the 'source'."""
+        with self.lock:
+            self.samples['queue_wait_s'].append(float(queue_wait_s))
+            self.samples['load_s'].append(float(load_s))
+            for stage in LoadTelemetry.STAGES:
+                if stage in timings:
+                    self.samples[stage].append(float(timings[stage]))
+            source = timings.get('source', 'unknown')
+            self.sources[source] = self.sources.get(source, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            for samples in self.samples.values():
+                samples.clear()
+            self.sources.clear()
+            self.started = time.time()
+
+    def values(self, metric) -> np.ndarray:
+        with self.lock:
+            return np.array(self.samples[metric], dtype=np.float64)
+
+    def summary(self, metric) -> dict:
+        values = self.values(metric)
+        if len(values) == 0:
+            return {'count': 0}
+        (p50, p90, p99) = np.percentile(values, [50, 90, 99])
+        return {'count': len(values), 'mean': float(values.mean()), 'p50': float(p50), 'p90': float(p90),
+                'p99': float(p99), 'max': float(values.max())}
+
+    def histogram(self, metric, bins=20):
+        """(counts, bin edges) of the recent samples of a metric, None if there are none."""
+        values = self.values(metric)
+        if len(values) == 0:
+            return None
+        return np.histogram(values, bins=bins)
+
+    def load_sources(self) -> dict:
+        """Number of loads per source ('matlab', 'cache', 'spill')."""
+        with self.lock:
+            return dict(self.sources)
+
+    def snapshot(self, cache_stats=None) -> dict:
+        """Everything recorded so far (plus the cache counters), ready for json.dump."""
+        return {
+            'started': self.started,
+            'captured': time.time(),
+            'history': self.history,
+            'summary': {metric: self.summary(metric) for metric in LoadTelemetry.METRICS},
+            'samples': {metric: self.values(metric).tolist() for metric in LoadTelemetry.METRICS},
+            'load_sources': self.load_sources(),
+            'cache': cache_stats
+        }
+
+    def dump_json(self, path, cache_stats=None):
+        with open(path, "w") as dump_file:
+            json.dump(self.snapshot(cache_stats), dump_file, indent=1)
@@ -0,0 +1,84 @@
+import psutil
+from PySide6.QtCore import QObject, QTimer, Signal
+
+class MemoryGovernor(QObject):
+    """
+    Watches the memory use of the process and of the whole machine, and classifies
+    it into a pressure level. Several visualizer instances often share an analysis
+    node, so besides the process RSS (against an optional per-process limit) the
+    memory available system-wide is taken into account.
+
+    A level is entered as soon as its threshold is crossed, but only left once the
+    memory use has cleared the threshold by a margin, so the level doesn't flap while
+    the owner of the memory is shrinking its footprint.
+    """
+    NORMAL = 0
+    ELEVATED = 1
+    CRITICAL = 2
+    LEVEL_NAMES = ('normal', 'elevated', 'critical')
+
+    # Emitted with the new level when the pressure level changes
+    pressure_changed = Signal(int)
+    # Emitted with a short human readable summary after every sample
+    status_changed = Signal(str)
+
+    def __init__(self, rss_limit_bytes=None, elevated_available_fraction=0.15, critical_available_fraction=0.07,
+                 hysteresis=0.05, interval_ms=1000):
+        super().__init__()
+        # Process RSS above which memory is under pressure (None: only look at the system's available memory)
+        self.rss_limit_bytes = rss_limit_bytes
+        # Fractions of the total system memory which should remain available
+        self.elevated_available_fraction = elevated_available_fraction
+        self.critical_available_fraction = critical_available_fraction
+        # Margin by which the thresholds have to be cleared to step down a level
+        self.hysteresis = hysteresis
+        self.level = MemoryGovernor.NORMAL
+        self.rss_bytes = 0
+        self.available_bytes = 0
+        self.total_bytes = 0
+        self.process = psutil.Process()
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self.sample)
+
+    def start(self):
+        self.sample()
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def sample(self) -> int:
+        """Measure the memory use now, update the pressure level and return it."""
+        self.rss_bytes = self.process.memory_info().rss
+        system = psutil.virtual_memory()
+        self.available_bytes = system.available
+        self.total_bytes = system.total
+
+        level = self._classify(0.0)
+        if level < self.level:
+            # Only step down once the memory use is clear of the thresholds by a margin
+            level = max(level, min(self.level, self._classify(self.hysteresis)))
+
+        if level != self.level:
+            previous = self.level
+            self.level = level
+            print(f'Memory Governor: pressure {MemoryGovernor.LEVEL_NAMES[previous]} -> {MemoryGovernor.LEVEL_NAMES[level]} ({self.status()})')
+            self.pressure_changed.emit(level)
+        self.status_changed.emit(self.status())
+        return level
+
+    def status(self) -> str:
+        return (f'Memory: {MemoryGovernor.LEVEL_NAMES[self.level]} | RSS {self.rss_bytes / 1024**3:.1f} GB'
+                f' | {self.available_bytes / 1024**3:.1f}/{self.total_bytes / 1024**3:.1f} GB available')
+
+    def _classify(self, margin: float) -> int:
+        """Pressure level of the last sample, with the thresholds tightened by `margin`."""
+        available_fraction = self.available_bytes / self.total_bytes if self.total_bytes else 1.0
+        rss_fraction = self.rss_bytes / self.rss_limit_bytes if self.rss_limit_bytes else 0.0
+
+        if available_fraction < self.critical_available_fraction + margin or rss_fraction > 1.25 - margin:
+            return MemoryGovernor.CRITICAL
+        if available_fraction < self.elevated_available_fraction + margin or rss_fraction > 1.0 - margin:
+            return MemoryGovernor.ELEVATED
+        return MemoryGovernor.NORMAL
@@ -1,5 +1,6 @@
 import os
 import sys
+import argparse
 import random
 import vispy.app
 from pathlib import Path
@@ -7,22 +8,26 @@ from PySide6.QtWidgets import (QApplication, QMainWindow, QDockWidget, QFileDial
 from PySide6.QtGui import QAction
 from PySide6.QtCore import Qt, Signal, Slot
 from data_manager import Data_Manager
+from background_loader import BackgroundLoader
 from scan_set import ScanSet
 from scanset_builder import ScansetBuilder
 from volume_slice_selector import VolumeSliceSelector
 from dynamic_dock_widget import DynamicDockWidget
 from timeline_controls import TimelineControls
+from telemetry_panel import TelemetryPanel
+from thumbnail_cache import ThumbnailCache
 from slice_plot import SlicePlot
+from redraw_scheduler import RedrawScheduler
 from radar_volume import RadarVolume
 
 class PARDataVisualizer(QMainWindow):
-    def __init__(self):
+    def __init__(self, loader_backend='thread'):
         super().__init__()
         self.setWindowTitle("PAR Data Visualizer")
         self.setGeometry(0, 0, 1600, 900)
 
-        # Volume data manager
-        self.data_manager = Data_Manager(num_files_to_load=10)
+        # Volume data manager, decoding volumes with the chosen BackgroundLoader backend (--loader-backend)
+        self.data_manager = Data_Manager(num_files_to_load=10, loader_backend=loader_backend)
 
         # Menu bar and related actions
         menu_bar = self.menuBar()
@@ -83,6 +88,7 @@ class PARDataVisualizer(QMainWindow):
         self.volume_slice_selector = VolumeSliceSelector()
         self.data_manager.render_volume.connect(lambda r_vol: self.volume_slice_selector.on_grid_updated(len(r_vol.elevations_rad), len(r_vol.azimuths_rad), 20, 20, 10))
         # self.volume_slice_selector.on_grid_updated(1, 1, 20, 20, 10)
+        self.data_manager.scan_index_changed.connect(self.on_scan_index_changed)
         self.dockable_vss.setWidget(self.volume_slice_selector)
         
         # Timeline controls    
@@ -92,10 +98,31 @@ class PARDataVisualizer(QMainWindow):
         self.timeline_controls = TimelineControls()
         self.timeline_controls.timeline_index_changed.connect(lambda index: self.data_manager.set_current_index(index))
         self.data_manager.num_volumes_changed.connect(self.timeline_controls.on_num_volumes_changed)
+        self.timeline_controls.playback_state_changed.connect(self.data_manager.on_playback_state_changed)
+        # Playback only steps onto volumes which are loaded, and resumes as soon as the one it waits for is,
+        # or skips it if it failed to load
+        self.timeline_controls.set_ready_probe(self.data_manager.is_volume_ready, self.data_manager.is_volume_failed)
+        self.data_manager.next_volume_ready.connect(self.timeline_controls.on_next_volume_ready)
+        self.data_manager.volume_failed.connect(self.timeline_controls.on_volume_failed)
+        # Volume times for the timestamp label, seeking and real-time playback
+        self.data_manager.scan_index_changed.connect(self.timeline_controls.on_scan_index_changed)
+        # Thumbnails for scrubbing, built in the background and from the volumes as they load
+        self.thumbnail_cache = ThumbnailCache()
+        self.data_manager.scan_index_changed.connect(lambda scan_index: self.thumbnail_cache.set_files(scan_index.files))
+        self.data_manager.loader.volume_loaded.connect(self.thumbnail_cache.on_volume_loaded)
+        self.timeline_controls.set_thumbnail_cache(self.thumbnail_cache, *SlicePlot.cmaps.get_cmap_and_clims_for_product(ThumbnailCache.PRODUCT))
         self.dockable_timec.setWidget(self.timeline_controls)
         self.view_menu.addAction(self.dockable_timec.toggleViewAction())
         self.addDockWidget(Qt.DockWidgetArea.BottomDockWidgetArea, self.dockable_timec)
 
+        # Loader and cache telemetry
+        self.dockable_telemetry = QDockWidget("Telemetry", self)
+        self.dockable_telemetry.hide() # Don't show up at startup
+        self.telemetry_panel = TelemetryPanel(self.data_manager)
+        self.dockable_telemetry.setWidget(self.telemetry_panel)
+        self.view_menu.addAction(self.dockable_telemetry.toggleViewAction())
+        self.addDockWidget(Qt.DockWidgetArea.BottomDockWidgetArea, self.dockable_telemetry)
+
         # This is a bit of a hack to create a known position in the menu
         # before which we can insert new dynamic views.
         self.dummy_view_action = QAction("Dummy View Action", self)
@@ -105,6 +132,7 @@ class PARDataVisualizer(QMainWindow):
         
         self.dynamic_views = []
         self.dynamic_view_actions = {}
+        self.slice_plots = {}
         self.dynamic_view_count = 0
 
         # Initial PPI Canvas
@@ -119,6 +147,10 @@ class PARDataVisualizer(QMainWindow):
         self.ready_status_widget = QLabel('Ready to rock. 🎸 v0.1')
         self.show()
         self.statusBar().addPermanentWidget(self.ready_status_widget)
+        # Memory pressure level and usage, updated by the data manager's memory governor
+        self.memory_status_widget = QLabel(self.data_manager.memory_governor.status())
+        self.data_manager.memory_governor.status_changed.connect(self.memory_status_widget.setText)
+        self.statusBar().addPermanentWidget(self.memory_status_widget)
         self.statusBar().showMessage(f'PAR Data Visualizer initialized! {random.choice(self.happy_messages)}')
         
     def closeEvent(self, event):
@@ -126,8 +158,9 @@ class PARDataVisualizer(QMainWindow):
         because a QApplication will continue running as long as at least one
         top-level widget is still visible. This behavior is undesireable. The 
         user shouldn't have to close all windows before exiting."""
-        # Signal background loading tasks to stop.
-        self.data_manager.loader.stop_flag.set()
+        # Signal background loading and indexing tasks to stop.
+        self.data_manager.shutdown()
+        self.thumbnail_cache.shutdown()
         QApplication.instance().quit()
 
     def create_new_dynamic_view(self, floating, slice_type):
@@ -150,13 +183,22 @@ class PARDataVisualizer(QMainWindow):
 
         # When the data manager requests, render a volume
         self.data_manager.render_volume.connect(slice_plot.on_radar_volume_updated)
+        # Get the next volume onto the GPU ahead of time
+        self.data_manager.next_volume_ready.connect(slice_plot.on_next_volume_ready)
 
         # When the selected RHI/PPI slices change, update the plot
         self.volume_slice_selector.selection_changed.connect(slice_plot.on_az_el_index_selection_changed)
 
+        # Lay out the plot extents as soon as the scan geometry is known
+        self.data_manager.scan_index_changed.connect(lambda scan_index: slice_plot.on_scan_geometry_changed(self.current_scan_metadata(scan_index)))
+        slice_plot.on_scan_geometry_changed(self.current_scan_metadata(self.data_manager.scan_index))
+
         # When the user hovers on RHI/PPI slices, update the plot
         self.volume_slice_selector.slice_hovered.connect(slice_plot.on_az_el_slice_hovered)
 
+        # When the user switches products, let the data manager know which products are still in view
+        slice_plot.product_display_changed.connect(lambda product: self.update_visible_products())
+
         
         # View menu action management
         toggle_view_action = dock_widget.toggleViewAction()
@@ -166,6 +208,8 @@ class PARDataVisualizer(QMainWindow):
         self.dynamic_view_actions[dock_widget] = toggle_view_action
 
         self.dynamic_views.append(dock_widget)
+        self.slice_plots[dock_widget] = slice_plot
+        self.update_visible_products()
         self.statusBar().showMessage(f'{dock_widget.windowTitle()} view created.')
         return dock_widget
 
@@ -178,8 +222,29 @@ class PARDataVisualizer(QMainWindow):
             action = self.dynamic_view_actions.pop(dock_widget)
             self.view_menu.removeAction(action)
 
+        if dock_widget in self.slice_plots:
+            slice_plot = self.slice_plots.pop(dock_widget)
+            RedrawScheduler.instance().discard(slice_plot)
+            self.update_visible_products()
+
         self.statusBar().showMessage(f'{dock_widget.windowTitle()} view closed.')
         
+    def current_scan_metadata(self, scan_index):
+        """Metadata of the current volume from the scan index, or of any indexed volume as a stand-in."""
+        metadata = scan_index.get(self.data_manager.get_current_index())
+        return metadata if metadata is not None else scan_index.first_known()
+
+    @Slot(object)
+    def on_scan_index_changed(self, scan_index):
+        # Lay out the slice selector grid right away, instead of waiting for the first volume to load
+        metadata = self.current_scan_metadata(scan_index)
+        if metadata is not None and (self.volume_slice_selector.rows, self.volume_slice_selector.cols) != (metadata.num_elevations, metadata.num_azimuths):
+            self.volume_slice_selector.on_grid_updated(metadata.num_elevations, metadata.num_azimuths, 20, 20, 10)
+
+    def update_visible_products(self):
+        """Tell the data manager which products are displayed by the open views."""
+        self.data_manager.on_visible_products_changed([plot.get_product_display() for plot in self.slice_plots.values()])
+
     def new_scanset(self):
         self.dockable_ssb.setVisible(True)
         self.scanset = ScanSet("New scanset", base_dir=Path(os.path.expanduser("~")))
@@ -197,7 +262,7 @@ class PARDataVisualizer(QMainWindow):
         self.statusBar().showMessage(status)
 
     def on_volume_loaded(self, filename: str, r_volume: RadarVolume):
-        print(f'Loaded volume {filename} {r_volume.products["Z"].shape}')
+        print(f'Loaded volume {filename} {r_volume.shape}')
 
 # OLD STUFF
 
@@ -226,6 +291,13 @@ class PARDataVisualizer(QMainWindow):
     #         return timestamp_str
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='PAR Data Visualizer')
+    # Decoding on threads loads faster than spawning worker processes unless there are cores to spare,
+    # compare both on your data with: python ./background_loader.py --benchmark FILE.mat [FILE.mat ...]
+    parser.add_argument('--loader-backend', choices=BackgroundLoader.BACKENDS, default='thread',
+                        help="Decode volumes on a thread pool (default) or in worker processes.")
+    args = parser.parse_args()
+
     # Solves issue with VisPy plots breaking when docks transition between floating and docked: 
     # https://github.com/vispy/vispy/issues/1759#issuecomment-724217682
     QApplication.setAttribute(Qt.ApplicationAttribute.AA_ShareOpenGLContexts)
@@ -233,6 +305,6 @@ if __name__ == "__main__":
     # VisPy + PySide6 application initialization
     app = vispy.app.use_app("pyside6")
     app.create()
-    window = PARDataVisualizer()
+    window = PARDataVisualizer(loader_backend=args.loader_backend)
     window.show()
     sys.exit(app.run())
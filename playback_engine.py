@@ -0,0 +1,298 @@
+import time
+import numpy as np
+from collections import deque
+from PySide6.QtCore import QObject, QTimer, Qt, Signal, Slot
+from volume_timeline import VolumeTimeline
+
+class PlaybackEngine(QObject):
+    """
+    Steps through the volumes of a scan at a chosen speed, only showing volumes which are
+    ready. Before every step the engine asks a ready probe (e.g. Data_Manager.is_volume_ready)
+    whether the next volume is resident. If it isn't, the playback policy decides:
+
+    - WAIT holds the current volume until the next one arrives (a stall), so every volume
+      of the loop is shown, at the expense of the frame rate.
+    - DROP keeps to the schedule: once volumes arrive, it jumps to the latest one which is
+      due, skipping the ones in between (dropped frames), so the loop keeps its speed at
+      the expense of gaps. Playback only ever moves onto ready volumes, moving on to ones
+      which aren't would move the prefetch window away from the loads in flight.
+
+    Under either policy, volumes which failed to load (according to an optional failed probe,
+    e.g. Data_Manager.is_volume_failed) are skipped as if they had been shown, and counted as
+    dropped, instead of being waited for forever.
+
+    Volumes are either played evenly spaced (FRAMES, one volume per second at 1x) or in
+    REAL_TIME, where a playback clock runs at a multiple of real time over the volume
+    times of a VolumeTimeline, so the irregular gaps between volumes are kept. The clock
+    doesn't wait for rendering, a step shows the latest volume which is due by then.
+
+    The achieved frame rate (volumes actually shown per second), the stalls and the dropped
+    frames are counted, so the playback speed can be matched to what the loader sustains.
+    """
+    WAIT = 'wait'
+    DROP = 'drop'
+    POLICIES = (WAIT, DROP)
+    FRAMES = 'frames'
+    REAL_TIME = 'real_time'
+    MODES = (FRAMES, REAL_TIME)
+    # Multiples of one volume per second (FRAMES) or of real time (REAL_TIME)
+    SPEEDS = {FRAMES: (0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0),
+              REAL_TIME: (1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)}
+    # One volume per second at 1x
+    BASE_INTERVAL_MS = 1000
+    # How often the playback clock is checked for due volumes in REAL_TIME
+    REAL_TIME_TICK_MS = 20
+    # Number of recent frames the achieved frame rate is measured over
+    FPS_WINDOW = 30
+
+    # Index the playback moved to
+    index_changed = Signal(int)
+    # Emitted with get_stats() after every step
+    stats_changed = Signal(dict)
+
+    def __init__(self, ready_probe=None, policy=WAIT, speed=1.0, mode=FRAMES, failed_probe=None):
+        super().__init__()
+        # index -> whether the volume can be shown right away, everything is ready without a probe
+        self.ready_probe = ready_probe
+        # index -> whether the volume failed to load and won't become ready, nothing fails without a probe
+        self.failed_probe = failed_probe
+        self.policy = policy
+        self.speed = speed
+        self.mode = mode
+        self.direction = 1
+        self.index = 0
+        self.num_volumes = 0
+        # Volume times for REAL_TIME, evenly spaced until the actual times are known
+        self.timeline = VolumeTimeline([])
+        # Scan time (seconds since the Unix epoch) of the playback clock, and perf_counter() when it last advanced
+        self.clock_s = 0.0
+        self.last_tick_s = 0.0
+        # Whether the playback clock started the loop over while the last volume is still on screen
+        self.wrapped = False
+        self.timer = QTimer(self)
+        # Coarse timers may be off by 5% of the interval, which shows at 20x
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.setInterval(self.interval_ms())
+        self.timer.timeout.connect(self.step)
+        # Number of steps playback is behind its schedule
+        self.lag = 0
+        # perf_counter() when the current stall began, None if not stalled
+        self.stalled_since = None
+        self.reset_stats()
+
+    def interval_ms(self) -> int:
+        """Interval of the playback timer."""
+        if self.mode == PlaybackEngine.REAL_TIME:
+            return PlaybackEngine.REAL_TIME_TICK_MS
+        return max(1, round(PlaybackEngine.BASE_INTERVAL_MS / self.speed))
+
+    def volume_interval_ms(self) -> int:
+        """Average time between two volumes on screen, when playback keeps up."""
+        if self.mode == PlaybackEngine.REAL_TIME:
+            return max(1, round(self.timeline.mean_interval_s() * 1000 / self.speed))
+        return self.interval_ms()
+
+    def is_playing(self) -> bool:
+        return self.timer.isActive()
+
+    def start(self):
+        self.lag = 0
+        self.stalled_since = None
+        self.frame_times.clear()
+        self.clock_s = self.timeline.time_of(self.index) if self.index < len(self.timeline) else 0.0
+        self.wrapped = False
+        self.last_tick_s = time.perf_counter()
+        self.timer.start(self.interval_ms())
+
+    def stop(self):
+        self._end_stall()
+        self.timer.stop()
+
+    def set_speed(self, speed: float):
+        self.speed = speed
+        self.frame_times.clear()
+        self.timer.setInterval(self.interval_ms())
+
+    def set_policy(self, policy: str):
+        self.policy = policy
+        self.lag = 0
+
+    def set_mode(self, mode: str):
+        self.mode = mode
+        self.lag = 0
+        self.frame_times.clear()
+        self.timer.setInterval(self.interval_ms())
+        if self.is_playing():
+            self.start()
+
+    def set_num_volumes(self, num_volumes: int):
+        self.num_volumes = num_volumes
+        self.index = 0
+        self.lag = 0
+        self.wrapped = False
+        if len(self.timeline) != num_volumes:
+            self.timeline = VolumeTimeline(np.arange(num_volumes, dtype=np.float64))
+
+    def set_timeline(self, timeline: VolumeTimeline):
+        self.timeline = timeline
+        # The clock may have been running on the stand-in times
+        if self.index < len(timeline):
+            self.clock_s = timeline.time_of(self.index)
+            self.wrapped = False
+
+    @Slot(int)
+    def seek(self, index: int):
+        """Continue playback from `index`, e.g. after the user moved the timeline."""
+        if index != self.index:
+            self.index = index
+            self.lag = 0
+            self.wrapped = False
+            if index < len(self.timeline):
+                self.clock_s = self.timeline.time_of(index)
+
+    def next_index(self, steps=1) -> int:
+        return (self.index + steps * self.direction) % self.num_volumes
+
+    def is_ready(self, index) -> bool:
+        return self.ready_probe is None or self.ready_probe(index)
+
+    def is_failed(self, index) -> bool:
+        return self.failed_probe is not None and self.failed_probe(index)
+
+    @Slot()
+    def step(self):
+        """Timer tick: one more volume is due (FRAMES), or the playback clock moves on (REAL_TIME)."""
+        if self.num_volumes <= 0:
+            return
+        self._skip_failed()
+        if self.mode == PlaybackEngine.REAL_TIME:
+            now = time.perf_counter()
+            (elapsed_s, self.last_tick_s) = (now - self.last_tick_s, now)
+            due = self._due_real_time(elapsed_s * self.speed)
+            if not due:
+                # Between volumes
+                return
+        else:
+            if self.policy == PlaybackEngine.WAIT:
+                self.lag = 1
+            else:
+                # Beyond half the loop, the volumes due would wrap around onto the ones behind the cursor
+                self.lag = min(self.lag + 1, max(1, self.num_volumes // 2))
+            due = self._due_frames()
+        self._advance(due)
+        self.stats_changed.emit(self.get_stats())
+
+    @Slot()
+    def on_volume_ready(self):
+        """
+        Resume a stalled playback right away once a volume it waits for is ready (or failed to load),
+        instead of at the next tick.
+        """
+        if not self.is_playing() or self.stalled_since is None:
+            return
+        self._skip_failed()
+        due = self._due_real_time(0.0) if self.mode == PlaybackEngine.REAL_TIME else self._due_frames()
+        if self._advance(due):
+            if self.mode == PlaybackEngine.FRAMES:
+                # The resumed volume gets a whole interval on screen
+                self.timer.start()
+            self.stats_changed.emit(self.get_stats())
+
+    def _skip_failed(self):
+        """Move past the volumes next in line which failed to load, as if they had been shown, counting them as dropped."""
+        for _ in range(self.num_volumes - 1):
+            if self.mode == PlaybackEngine.REAL_TIME:
+                if self.index >= len(self.timeline):
+                    return
+                position = -1 if self.wrapped else self.timeline.position_of(self.index)
+                if position + 1 >= len(self.timeline):
+                    # The loop starts over once the clock gets there
+                    return
+                index = self.timeline.index_at_position(position + 1)
+            else:
+                index = self.next_index()
+            if not self.is_failed(index):
+                return
+            self.index = index
+            self.wrapped = False
+            self.dropped += 1
+
+    def _due_frames(self) -> list:
+        """Indices of the volumes due in FRAMES, latest first."""
+        return [self.next_index(steps) for steps in range(self.lag, 0, -1)]
+
+    def _due_real_time(self, advance_s) -> list:
+        """Move the playback clock on by `advance_s` of scan time, returns the indices of the volumes due, latest first."""
+        timeline = self.timeline
+        if self.index >= len(timeline):
+            # The timeline of a new scan, ahead of its volume count
+            return []
+        # Once the clock started the loop over, every volume from the start of the scan on is due
+        position = -1 if self.wrapped else timeline.position_of(self.index)
+        # The last volume stays on screen for an average interval before the loop starts over
+        loop_end_s = timeline.end_s + timeline.mean_interval_s()
+        self.clock_s += advance_s
+        if self.policy == PlaybackEngine.WAIT:
+            # Never run past the next volume
+            next_s = timeline.sorted_times_s[position + 1] if position + 1 < len(timeline) else loop_end_s
+            self.clock_s = min(self.clock_s, next_s)
+        if self.clock_s >= loop_end_s:
+            self.clock_s = timeline.start_s + (self.clock_s - loop_end_s) % (loop_end_s - timeline.start_s)
+            # Volumes at the end of the scan which never made it onto the screen
+            self.dropped += len(timeline) - 1 - position
+            # Remembered until a volume is shown, the start of the loop may not be ready yet
+            self.wrapped = True
+            position = -1
+        due_position = timeline.position_at(self.clock_s)
+        return [timeline.index_at_position(p) for p in range(due_position, position, -1)]
+
+    def _advance(self, due: list) -> bool:
+        """Show the latest volume of `due` (latest first) which is ready, returns False (and stalls) if there is none."""
+        for (k, index) in enumerate(due):
+            if self.is_ready(index):
+                self._end_stall()
+                # The ones due before it are skipped
+                self.dropped += len(due) - 1 - k
+                self.lag = 0
+                self._show(index)
+                return True
+        if self.stalled_since is None:
+            self.stalled_since = time.perf_counter()
+            self.stalls += 1
+        return False
+
+    def _show(self, index):
+        self.index = index
+        self.wrapped = False
+        self.frames += 1
+        self.frame_times.append(time.perf_counter())
+        self.index_changed.emit(index)
+
+    def _end_stall(self):
+        if self.stalled_since is not None:
+            self.stalled_s += time.perf_counter() - self.stalled_since
+            self.stalled_since = None
+
+    def achieved_fps(self) -> float:
+        """Volumes shown per second over the last frames."""
+        if len(self.frame_times) < 2:
+            return 0.0
+        elapsed = self.frame_times[-1] - self.frame_times[0]
+        return (len(self.frame_times) - 1) / elapsed if elapsed > 0 else 0.0
+
+    def reset_stats(self):
+        self.frames = 0
+        self.stalls = 0
+        self.dropped = 0
+        self.stalled_s = 0.0
+        self.frame_times = deque(maxlen=PlaybackEngine.FPS_WINDOW)
+
+    def get_stats(self) -> dict:
+        return {
+            'target_fps': 1000 / self.volume_interval_ms(),
+            'achieved_fps': self.achieved_fps(),
+            'frames': self.frames,
+            'stalls': self.stalls,
+            'stalled_s': self.stalled_s + (time.perf_counter() - self.stalled_since if self.stalled_since is not None else 0.0),
+            'dropped': self.dropped
+        }
@@ -0,0 +1,70 @@
+import numpy as np
+from collections import OrderedDict
+from slice_geometry import SliceGeometry
+
+class PolarResampler(object):
+    """
+    Resamples slices (angle x range blocks, see SliceGeometry) onto a Cartesian raster
+    in kilometers on the CPU, as an alternative to bending the slice texture into polar
+    space with a subdivided mesh on the GPU.
+
+    For every raster pixel the angle and range gate it falls into are looked up once
+    and kept as a pair of index arrays, so resampling a slice is a single fancy-indexing
+    gather. The lookup table only depends on the slice geometry and the raster size, and
+    is shared by every plot which displays slices of the same geometry at the same size.
+    """
+    # (geometry, width, height) -> PolarResampler, most recently used last
+    cache = OrderedDict()
+    CACHE_SIZE = 8
+
+    def __init__(self, geometry: SliceGeometry, width: int, height: int):
+        self.geometry = geometry
+        (x0, x1, y0, y1) = PolarResampler.extent_km(geometry)
+        # Square pixels, covering the extent of the slice
+        self.km_per_pixel = max((x1 - x0) / width, (y1 - y0) / height)
+        self.width = max(1, int(np.ceil((x1 - x0) / self.km_per_pixel)))
+        self.height = max(1, int(np.ceil((y1 - y0) / self.km_per_pixel)))
+        self.origin_km = (x0, y0)
+
+        # Centers of the raster pixels in kilometers
+        x = x0 + (np.arange(self.width, dtype=np.float64) + 0.5) * self.km_per_pixel
+        y = y0 + (np.arange(self.height, dtype=np.float64) + 0.5) * self.km_per_pixel
+        (xx, yy) = np.meshgrid(x, y)
+        (angle_idx, range_idx) = geometry.gate_indices(xx, yy)
+
+        # Pixels outside of the slice read a dummy gate and are masked out afterwards
+        self.outside = (angle_idx < 0) | (range_idx < 0)
+        self.angle_idx = np.where(self.outside, 0, angle_idx).astype(np.intp)
+        self.range_idx = np.where(self.outside, 0, range_idx).astype(np.intp)
+
+    @staticmethod
+    def get(geometry: SliceGeometry, width: int, height: int):
+        """The resampler for a geometry and raster size, built the first time it is needed."""
+        key = (geometry, width, height)
+        resampler = PolarResampler.cache.get(key)
+        if resampler is None:
+            resampler = PolarResampler(geometry, width, height)
+            PolarResampler.cache[key] = resampler
+            while len(PolarResampler.cache) > PolarResampler.CACHE_SIZE:
+                PolarResampler.cache.popitem(last=False)
+        PolarResampler.cache.move_to_end(key)
+        return resampler
+
+    @staticmethod
+    def extent_km(geometry: SliceGeometry):
+        """Bounding box (x0, x1, y0, y1) of the slice in kilometers."""
+        steps = np.linspace(0, geometry.num_angles, 721)
+        theta = geometry.radial_swath * geometry.loc0 + geometry.direction * steps * geometry.radial_swath / geometry.num_angles
+        radii = np.array([geometry.y_start, geometry.y_start + geometry.num_ranges])[:, np.newaxis] * geometry.km_per_pixel
+        x = radii * np.cos(theta)
+        y = radii * np.sin(theta)
+        return (x.min(), x.max(), y.min(), y.max())
+
+    def resample(self, slice_data: np.ndarray) -> np.ndarray:
+        """
+        Resample a slice (angle x range, any strides) onto the raster. Returns a float32
+        (height x width) image, NaN outside of the slice.
+        """
+        image = np.asarray(slice_data[self.angle_idx, self.range_idx], dtype=np.float32)
+        image[self.outside] = np.nan
+        return image
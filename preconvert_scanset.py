@@ -0,0 +1,101 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from scan_set import ScanSet
+from radar_volume import RadarVolume
+from volume_file_cache import VolumeFileCache
+
+# Headless pre-conversion of a scanset into the volume file cache. Run it ahead of
+# time (e.g. overnight for a whole weather event) so interactive sessions can map
+# every volume in straight from the cache instead of paying the loadmat cost.
+#
+#   python ./preconvert_scanset.py path/to/scanset.json [--workers N] [--force]
+#
+# Cache entries are written atomically, so an interrupted run can simply be started
+# again: files with an up-to-date cache entry are skipped.
+
+def convert_file(file_path: Path):
+    """
+    Worker process entry point. Returns a (file_path, succeeded, seconds) tuple.
+    """
+    start = time.perf_counter()
+    try:
+        succeeded = RadarVolume.convert_matlab_file_to_cache(file_path)
+    except Exception as e:
+        print(f'Failed to convert "{file_path}": {e}')
+        succeeded = False
+    return (file_path, succeeded, time.perf_counter() - start)
+
+def collect_scanset_files(scanset: ScanSet) -> list[Path]:
+    """All the volume files referenced by a scanset, in scan order and without duplicates."""
+    base_dir = scanset.get_base_dir()
+    files = {}
+    for scan in scanset.get_scans():
+        for filename in scan.get_scan_files():
+            files.setdefault(base_dir / Path(filename), None)
+    return list(files.keys())
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours}h{minutes:02d}m{seconds:02d}s' if hours else f'{minutes}m{seconds:02d}s'
+
+def preconvert_scanset(scanset_path: Path, workers: int, force: bool = False) -> int:
+    """
+    Convert every volume of the scanset into the volume file cache. Returns the number of failures.
+    """
+    scanset = ScanSet.load_scanset(scanset_path)
+    files = collect_scanset_files(scanset)
+    print(f'Scanset "{scanset.get_name()}": {len(files)} volume files.')
+
+    missing = [f for f in files if not f.exists()]
+    for f in missing:
+        print(f'Missing: "{f}"')
+
+    todo = [f for f in files if f.exists() and (force or not VolumeFileCache.is_valid(f, np.float32))]
+    print(f'{len(files) - len(missing) - len(todo)} already up to date, {len(missing)} missing, {len(todo)} to convert with {workers} workers.')
+
+    if force:
+        # Invalidate the existing entries so the workers decode the files again.
+        for f in todo:
+            (VolumeFileCache.cache_dir_for(f) / VolumeFileCache.HEADER_NAME).unlink(missing_ok=True)
+
+    failures = 0
+    done_bytes = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(convert_file, f) for f in todo]
+        for (done, future) in enumerate(as_completed(futures), start=1):
+            (file_path, succeeded, seconds) = future.result()
+            if succeeded:
+                done_bytes += file_path.stat().st_size
+            else:
+                failures += 1
+
+            elapsed = time.perf_counter() - start
+            files_per_s = done / elapsed
+            mb_per_s = done_bytes / elapsed / 1e6
+            eta = (len(todo) - done) / files_per_s
+            print(f'[{done:>{len(str(len(todo)))}}/{len(todo)}] {"ok  " if succeeded else "FAIL"} {file_path.name} '
+                  f'({seconds:.2f} s) | {files_per_s:.2f} files/s, {mb_per_s:.1f} MB/s, ETA {format_duration(eta)}')
+
+    elapsed = time.perf_counter() - start
+    print(f'Converted {len(todo) - failures} files in {format_duration(elapsed)} ({failures} failed).')
+    return failures + len(missing)
+
+def main():
+    parser = argparse.ArgumentParser(description='Pre-convert the volume files of a scanset into the fast-loading volume cache.')
+    parser.add_argument('scanset', type=Path, help='Path to a scanset JSON file.')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(), help='Number of worker processes (default: all CPU cores).')
+    parser.add_argument('--force', action='store_true', help='Convert files again even if their cache entry is up to date.')
+    args = parser.parse_args()
+
+    failures = preconvert_scanset(args.scanset, max(1, args.workers), args.force)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
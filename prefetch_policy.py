@@ -0,0 +1,55 @@
+import math
+import numpy as np
+from collections import deque
+
+class PrefetchPolicy(object):
+    """
+    Decides how many volumes to keep loaded ahead of and behind the cursor.
+
+    While paused the user may step either way, so the window is symmetric. While
+    playing, volumes are consumed at one per timer interval in the playback
+    direction, so the window leans ahead: far enough that a volume requested now
+    finishes loading (on one of the parallel workers) before playback reaches it,
+    while only a little is kept behind the cursor for stepping back.
+    """
+    def __init__(self, num_workers=1, history=20):
+        self.num_workers = max(1, num_workers)
+        self.playing = False
+        self.direction = 1
+        self.interval_s = 1.0
+        # Recent per-volume load times (seconds), excluding time spent waiting in the queue
+        self.load_times = deque(maxlen=history)
+
+    def set_playback(self, playing: bool, direction: int, interval_ms: int):
+        self.playing = playing
+        self.direction = 1 if direction >= 0 else -1
+        self.interval_s = max(interval_ms, 1) / 1000.0
+
+    def record_load_time(self, seconds: float):
+        self.load_times.append(seconds)
+
+    def mean_load_time(self) -> float:
+        return float(np.mean(self.load_times)) if self.load_times else 0.0
+
+    def volumes_needed_ahead(self) -> int:
+        """
+        Number of volumes to keep in flight ahead of the cursor while playing. A volume takes
+        `load time` to arrive, during which `load time / interval` volumes are played. Keep
+        enough requests queued to occupy every worker on top of that.
+        """
+        volumes_per_load = self.mean_load_time() / self.interval_s
+        return math.ceil(volumes_per_load) + self.num_workers
+
+    def window(self, files_per_side: int):
+        """
+        Returns the (behind, ahead) number of volumes to keep loaded, in terms of the playback
+        direction, given the symmetric window of `files_per_side` the cache budget allows.
+        """
+        if not self.playing:
+            return (files_per_side, files_per_side)
+
+        total = 2 * files_per_side
+        behind = min(1, total)
+        # Playback waits for the next volume, so it is requested even when nothing else fits
+        ahead = max(1, min(total - behind, max(files_per_side, self.volumes_needed_ahead())))
+        return (behind, ahead)
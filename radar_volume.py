@@ -1,6 +1,117 @@
 import scipy.io as scio
 import numpy as np
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
 from datetime import datetime
+from functools import partial
+from time import perf_counter
+from volume_file_cache import VolumeFileCache
+
+def add_timing(timings, stage, start):
+    """Add the time since `start` (a perf_counter() value) to `timings[stage]`, if timings are being collected."""
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + perf_counter() - start
+
+class LazyProducts(Mapping):
+    """
+    A read-only mapping of product type -> 3-D block of data (el x az x range) which
+    only builds a product the first time it is accessed. Each product is described by
+    a zero-argument builder, e.g. stacking the raw sweeps of the product or mapping a
+    cached array back in. Built products are kept until they are dropped again.
+
+    `source_nbytes` maps a product type to the memory held by its builder (e.g. the
+    raw sweeps of the product), which counts towards `nbytes`. Such a builder is the
+    only source of its product: the first build keeps the cube and releases the
+    builder, so the sweeps are freed, and the product can't be dropped afterwards.
+    """
+    def __init__(self, builders: dict, source_nbytes=None):
+        self.builders = dict(builders)
+        self.source_nbytes = dict(source_nbytes) if source_nbytes else {}
+        self.cubes = {}
+        # Products may be requested from the GUI thread while a loader thread is still
+        # working with the volume, make sure each product is only built once.
+        self.lock = threading.Lock()
+
+    def __getitem__(self, p_type):
+        cube = self.cubes.get(p_type)
+        if cube is not None:
+            return cube
+
+        with self.lock:
+            if p_type not in self.cubes:
+                self.cubes[p_type] = self.builders[p_type]()
+                if self.source_nbytes.pop(p_type, None) is not None:
+                    # The cube replaces the raw data of the product
+                    self.builders[p_type] = None
+            return self.cubes[p_type]
+
+    def __iter__(self):
+        return iter(self.builders)
+
+    def __len__(self):
+        return len(self.builders)
+
+    def is_loaded(self, p_type) -> bool:
+        return p_type in self.cubes
+
+    def loaded(self) -> list:
+        """The product types which are currently built."""
+        return list(self.cubes.keys())
+
+    def get_built(self, p_type):
+        """A product if it is built, None otherwise. Never builds it."""
+        return self.cubes.get(p_type)
+
+    def build(self, p_type):
+        """Build a product without keeping it, unless it is already built or can only be built once."""
+        cube = self.cubes.get(p_type)
+        if cube is not None:
+            return cube
+        if p_type in self.source_nbytes:
+            return self[p_type]
+        return self.builders[p_type]()
+
+    def iter_built(self):
+        """Yield (product type, cube) pairs one at a time without keeping the cubes."""
+        for p_type in self.builders:
+            yield (p_type, self.build(p_type))
+
+    def drop(self, p_type):
+        """Release a built product. It will be rebuilt the next time it is accessed."""
+        with self.lock:
+            if self.builders[p_type] is not None:
+                self.cubes.pop(p_type, None)
+
+    def retain(self, p_types):
+        """Release every built product which is not in `p_types`."""
+        with self.lock:
+            for p_type in [p for p in self.cubes if p not in p_types and self.builders[p] is not None]:
+                del self.cubes[p_type]
+
+    def downcast(self, p_types, dtype=np.float16):
+        """
+        Shrink every product which is not in `p_types`. Products which can be built again are released,
+        as by retain(). Those which can't are kept in `dtype`, a product which isn't built yet is built
+        first so its raw sweeps are released too.
+        """
+        with self.lock:
+            for p_type in [p for p in self.builders if p not in p_types]:
+                if self.builders[p_type] is not None and p_type not in self.source_nbytes:
+                    self.cubes.pop(p_type, None)
+                    continue
+                cube = self.cubes.get(p_type)
+                if cube is None:
+                    cube = self.builders[p_type]()
+                    self.builders[p_type] = None
+                    del self.source_nbytes[p_type]
+                if cube.dtype.itemsize > np.dtype(dtype).itemsize:
+                    self.cubes[p_type] = cube.astype(dtype)
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes held by the built products and the builders."""
+        return sum(list(self.source_nbytes.values())) + sum(cube.nbytes for cube in list(self.cubes.values()))
 
 class RadarVolume(object):
     """
@@ -32,18 +143,183 @@ class RadarVolume(object):
         self.azimuth_swath_rad = azimuth_swath_rad
         self.elevations_rad = elevations_rad
         self.elevation_swath_rad  = elevation_swath_rad
+        # Seconds it took the background loader to produce this volume (None if unknown)
+        self.load_time_s = None
+        # (product, slice type, index[, level]) -> contiguous slice, least recently used first. See
+        # ppi_slice/rhi_slice/slice_level, at most MAX_CACHED_SLICES are kept.
+        self.slices = OrderedDict()
+
+    # Number of slices kept per volume: the slices on screen, their levels of detail and some scrubbing history
+    MAX_CACHED_SLICES = 32
+
+    # Constructor arguments (besides the filename and products) which make up the metadata of a volume.
+    METADATA_FIELDS = ('radar', 'lat', 'lon', 'elev_m', 'height_m', 'lambda_m', 'prf_hz', 'nyq_m_per_s',
+                       'datestr', 'time', 'vcp', 'sclice_type', 'start_range_km', 'ranges_km',
+                       'doppler_resolution_km', 'azimuths_rad', 'azimuth_swath_rad', 'elevations_rad',
+                       'elevation_swath_rad')
+
+    def metadata(self) -> dict:
+        """
+        The scalar and geometry metadata of the volume, i.e. everything except the product data.
+        """
+        return {field: getattr(self, field) for field in RadarVolume.METADATA_FIELDS}
+
+    @property
+    def shape(self) -> tuple:
+        """Shape of every product block (el x az x range), known without building any product."""
+        return (len(self.elevations_rad), len(self.azimuths_rad), len(self.ranges_km))
+
+    @property
+    def nbytes(self) -> int:
+        """Number of bytes held by the products which are currently built (and their raw sweeps, if any) and the cached slices."""
+        return self.products.nbytes + sum(s.nbytes for s in list(self.slices.values()))
+
+    def drop_products(self, keep):
+        """Release every built product except those in `keep`, e.g. the products nobody is viewing."""
+        self.products.retain(keep)
+        for key in [key for key in self.slices if key[0] not in keep]:
+            del self.slices[key]
+
+    def downcast_products(self, keep, dtype=np.float16):
+        """Like drop_products(), but the products which can't be released are kept at a lower precision instead."""
+        self.products.downcast(keep, dtype)
+        for key in [key for key in self.slices if key[0] not in keep]:
+            del self.slices[key]
+
+    def ppi_slice(self, p_type, el_idx) -> np.ndarray:
+        """The PPI slice of a product at an elevation index, as a C-contiguous (range x azimuth) array."""
+        return self._get_slice(p_type, 'ppi', el_idx)
+
+    def rhi_slice(self, p_type, az_idx) -> np.ndarray:
+        """The RHI slice of a product at an azimuth index, as a C-contiguous (range x elevation) array."""
+        return self._get_slice(p_type, 'rhi', az_idx)
+
+    def slice_level(self, p_type, slice_type, index, pyramid, level) -> np.ndarray:
+        """A level of detail of a PPI/RHI slice (see SlicePyramid), reduced the first time it is needed."""
+        if level == 0:
+            return self._get_slice(p_type, slice_type, index)
+        key = (p_type, slice_type, index, level)
+        data = self._cached_slice(key)
+        if data is None:
+            data = pyramid.reduce(self._get_slice(p_type, slice_type, index), level, p_type)
+            self._cache_slice(key, data)
+        return data
+
+    def _get_slice(self, p_type, slice_type, index):
+        # Slices of the (el x az x range) cube are strided, and the plots want them transposed. Copy each
+        # slice into an upload-ready layout the first time it is shown, scrubbing back to it is then free.
+        key = (p_type, slice_type, index)
+        data = self._cached_slice(key)
+        if data is None:
+            cube = self.products[p_type]
+            # Downcast products (see downcast_products) are shown in float32 like the rest
+            data = np.ascontiguousarray((cube[index, :, :] if slice_type == 'ppi' else cube[:, index, :]).T, dtype=np.float32)
+            self._cache_slice(key, data)
+        return data
+
+    def _cached_slice(self, key):
+        data = self.slices.get(key)
+        if data is not None:
+            self.slices.move_to_end(key)
+        return data
+
+    def _cache_slice(self, key, data):
+        self.slices[key] = data
+        while len(self.slices) > RadarVolume.MAX_CACHED_SLICES:
+            self.slices.popitem(last=False)
+
+    @staticmethod
+    def build_radar_volume_from_cache(file_path, dtype=np.float32):
+        """
+        Static method for mapping a previously decoded volume back in from the volume
+        file cache. Returns None if there is no up-to-date cache entry for the file.
+        """
+        cached = VolumeFileCache.read(file_path, dtype)
+        if cached is None:
+            return None
+
+        (metadata, product_paths) = cached
+        products = LazyProducts({p_type: partial(VolumeFileCache.map_product, path) for (p_type, path) in product_paths.items()})
+        return RadarVolume.from_metadata(file_path, metadata, products)
+
+    @staticmethod
+    def from_metadata(file_path, metadata: dict, products):
+        """
+        Rebuild a volume from metadata stored as JSON (see `metadata()`) and its products.
+        """
+        metadata = dict(metadata)
+        for field in ('ranges_km', 'azimuths_rad', 'elevations_rad'):
+            metadata[field] = np.asarray(metadata[field], dtype=np.float64)
+        return RadarVolume(filename=file_path, products=products, **metadata)
     
     @staticmethod
-    def build_radar_volume_from_matlab_file(file_path):
+    def convert_matlab_file_to_cache(file_path, dtype=np.float32, timings=None) -> bool:
+        """
+        Decode a MATLAB volume file into the volume file cache without keeping it around.
+        Returns True if an up-to-date cache entry exists afterwards. Safe to run in a worker process.
+        """
+        if VolumeFileCache.is_valid(file_path, dtype):
+            return True
+        RadarVolume.build_radar_volume_from_matlab_file(file_path, dtype, use_cache=True, timings=timings)
+        return VolumeFileCache.is_valid(file_path, dtype)
+
+    @staticmethod
+    def _assemble_product_cube(sweeps, p_type, dtype):
+        """
+        Stack the sweeps of a single product into a 3-D block (el x az x range).
+
+        Each sweep is stored range x az in the file, so the transposed views are
+        stacked straight into a single `dtype` array: one copy per gate instead of
+        a cast followed by a write into a float64 block.
+        """
+        sweeps = [sweep.T for sweep in sweeps]
+        if p_type == 'R':
+            # Correlation coefficient is stored as a complex value, keep the magnitude.
+            sweeps = [np.abs(sweep) for sweep in sweeps]
+        return np.stack(sweeps, dtype=dtype, casting='unsafe')
+
+    @staticmethod
+    def build_radar_volume_from_matlab_file(file_path, dtype=np.float32, use_cache=True, cancel_flag=None, timings=None):
         """
         Static method for reading in a MATLAB data file containing a volume of data
         from a PAR scan. Using the static method convention to indicate that construction
         of one of these objects is non-trivial and may take some time.
+
+        The product cubes are assembled in `dtype` (float32 by default). Pass np.float64
+        to get full precision at twice the memory cost.
+
+        With `use_cache` the volume file cache is tried first, and a freshly decoded
+        volume is written to it so the next load can skip the .mat file entirely.
+
+        `cancel_flag` (e.g. a threading.Event) is checked between the loading stages, and
+        None is returned as soon as it is set.
+
+        If a `timings` dict is passed, the seconds spent reading the file ('read_s'),
+        decoding the MATLAB structs ('decode_s') and assembling/caching the product
+        cubes ('assemble_s') are added to it, and 'source' is set to where the volume
+        came from ('cache' or 'matlab') unless it is already set.
         """
+        if use_cache:
+            start = perf_counter()
+            r_volume = RadarVolume.build_radar_volume_from_cache(file_path, dtype)
+            if r_volume is not None:
+                add_timing(timings, 'read_s', start)
+                if timings is not None:
+                    timings.setdefault('source', 'cache')
+                return r_volume
+
+        if timings is not None:
+            timings.setdefault('source', 'matlab')
         try:
             # Load the data.
             #   squeeze_me=True, collapse unit dimensions (no 1x1 ndarrays).    
+            start = perf_counter()
             data = scio.loadmat(file_path, squeeze_me=True)
+            add_timing(timings, 'read_s', start)
+            start = perf_counter()
+
+            if cancel_flag is not None and cancel_flag.is_set():
+                return None
         
             if 'volume' not in data:
                 print("No 'volume' key found in the .mat file. Please check the data structure.")
@@ -56,12 +332,10 @@ class RadarVolume(object):
             first_slice = volume[0]
 
             # Extract metadata.
-            azimuths_rad = [(az * np.pi / 180.0) for az in first_slice['az_deg']]
+            azimuths_rad = np.deg2rad(np.asarray(first_slice['az_deg'], dtype=np.float64))
             azimuth_swath_rad = np.abs(azimuths_rad[-1] - azimuths_rad[0])
-            num_azimuths = len(azimuths_rad)
-            elevations_rad = [(entry['sweep_el_deg'] * np.pi / 180.0) for entry in volume]
+            elevations_rad = np.deg2rad(np.array([entry['sweep_el_deg'] for entry in volume], dtype=np.float64))
             elevation_swath_rad = np.abs(elevations_rad[-1] - elevations_rad[0])
-            num_elevations = len(elevations_rad)
             product_types = [entry['type'] for entry in first_slice['prod']]
             start_range_km = first_slice['start_range_km']
             # DR "doppler resolution"
@@ -69,27 +343,17 @@ class RadarVolume(object):
             
             # Build up the range bins
             num_ranges = first_slice['prod'][0]['data'].shape[0]
-            ranges_km = [(start_range_km + (doppler_resolution_km * i)) for i in range(num_ranges)]
-            range_swath_km = np.abs(ranges_km[-1] - ranges_km[0])
+            ranges_km = start_range_km + doppler_resolution_km * np.arange(num_ranges, dtype=np.float64)
             
-            # Transform the data from each product into a 3-dimensional ndarray and place it in the products dictionary
-            products = {}
-            for p_type in product_types:
-                # Initialize the 3-D block of data for the current product (el x az x range)
-                products[p_type] = np.zeros((num_elevations, num_azimuths, num_ranges))
-
-                # Transform the source data into the 3-D block for the current product.
-                p_data = products[p_type]
-                p_idx = product_types.index(p_type)
-                for el_idx in range(num_elevations):
-                    prods = volume[el_idx]['prod']
-                    if p_type == 'R':
-                        p_data[el_idx, :, :] = np.abs(prods[p_idx]['data']).astype(np.float32).T
-                    else:
-                        p_data[el_idx, :, :] = prods[p_idx]['data'].astype(np.float32).T
-                    
-
-            return RadarVolume(
+            # Hold onto the raw sweeps of each product (no copies). The 3-dimensional ndarray of a
+            # product is only assembled the first time somebody accesses it, which releases its sweeps.
+            sweeps = {p_type: [entry['prod'][p_idx]['data'] for entry in volume] for (p_idx, p_type) in enumerate(product_types)}
+            source_nbytes = {p_type: sum(sweep.nbytes for sweep in p_sweeps) for (p_type, p_sweeps) in sweeps.items()}
+            builders = {p_type: partial(RadarVolume._assemble_product_cube, p_sweeps, p_type, dtype)
+                        for (p_type, p_sweeps) in sweeps.items()}
+            products = LazyProducts(builders, source_nbytes)
+
+            r_volume = RadarVolume(
                 filename=file_path,
                 radar=first_slice['radar'] if 'radar' in first_slice.dtype.names else None,
                 lat=first_slice['lat'] if 'lat' in first_slice.dtype.names else None,
@@ -113,8 +377,72 @@ class RadarVolume(object):
                 azimuth_swath_rad=azimuth_swath_rad,
                 elevations_rad=elevations_rad,
                 elevation_swath_rad=elevation_swath_rad)
+            # From here on the builders hold the only references to the raw sweeps
+            del data, volume, first_slice, sweeps
+            add_timing(timings, 'decode_s', start)
 
         except:
             # TODO: Hushing any volume loading errors down to a single print statement for now. In the future, this should write to a log or something so that it can be triaged.
             print(f'Failed to load .mat file: "{file_path}"')
-            return None
\ No newline at end of file
+            return None
+
+        if cancel_flag is not None and cancel_flag.is_set():
+            return None
+
+        if use_cache:
+            # Stream the products through the cache one cube at a time, each cube replacing the raw
+            # sweeps of its product, then switch over to the memory-mapped entry. If the write fails
+            # the volume keeps the assembled cubes instead of the sweeps.
+            start = perf_counter()
+            written = VolumeFileCache.write(file_path, r_volume.metadata(), r_volume.products.iter_built())
+            cached_volume = RadarVolume.build_radar_volume_from_cache(file_path, dtype) if written else None
+            add_timing(timings, 'assemble_s', start)
+            if cached_volume is not None:
+                return cached_volume
+
+        return r_volume
+
+
+# Benchmark of the slice extraction and texture upload, with and without the slice cache:
+#
+#   python ./radar_volume.py path/to/volume.mat
+if __name__ == "__main__":
+    import sys
+    import timeit
+    from pathlib import Path
+    from vispy import gloo
+
+    r_volume = RadarVolume.build_radar_volume_from_matlab_file(Path(sys.argv[1]))
+    (num_el, num_az, num_ranges) = r_volume.shape
+    print(f'Volume {r_volume.filename.name}: {num_el} x {num_az} x {num_ranges}')
+
+    # Without a GL context the upload stops at VisPy's command queue, which is where the copies happen.
+    # SlicePlot uploads float slices as they are, into single channel float textures.
+    texture = gloo.Texture2D(np.zeros((10, 10), dtype=np.float32), internalformat='r32f')
+    def upload(data):
+        texture.set_data(data)
+        texture.glir.clear()
+
+    cube = r_volume.products['Z']
+    cases = {
+        'PPI strided': lambda i: cube[i % num_el, :, :].T,
+        'PPI cached': lambda i: r_volume.ppi_slice('Z', i % num_el),
+        'RHI strided': lambda i: cube[:, i % num_az, :].T,
+        'RHI cached': lambda i: r_volume.rhi_slice('Z', i % num_az),
+    }
+    # Cycle through as many slices as the slice cache holds
+    num_slices = RadarVolume.MAX_CACHED_SLICES // 2
+    for i in range(num_slices):
+        # Fill the slice cache
+        r_volume.ppi_slice('Z', i % num_el)
+        r_volume.rhi_slice('Z', i % num_az)
+
+    repeats = 500
+    def best_ms(fn):
+        return min(timeit.repeat(lambda: [fn(i % num_slices) for i in range(repeats)], number=1, repeat=7)) / repeats * 1000
+
+    print(f'{"":<12} {"extract":>10} {"upload":>10}')
+    for (name, get_slice) in cases.items():
+        extract_ms = best_ms(lambda i: np.ascontiguousarray(get_slice(i)))
+        upload_ms = best_ms(lambda i: upload(get_slice(i)))
+        print(f'{name:<12} {extract_ms:>7.3f} ms {upload_ms:>7.3f} ms')
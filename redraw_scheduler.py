@@ -0,0 +1,83 @@
+from PySide6.QtCore import QObject, QTimer, Slot
+
+class RedrawScheduler(QObject):
+    """
+    Coalesces redraw requests of views (e.g. SlicePlots) into at most one redraw per
+    view per display frame. Views are only marked dirty when their state changes, and
+    every dirty view is redrawn once, from its latest state, when the frame timer fires.
+    A fast sweep over the slice selector then costs one redraw per frame instead of one
+    per mouse event.
+
+    A view is any object with a `redraw()` method.
+    """
+    # ~60 Hz
+    FRAME_INTERVAL_MS = 16
+
+    _instance = None
+
+    @staticmethod
+    def instance():
+        """The scheduler shared by all views, created the first time it is needed."""
+        if RedrawScheduler._instance is None:
+            RedrawScheduler._instance = RedrawScheduler()
+        return RedrawScheduler._instance
+
+    def __init__(self, frame_interval_ms=FRAME_INTERVAL_MS):
+        super().__init__()
+        # Dirty views, in the order they were first marked (dict as an ordered set)
+        self.dirty = {}
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(frame_interval_ms)
+        self.timer.timeout.connect(self.flush)
+
+        # Counters
+        self.requested = 0
+        # Requests folded into a redraw which was already pending
+        self.coalesced = 0
+        self.executed = 0
+        self.frames = 0
+
+    def mark_dirty(self, view):
+        """Redraw `view` at the next frame."""
+        self.requested += 1
+        if view in self.dirty:
+            self.coalesced += 1
+            return
+        self.dirty[view] = None
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def discard(self, view):
+        """Forget a view which is going away, along with any pending redraw."""
+        self.dirty.pop(view, None)
+
+    @Slot()
+    def flush(self):
+        """Redraw every dirty view now."""
+        (dirty, self.dirty) = (self.dirty, {})
+        if not dirty:
+            return
+        self.frames += 1
+        for view in dirty:
+            self.executed += 1
+            try:
+                view.redraw()
+            except Exception as e:
+                # Keep the other views going
+                print(f'Redraw Scheduler: failed to redraw {view}: {e}')
+
+    def reset_stats(self):
+        self.requested = 0
+        self.coalesced = 0
+        self.executed = 0
+        self.frames = 0
+
+    def get_stats(self) -> dict:
+        return {
+            'requested': self.requested,
+            'coalesced': self.coalesced,
+            'executed': self.executed,
+            'frames': self.frames,
+            'pending': len(self.dirty)
+        }
@@ -0,0 +1,110 @@
+import itertools
+import numpy as np
+from collections import OrderedDict
+from radar_volume import RadarVolume
+
+class ResidentVolumeCache(object):
+    """
+    In-memory cache of loaded radar volumes, bounded by a byte budget instead of a
+    number of files. The size of a volume is the `nbytes` of its built products, so
+    it grows as products are decoded and shrinks as they are dropped.
+
+    When the cache is over budget, volumes are evicted by a score combining how long
+    ago they were last used (LRU) and how far they are from the cursor, so volumes
+    which were just visited or are about to be visited survive the longest. Pinned
+    volumes (e.g. the one on screen) are never evicted.
+    """
+    def __init__(self, budget_bytes, distance_weight=1.0):
+        self.budget_bytes = budget_bytes
+        # Relative weight of the distance from the cursor vs. the LRU age of a volume
+        self.distance_weight = distance_weight
+        # filename -> RadarVolume, least recently used first
+        self.volumes = OrderedDict()
+        self.last_used = {}
+        self.clock = itertools.count()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, filename):
+        return filename in self.volumes
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def get(self, filename):
+        """Look up a volume, counting a hit or miss and marking it as recently used."""
+        r_volume = self.volumes.get(filename)
+        if r_volume is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(filename)
+        return r_volume
+
+    def peek(self, filename):
+        """Look up a volume without affecting the statistics or the LRU order."""
+        return self.volumes.get(filename)
+
+    def put(self, filename, r_volume: RadarVolume):
+        self.volumes[filename] = r_volume
+        self._touch(filename)
+
+    def remove(self, filename):
+        self.volumes.pop(filename, None)
+        self.last_used.pop(filename, None)
+
+    def values(self):
+        return list(self.volumes.values())
+
+    def total_bytes(self) -> int:
+        return sum(r_volume.nbytes for r_volume in self.volumes.values())
+
+    def evict(self, distance_fn, pinned=()):
+        """
+        Evict volumes until the cache fits its budget. `distance_fn(filename)` returns the
+        distance of a volume from the cursor (in files). Returns the evicted (filename, volume)
+        pairs, e.g. to move them to a slower tier.
+        """
+        sizes = {filename: r_volume.nbytes for (filename, r_volume) in self.volumes.items()}
+        total = sum(sizes.values())
+        if total <= self.budget_bytes:
+            return []
+
+        candidates = [filename for filename in self.volumes if filename not in pinned]
+        if not candidates:
+            return []
+
+        # Age in accesses since the volume was last used, relative to the oldest volume, and the
+        # distance from the cursor relative to the farthest volume. Both end up in [0, 1].
+        now = next(self.clock)
+        ages = np.array([now - self.last_used[filename] for filename in candidates], dtype=np.float64)
+        distances = np.array([distance_fn(filename) for filename in candidates], dtype=np.float64)
+        scores = ages / max(ages.max(), 1.0) + self.distance_weight * distances / max(distances.max(), 1.0)
+
+        evicted = []
+        for i in np.argsort(-scores, kind='stable'):
+            if total <= self.budget_bytes:
+                break
+            filename = candidates[i]
+            total -= sizes[filename]
+            evicted.append((filename, self.volumes[filename]))
+            self.remove(filename)
+            self.evictions += 1
+        return evicted
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'volumes': len(self.volumes),
+            'bytes': self.total_bytes(),
+            'budget_bytes': self.budget_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def _touch(self, filename):
+        self.volumes.move_to_end(filename)
+        self.last_used[filename] = next(self.clock)
@@ -0,0 +1,129 @@
+import numpy as np
+from vispy.visuals.transforms import STTransform, PolarTransform
+
+class SliceGeometry(object):
+    """
+    Everything that determines where the pixels of a slice image end up in a plot:
+    the shape of the slice and the extents it is drawn with. Slices with an equal
+    geometry share the same polar transform chain, so a plot only has to build a
+    new transform when the geometry changes, not when just the data does.
+
+    A slice image has one column per angle (azimuth for PPI, elevation for RHI)
+    and one row per range gate, starting `y_start` gates away from the radar.
+    """
+    def __init__(self, slice_type, num_angles, num_ranges, radial_swath, loc0, y_start, km_per_pixel):
+        self.slice_type = slice_type
+        self.num_angles = int(num_angles)
+        self.num_ranges = int(num_ranges)
+        # Angular extent of the slice (radians)
+        self.radial_swath = float(radial_swath)
+        # Location of the first column (radians, clockwise from 0)
+        self.loc0 = float(loc0)
+        # Number of range gates between the radar and the first range gate
+        self.y_start = float(y_start)
+        # Scale from pixel space into kilometers
+        self.km_per_pixel = float(km_per_pixel)
+
+    @staticmethod
+    def from_volume(volume, slice_type):
+        """The geometry of the PPI or RHI slices of a RadarVolume."""
+        # Because we transform into polar coordinates
+        # Width of the camera is range_start_km * 1000 / doppler_resolution + len(ranges)
+        y_start = np.floor(volume.start_range_km / volume.doppler_resolution_km)
+        km_per_pixel = volume.ranges_km[-1] / (y_start + len(volume.ranges_km))
+        if slice_type == 'rhi':
+            return SliceGeometry(slice_type, len(volume.elevations_rad), len(volume.ranges_km),
+                                 volume.elevation_swath_rad, volume.elevations_rad[0], y_start, km_per_pixel)
+        return SliceGeometry(slice_type, len(volume.azimuths_rad), len(volume.ranges_km),
+                             volume.azimuth_swath_rad, volume.azimuth_swath_rad, y_start, km_per_pixel)
+
+    @property
+    def key(self) -> tuple:
+        return (self.slice_type, self.num_angles, self.num_ranges, self.radial_swath, self.loc0, self.y_start, self.km_per_pixel)
+
+    @property
+    def direction(self) -> int:
+        """Direction of increasing column index, -1 clockwise (PPI azimuths), 1 counter-clockwise (RHI elevations)."""
+        return -1 if self.slice_type == 'ppi' else 1
+
+    def __eq__(self, other):
+        return isinstance(other, SliceGeometry) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def range_edges_km(self) -> np.ndarray:
+        """Distances of the boundaries between the range gates (rows) of a slice image from the radar, in kilometers."""
+        return (self.y_start + np.arange(self.num_ranges + 1)) * self.km_per_pixel
+
+    def angle_edges_rad(self) -> np.ndarray:
+        """Angles of the boundaries between the columns of a slice image, swept from the edge of the first column."""
+        return np.arange(self.num_angles + 1) * (self.radial_swath / self.num_angles)
+
+    def polar_coordinates(self, x_km, y_km):
+        """
+        The (swept angle, range) of points in kilometers, the closed form inverse of build_transform().
+        The swept angle (radians) is measured from the edge of the first column in the direction of
+        increasing columns, wrapped into [0, 2pi), the range in kilometers from the radar.
+        """
+        range_km = np.hypot(x_km, y_km)
+        theta = np.arctan2(y_km, x_km)
+        theta0 = self.radial_swath * self.loc0
+        swept_rad = np.mod(self.direction * (theta - theta0), 2.0 * np.pi)
+        return (swept_rad, range_km)
+
+    def gate_indices(self, x_km, y_km):
+        """
+        The (angle, range gate) indices of the slice image pixels which points in kilometers fall into,
+        -1 where a point isn't covered by the slice. Vectorized, exact at any zoom level.
+        """
+        (swept_rad, range_km) = self.polar_coordinates(x_km, y_km)
+        angle_idx = np.searchsorted(self.angle_edges_rad(), swept_rad, side='right') - 1
+        range_idx = np.searchsorted(self.range_edges_km(), range_km, side='right') - 1
+        inside = (angle_idx >= 0) & (angle_idx < self.num_angles) & (range_idx >= 0) & (range_idx < self.num_ranges)
+        return (np.where(inside, angle_idx, -1), np.where(inside, range_idx, -1))
+
+    def build_transform(self):
+        """
+        Build the chain of transforms which maps a slice image in pixel space (angle x range)
+        into polar coordinates in kilometers.
+        """
+        # Complicated method for transforming an image in cartesian coordinates into polar coordinates
+        # Credit: https://stackoverflow.com/a/68390497/13542651
+        width = self.num_angles
+        height = self.num_ranges
+        scx = self.km_per_pixel
+        scy = self.km_per_pixel
+        xoff = 0
+        yoff = 0
+
+        ori0 = 0 # Side of the image to collapse at origin (0 for top/1 for bottom)
+
+        return (
+            STTransform(scale=(scx, scy), translate=(xoff, yoff))
+
+            *PolarTransform()
+
+            # 1
+            # pre scale image to work with polar transform
+            # PolarTransform does not work without this
+            # scale vertex coordinates to 2*pi
+            *STTransform(scale=(self.radial_swath / width, 1.0))
+
+            # 2
+            # origin switch via translate.y, fix translate.x
+            *STTransform(translate=(width * (ori0 % 2) * 0.5,
+                                    -height * (ori0 % 2)))
+
+            # 3
+            # location change via translate.x
+            *STTransform(translate=(width * (self.loc0), 0.0))
+
+            # 4
+            # direction switch via inverting scale.x
+            *STTransform(scale=(self.direction, 1.0))
+
+            # 5
+            # Shift the image up for the receive start (start_range_km * 1000 / doppler_resolution)
+            *STTransform(translate=(0, self.y_start))
+        )
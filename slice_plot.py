@@ -9,18 +9,38 @@ from vispy.visuals import TextVisual
 from vispy.scene.visuals import Image
 from vispy.plot import Fig, PlotWidget
 from vispy.color import Colormap
-from vispy.visuals.transforms import STTransform, PolarTransform
 from PySide6.QtWidgets import QApplication, QMainWindow, QVBoxLayout, QHBoxLayout, QWidget, QDockWidget, QMenu, QToolTip
-from PySide6.QtCore import Qt, Slot, QObject, Signal, QPoint
+from PySide6.QtCore import Qt, Slot, QObject, Signal, QPoint, QTimer
 from PySide6.QtGui import QAction, QActionGroup, QPaintEvent
 from color_maps import ColorMaps
 from radar_volume import RadarVolume
+from slice_geometry import SliceGeometry
+from polar_resampler import PolarResampler
+from slice_pyramid import SlicePyramid
+from gate_picker import GatePicker
+from redraw_scheduler import RedrawScheduler
+from texture_cache import TextureCache, ResidentImage
+from vispy.visuals.transforms import STTransform
+from collections import deque
 from dynamic_dock_widget import DynamicDockWidget
 
 class SlicePlot(QObject):
     cmaps = ColorMaps('D:/cs5093/20240428/MATLAB Display Code/colormaps.mat')
 
-    def __init__(self, id, parent=None, slice_type='ppi'):
+    # How slices are drawn in polar space:
+    #   'subdivide' - the slice texture is bent into polar space by a subdivided mesh on the GPU
+    #   'resample'  - the slice is resampled onto a Cartesian raster on the CPU (see PolarResampler)
+    RENDER_MODES = ('subdivide', 'resample')
+    # The resampling raster follows the size of the view in steps of this many pixels
+    RASTER_STEP = 64
+
+    # Signal emitted when the product displayed by this plot is switched
+    product_display_changed = Signal(str)
+
+    # Once a plot has been idle this long, the textures it is likely to show next are uploaded
+    WARM_TEXTURES_DELAY_MS = 150
+
+    def __init__(self, id, parent=None, slice_type='ppi', texture_budget_bytes=256 * 1024**2):
         super().__init__(parent=parent)
         
         # Set this plot's id (used for window/dock-tab title)
@@ -33,8 +53,6 @@ class SlicePlot(QObject):
         self.current_az = 0
         self.current_el = 0
 
-        self.throttle = time.monotonic()
-
         # Group the product switching actions together to ensure mutual exclusivity
         # https://www.weather.gov/jan/dualpolupgrade-products
         self.action_group = QActionGroup(self)
@@ -61,6 +79,22 @@ class SlicePlot(QObject):
         self.action_group.addAction(self.width_mode_action)
         self.action_group.addAction(self.zdr_mode_action)
 
+        # Rendering mode actions, also mutually exclusive
+        self.render_mode = 'subdivide'
+        self.render_mode_group = QActionGroup(self)
+        self.subdivide_mode_action = QAction("Polar Mesh (GPU)", self, checkable=True)
+        self.resample_mode_action = QAction("Cartesian Resampling (CPU)", self, checkable=True)
+        self.subdivide_mode_action.triggered.connect(lambda: self.set_render_mode('subdivide'))
+        self.resample_mode_action.triggered.connect(lambda: self.set_render_mode('resample'))
+        self.render_mode_group.addAction(self.subdivide_mode_action)
+        self.render_mode_group.addAction(self.resample_mode_action)
+        self.subdivide_mode_action.setChecked(True)
+
+        # Recent update_plot and draw times (seconds), to compare the rendering modes
+        self.update_times = deque(maxlen=200)
+        self.draw_times = deque(maxlen=200)
+        self.draw_started = None
+
         # Show reflectivity by default
         self.reflectivity_mode_action.setChecked(True)
         self.product_to_display = 'Z'
@@ -95,6 +129,11 @@ class SlicePlot(QObject):
         # Intercept mouse movement to display tooltip of data
         self.canvas.events.mouse_move.connect(self.on_mouse_move)
         self.canvas.native.setContextMenuPolicy(Qt.CustomContextMenu)
+        # Time every frame, from the start of the draw event until the buffers are swapped
+        self.canvas.events.draw.connect(self.on_draw_started, position='first')
+        self.canvas.events.draw.connect(self.on_draw_finished, position='last')
+        # The resampling raster follows the size of the view
+        self.canvas.events.resize.connect(self.on_canvas_resized)
         self.grid = self.canvas.central_widget.add_grid(spacing=1.0, margin=10.0)
         
         # Cell (0,0) - Title
@@ -119,7 +158,12 @@ class SlicePlot(QObject):
         # Cell (1,1) - View
         self.view = self.grid.add_view(row=1, col=1, camera='panzoom')
         self.view.camera.set_range((-5, 15), (-5, 15))
-        self.image = Image(np.zeros((10, 10), dtype=np.float32), parent=self.view.scene, cmap=self.cmap, clim=self.clim, grid=(360, 360), method='subdivide', interpolation='nearest')
+        # FIXME: make locking the aspect ratio a setting?
+        # Enforce the aspect ratio to be 1
+        self.view.camera.aspect = 1
+        # GPU-scaled (float) textures let contiguous float32 slices be uploaded as they are,
+        # instead of VisPy copying and rescaling every slice to the color limits on the CPU
+        self.image = ResidentImage(np.zeros((10, 10), dtype=np.float32), parent=self.view.scene, cmap=self.cmap, clim=self.clim, grid=(360, 360), method='subdivide', interpolation='nearest', texture_format='auto')
 
         # Cell (1,2) - Color Bar
         self.color_bar = ColorBarWidget(
@@ -151,16 +195,48 @@ class SlicePlot(QObject):
         self.x_axis.height_max = 160.0
         self.grid.add_widget(self.x_axis, row=2, col=1)
 
+        # Maps the cursor to the gates under it, for the tooltips
+        self.picker = GatePicker(self.view)
+
         self.y_axis.link_view(self.view)
         self.x_axis.link_view(self.view)
 
+        # Geometry of the scan the camera range was last laid out for
+        self.scan_geometry = None
+
+        # Geometry of the slices of the current volume, and the key (render mode and geometry, or
+        # resampling raster) the image transform was set up for. Building a transform chain (and the
+        # shader code that comes with it) is only worth it when the key changes, so the transforms
+        # of the geometries seen so far are kept around.
+        self.volume = None
+        # The volume the data manager expects to be shown next (see Data_Manager.next_volume_ready)
+        self.next_volume = None
+        self.slice_geometry = None
+        self.transform_key = None
+        self.transform_cache = {}
+        # Level of detail of the slice pyramid on screen (see SlicePyramid)
+        self.lod_level = 0
+        self.view.scene.transform.changed.connect(self.on_camera_changed)
+
+        # Slice textures kept on the GPU: the slices on screen, the same slices of the other products
+        # and of the next volume, and whatever was shown recently. Switching products or stepping to
+        # the next volume then only swaps textures and sets the color limits.
+        self.texture_cache = TextureCache(self.canvas.context.glir, texture_budget_bytes)
+        self.warm_timer = QTimer(self)
+        self.warm_timer.setSingleShot(True)
+        self.warm_timer.setInterval(SlicePlot.WARM_TEXTURES_DELAY_MS)
+        self.warm_timer.timeout.connect(self.warm_textures)
+
         # self.update_plot()
 
     def set_plot_title(self):
         if self.slice_type == 'rhi':
-            self.title.text = f'RHI ({self.product_to_display}) - AZ {self.azimuths_rad[self.current_az] * 180.0 / np.pi:.2f}°'
+            text = f'RHI ({self.product_to_display}) - AZ {self.azimuths_rad[self.current_az] * 180.0 / np.pi:.2f}°'
         else:
-            self.title.text = f'PPI ({self.product_to_display}) - EL (Tilt) {self.elevations_rad[self.current_el] * 180.0 / np.pi:.2f}°'
+            text = f'PPI ({self.product_to_display}) - EL (Tilt) {self.elevations_rad[self.current_el] * 180.0 / np.pi:.2f}°'
+        # Changing the text lays the label out again
+        if self.title.text != text:
+            self.title.text = text
 
     def set_product_display(self, product):
         self.product_to_display = product
@@ -184,7 +260,9 @@ class SlicePlot(QObject):
         # Image color setup (depends on displayed product)
         self.image.cmap = self.cmap
         self.image.clim = self.clim
-        self.update_plot()
+        self.request_redraw()
+
+        self.product_display_changed.emit(product)
 
     def get_product_display(self):
         return self.product_to_display
@@ -198,39 +276,17 @@ class SlicePlot(QObject):
     
     def on_mouse_move(self, event):
         """Handle mouse move events."""
-        # throttle mouse events to 50ms
-        if time.monotonic() - self.throttle < 0.05:
-            return
-        self.throttle = time.monotonic()
-
-        if event.pos is None:
+        if event.pos is None or self.volume is None:
             # Ignore invalid positions
             return
-        
-        # Calculate the inverse transform from local screen coords to image pixel space.
-        # Each pixel corresponds to a pair of indices sampling the data.
-        transform = self.image.transforms.get_transform(map_to="canvas")
-        canvas_pos = transform.imap(event.pos)
-
-        # FIXME: This is a hack to fix the transform to correctly index the input data.
-        # I have no idea why this is necessary, but I was luck to notice that the inverse transform was correct in terms of shape, but there is some x-offset that is not accounted for.
-        corrected_pos = np.floor(np.array([
-            44 - (canvas_pos[0] + 21.5) if self.slice_type == 'ppi' else 20 - (canvas_pos[0] - 42.6),
-            canvas_pos[1]]))
 
-        x = int(corrected_pos[0])
-        y = int(corrected_pos[1])
+        # The scene is in kilometers in every render mode, find the gate under the cursor in closed form
+        (angle_idx, range_idx) = self.picker.pick(self.slice_geometry, event.pos[:2])
+        x = int(angle_idx)
+        y = int(range_idx)
 
-        # Debug print
-        # print(f"Uncorrected coords: ({canvas_pos[0]:.2f}, {canvas_pos[1]:.2f})\tCorrected coords: ({x}, {y})")
-
-        prod = self.products[self.product_to_display]
-        if self.slice_type == 'rhi':
-            # RHI: elevation x range
-            slice = prod[:, self.current_az, :].T
-        else:
-            # PPI: azimuth x range.
-            slice = prod[self.current_el, :, :].T
+        # range x angle
+        slice = self.get_slice()
 
         # Check if coordinates are within the image bounds
         if 0 <= x < slice.shape[1] and 0 <= y < slice.shape[0]:
@@ -268,6 +324,19 @@ Height: {self.ranges_km[y] * np.sin(self.elevations_rad[x] if self.slice_type ==
         context_menu.addAction(self.width_mode_action)
         context_menu.addAction(self.zdr_mode_action)
 
+        render_mode_label = QAction(f"Render mode: {self.frame_time_summary()}", self)
+        render_mode_label.setEnabled(False)
+        context_menu.addSeparator()
+        context_menu.addAction(render_mode_label)
+        context_menu.addAction(self.subdivide_mode_action)
+        context_menu.addAction(self.resample_mode_action)
+
+        texture_stats = self.texture_cache.stats()
+        texture_label = QAction(f"Textures: {texture_stats['textures']} resident, {texture_stats['bytes'] / 1024**2:.0f}/"
+                                f"{texture_stats['budget_bytes'] / 1024**2:.0f} MB, hit rate {texture_stats['hit_rate'] * 100:.0f}%", self)
+        texture_label.setEnabled(False)
+        context_menu.addAction(texture_label)
+
         # Show it
         context_menu.exec(pos)
 
@@ -276,93 +345,192 @@ Height: {self.ranges_km[y] * np.sin(self.elevations_rad[x] if self.slice_type ==
         self.azimuths_rad = volume.azimuths_rad
         self.elevations_rad = volume.elevations_rad
         self.ranges_km = volume.ranges_km
-        self.products = volume.products
+        self.volume = volume
+        if volume is self.next_volume:
+            self.next_volume = None
+        self.slice_geometry = SliceGeometry.from_volume(volume, self.slice_type)
+
+        self.request_redraw()
+
+    @Slot(object)
+    def on_scan_geometry_changed(self, metadata):
+        """
+        Lay out the camera range from the scan metadata (see VolumeMetadata), before any
+        volume has been loaded. The range is only reset when the geometry actually changes
+        so that zooming and panning survive switching between volumes and scans.
+        """
+        if metadata is None or metadata.geometry() == self.scan_geometry:
+            return
+        self.scan_geometry = metadata.geometry()
 
-        # Because we transform into polar coordinates
-        # Width of the camera is range_start_km * 1000 / doppler_resolution + len(ranges)
-        self.y_start = np.floor(volume.start_range_km / volume.doppler_resolution_km) 
-        
-        # Calculate the radial extents of the slice
+        max_range_km = metadata.max_range_km
         if self.slice_type == 'rhi':
-            self.radial_swath = volume.elevation_swath_rad
+            self.view.camera.set_range((0, max_range_km), (0, max_range_km))
         else:
-            self.radial_swath = volume.azimuth_swath_rad
-
-        self.update_plot()
+            self.view.camera.set_range((-max_range_km, max_range_km), (-max_range_km, max_range_km))
 
     @Slot(int, int)
     def on_az_el_index_selection_changed(self, el_idx, az_idx):
         self.current_az = az_idx
         self.current_el = el_idx
-        self.update_plot()
+        self.request_redraw()
         
     @Slot(int, int)
     def on_az_el_slice_hovered(self, el_idx, az_idx):
         self.current_az = az_idx
         self.current_el = el_idx
-        self.update_plot()
+        self.request_redraw()
+
+    def get_transform(self, geometry: SliceGeometry):
+        """The polar transform chain for a slice geometry, built the first time the geometry is seen."""
+        transform = self.transform_cache.get(geometry)
+        if transform is None:
+            if len(self.transform_cache) >= 16:
+                # Scans rarely change geometry, don't hang on to a long history
+                self.transform_cache.clear()
+            transform = geometry.build_transform()
+            self.transform_cache[geometry] = transform
+        return transform
+
+    def set_render_mode(self, mode):
+        if mode == self.render_mode:
+            return
+        print(f'SlicePlot {self.id}: {self.frame_time_summary()}, switching to {mode}')
+        self.render_mode = mode
+        self.update_times.clear()
+        self.draw_times.clear()
+        # 'impostor' draws the resampled raster as a single quad, its transform is linear
+        self.image.method = 'subdivide' if mode == 'subdivide' else 'impostor'
+        self.transform_key = None
+        if self.slice_geometry is not None:
+            self.request_redraw()
+
+    def raster_size(self):
+        """Size of the resampling raster: the size of the view, rounded up to RASTER_STEP pixels."""
+        (width, height) = self.view.size
+        step = SlicePlot.RASTER_STEP
+        return (max(step, int(np.ceil(width / step)) * step), max(step, int(np.ceil(height / step)) * step))
+
+    def frame_time_summary(self) -> str:
+        """Median update_plot and draw times of the current render mode."""
+        update_ms = np.median(self.update_times) * 1000 if self.update_times else np.nan
+        draw_ms = np.median(self.draw_times) * 1000 if self.draw_times else np.nan
+        lod = f' LOD {self.lod_level}' if self.render_mode == 'subdivide' else ''
+        return f'{self.render_mode}{lod} (update {update_ms:.1f} ms, draw {draw_ms:.1f} ms)'
+
+    def on_draw_started(self, event):
+        self.draw_started = time.perf_counter()
+
+    def on_draw_finished(self, event):
+        if self.draw_started is not None:
+            self.draw_times.append(time.perf_counter() - self.draw_started)
+            self.draw_started = None
+
+    def on_canvas_resized(self, event):
+        if self.render_mode == 'resample' and self.slice_geometry is not None:
+            self.request_redraw()
+
+    def get_slice(self, volume=None, product=None, level=0):
+        """
+        The current slice of a product (by default the displayed one), as a contiguous (range x angle)
+        array, at a level of detail of the slice pyramid (see SlicePyramid).
+        """
+        volume = volume if volume is not None else self.volume
+        product = product if product is not None else self.product_to_display
+        if level > 0:
+            pyramid = SlicePyramid.get(SliceGeometry.from_volume(volume, self.slice_type))
+            return volume.slice_level(product, self.slice_type, self.slice_index(), pyramid, level)
+        if self.slice_type == 'rhi':
+            # RHI: range x elevation
+            return volume.rhi_slice(product, self.current_az)
+        # PPI: range x azimuth
+        return volume.ppi_slice(product, self.current_el)
+
+    def slice_index(self):
+        return self.current_az if self.slice_type == 'rhi' else self.current_el
+
+    def slice_key(self, volume, product, level=0):
+        """Key of the current slice of a product of a volume in the texture cache."""
+        return (volume.filename, product, self.slice_type, self.slice_index(), level)
+
+    def choose_lod_level(self) -> int:
+        """The level of detail of the slice pyramid which matches the zoom of the camera."""
+        pyramid = SlicePyramid.get(self.slice_geometry)
+        rect = self.view.camera.rect
+        (width, height) = self.view.size
+        # Kilometers per physical screen pixel
+        km_per_screen_pixel = max(rect.width / max(width, 1), rect.height / max(height, 1)) / self.canvas.pixel_scale
+        return pyramid.choose_level(km_per_screen_pixel)
+
+    def on_camera_changed(self, event):
+        # Zooming or resizing may call for another level of detail
+        if self.render_mode == 'subdivide' and self.slice_geometry is not None and self.choose_lod_level() != self.lod_level:
+            self.request_redraw()
+
+    @Slot(RadarVolume)
+    def on_next_volume_ready(self, volume: RadarVolume):
+        self.next_volume = volume
+        if not self.warm_timer.isActive():
+            self.warm_timer.start()
+
+    @Slot()
+    def warm_textures(self):
+        """Upload the current slice of the other built products, and of the next volume, ahead of time."""
+        if self.volume is None or self.render_mode != 'subdivide' or not self.image.resident_textures:
+            return
+        for volume in (self.volume, self.next_volume):
+            if volume is None:
+                continue
+            # Products which aren't built aren't viewed anywhere, except the one this plot displays
+            for product in dict.fromkeys([self.product_to_display] + volume.products.loaded()):
+                key = self.slice_key(volume, product, self.lod_level)
+                if key not in self.texture_cache:
+                    self.texture_cache.put(key, self.get_slice(volume, product, self.lod_level), self.clim)
+
+    def request_redraw(self):
+        """Redraw the plot at the next display frame, however often its state changes until then."""
+        RedrawScheduler.instance().mark_dirty(self)
+
+    def redraw(self):
+        if self.volume is not None:
+            self.update_plot()
 
     def update_plot(self):
+        start = time.perf_counter()
         
-        prod = self.products[self.product_to_display]
-        if self.slice_type == 'rhi':
-            # RHI: elevation x range
-            slice = prod[:, self.current_az, :].T
-        else:
-            # PPI: azimuth x range.
-            slice = prod[self.current_el, :, :].T
-
         # Update the plot title
         self.set_plot_title()
 
-        # FIXME: make locking the aspect ratio a setting?
-        # Enforce the aspect ratio to be 1
-        self.view.camera.aspect = 1
-        
-        self.image.set_data(slice)
-
-        # Complicated method for transforming an image in cartesian coordinates into polar coordinates
-        # Credit: https://stackoverflow.com/a/68390497/13542651
-
-        # Compute the scaling factor to convert from pixel space into kilometers
-        km_per_pixel = self.ranges_km[-1] / (self.y_start + len(self.ranges_km))
-        scx = km_per_pixel
-        scy = km_per_pixel
-        xoff = 0
-        yoff = 0
-
-        ori0 = 0 # Side of the image to collapse at origin (0 for top/1 for bottom)
-        loc0 = self.radial_swath if self.slice_type == 'ppi' else self.elevations_rad[0] # Location of zero (0, 2* np.pi) clockwise
-        dir0 = 1 # Direction cw/ccw -1, 1
-
-        transform = (
-            STTransform(scale=(scx, scy), translate=(xoff, yoff))
-
-            *PolarTransform()
-
-            # 1
-            # pre scale image to work with polar transform
-            # PolarTransform does not work without this
-            # scale vertex coordinates to 2*pi
-            *STTransform(scale=(self.radial_swath / self.image.size[0], 1.0))
-
-            # 2
-            # origin switch via translate.y, fix translate.x
-            *STTransform(translate=(self.image.size[0] * (ori0 % 2) * 0.5,                                                                   
-                                    -self.image.size[1] * (ori0 % 2)))
-
-            # 3
-            # location change via translate.x
-            *STTransform(translate=(self.image.size[0] * (loc0), 0.0))
-
-            # 4
-            # direction switch via inverting scale.x
-            *STTransform(scale=(-dir0 if self.slice_type == 'ppi' else dir0, 1.0))
-
-            # 5
-            # Shift the image up for the receive start (start_range_km * 1000 / doppler_resolution)
-            *STTransform(translate=(0, self.y_start))
-        )
-        self.image.transform = transform
+        if self.render_mode == 'resample':
+            # The resampled raster is already in kilometers, it only has to be scaled and moved into place
+            resampler = PolarResampler.get(self.slice_geometry, *self.raster_size())
+            self.image.set_data(resampler.resample(self.get_slice().T))
+            key = ('resample', resampler)
+            if key != self.transform_key:
+                self.image.transform = STTransform(scale=(resampler.km_per_pixel, resampler.km_per_pixel), translate=resampler.origin_km)
+                self.transform_key = key
+        else:
+            # Zoomed out views get a reduced slice, with at most about one range gate per screen pixel
+            self.lod_level = self.choose_lod_level()
+            geometry = SlicePyramid.get(self.slice_geometry).geometries[self.lod_level]
+
+            if self.image.resident_textures:
+                # Swap in the slice's texture, uploading it (without any further copies) if it isn't resident
+                key = self.slice_key(self.volume, self.product_to_display, self.lod_level)
+                self.texture_cache.pin([key])
+                resident = self.texture_cache.get(key)
+                if resident is None:
+                    resident = self.texture_cache.put(key, self.get_slice(level=self.lod_level), self.clim)
+                self.image.show_texture(*resident)
+                self.warm_timer.start()
+            else:
+                self.image.set_data(self.get_slice(level=self.lod_level))
+
+            # Only the texture has to be updated, unless the geometry of the (reduced) slice changed
+            key = ('subdivide', geometry)
+            if key != self.transform_key:
+                self.image.transform = self.get_transform(geometry)
+                self.transform_key = key
 
         self.grid.update()
+        self.update_times.append(time.perf_counter() - start)
@@ -0,0 +1,118 @@
+import math
+import numpy as np
+from collections import OrderedDict
+from slice_geometry import SliceGeometry
+
+class SlicePyramid(object):
+    """
+    Levels of detail for the slices of one geometry (see SliceGeometry). Level 0 is the
+    slice itself, every further level halves the number of range gates and, once the
+    cells are much longer along the range than across it, the number of angles too. A
+    plot uploads the coarsest level whose range gates are still no longer than a screen
+    pixel, so zoomed out views upload a fraction of a slice, while zoomed in views get
+    the exact gates.
+
+    The reductions are vectorized over blocks of gates, and depend on the product (see
+    REDUCTIONS): only continuous fields are averaged, folded or wrapped ones keep one of
+    the gates of a block. Missing gates (NaN) are ignored, a block without any valid gate
+    stays NaN.
+    """
+    # (geometry) -> SlicePyramid, most recently used last
+    cache = OrderedDict()
+    CACHE_SIZE = 8
+    # How a block of gates is reduced, per product:
+    #   'max'      - reflectivity keeps the maximum, so that cores don't fade when zooming out
+    #   'max_abs'  - velocity keeps the gate of the largest magnitude. Averaging across an aliasing
+    #                (folding) boundary or a couplet makes up velocities which were never measured.
+    #   'decimate' - differential phase wraps around, it keeps the first valid gate of the block
+    #   'mean'     - continuous fields (spectrum width, ZDR, RhoHV, ...), the default
+    REDUCTIONS = {'Z': 'max', 'V': 'max_abs', 'P': 'decimate'}
+    # Levels stop once a slice is down to this many range gates
+    MIN_RANGES = 64
+    MAX_LEVELS = 8
+
+    def __init__(self, geometry: SliceGeometry):
+        self.geometry = geometry
+        # (range factor, angle factor) of every level, and the geometry each level is drawn with
+        self.factors = [(1, 1)]
+        self.geometries = [geometry]
+        # Distance across the slice at mid-range between two angles (km), for deciding when to reduce angles
+        mid_range_km = (geometry.y_start + geometry.num_ranges / 2) * geometry.km_per_pixel
+        angle_step_km = mid_range_km * geometry.radial_swath / geometry.num_angles
+        (range_factor, angle_factor) = (1, 1)
+        while len(self.factors) < SlicePyramid.MAX_LEVELS and geometry.num_ranges // (2 * range_factor) >= SlicePyramid.MIN_RANGES:
+            range_factor *= 2
+            # Keep the cells from becoming much longer across the slice than along the range
+            if geometry.num_angles // (2 * angle_factor) >= 2 and 2 * angle_factor * angle_step_km <= range_factor * geometry.km_per_pixel:
+                angle_factor *= 2
+            self.factors.append((range_factor, angle_factor))
+            self.geometries.append(SlicePyramid.decimated_geometry(geometry, range_factor, angle_factor))
+
+    @staticmethod
+    def get(geometry: SliceGeometry):
+        """The pyramid of a geometry, built the first time it is needed."""
+        pyramid = SlicePyramid.cache.get(geometry)
+        if pyramid is None:
+            pyramid = SlicePyramid(geometry)
+            SlicePyramid.cache[geometry] = pyramid
+            while len(SlicePyramid.cache) > SlicePyramid.CACHE_SIZE:
+                SlicePyramid.cache.popitem(last=False)
+        SlicePyramid.cache.move_to_end(geometry)
+        return pyramid
+
+    @staticmethod
+    def decimated_geometry(geometry: SliceGeometry, range_factor, angle_factor):
+        """The geometry of a slice reduced in blocks of (range_factor x angle_factor) gates, padded to whole blocks."""
+        num_ranges = math.ceil(geometry.num_ranges / range_factor)
+        num_angles = math.ceil(geometry.num_angles / angle_factor)
+        # Padding columns widen the swath by the same angle per column
+        radial_swath = geometry.radial_swath * num_angles * angle_factor / geometry.num_angles
+        # loc0 positions the first column in units of the swath
+        loc0 = geometry.loc0 * geometry.radial_swath / radial_swath if radial_swath > 0 else geometry.loc0
+        return SliceGeometry(geometry.slice_type, num_angles, num_ranges, radial_swath, loc0,
+                             geometry.y_start / range_factor, geometry.km_per_pixel * range_factor)
+
+    @property
+    def num_levels(self) -> int:
+        return len(self.factors)
+
+    def choose_level(self, km_per_screen_pixel) -> int:
+        """The coarsest level whose range gates are no longer than a screen pixel."""
+        level = 0
+        for (i, geometry) in enumerate(self.geometries):
+            if geometry.km_per_pixel <= km_per_screen_pixel:
+                level = i
+        return level
+
+    def reduce(self, slice_data: np.ndarray, level, product) -> np.ndarray:
+        """Reduce a (range x angle) slice of this pyramid's geometry to a level, as a contiguous float32 array."""
+        (range_factor, angle_factor) = self.factors[level]
+        if (range_factor, angle_factor) == (1, 1):
+            return np.ascontiguousarray(slice_data, dtype=np.float32)
+
+        geometry = self.geometries[level]
+        (num_ranges, num_angles) = slice_data.shape
+        padded = np.full((geometry.num_ranges * range_factor, geometry.num_angles * angle_factor), np.nan, dtype=np.float32)
+        padded[:num_ranges, :num_angles] = slice_data
+        blocks = padded.reshape(geometry.num_ranges, range_factor, geometry.num_angles, angle_factor)
+
+        reduction = SlicePyramid.REDUCTIONS.get(product, 'mean')
+        if reduction == 'max':
+            # fmax ignores NaN unless a whole block is NaN
+            return np.ascontiguousarray(np.fmax.reduce(np.fmax.reduce(blocks, axis=3), axis=1))
+        valid = ~np.isnan(blocks)
+        if reduction == 'mean':
+            total = np.where(valid, blocks, 0.0).sum(axis=(1, 3))
+            count = valid.sum(axis=(1, 3))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                return np.ascontiguousarray((total / count).astype(np.float32))
+
+        # Keep one gate of each block: (ranges x angles x gates of the block)
+        gates = blocks.transpose(0, 2, 1, 3).reshape(geometry.num_ranges, geometry.num_angles, range_factor * angle_factor)
+        valid = valid.transpose(0, 2, 1, 3).reshape(gates.shape)
+        if reduction == 'max_abs':
+            chosen = np.argmax(np.where(valid, np.abs(gates), -1.0), axis=2)
+        else:
+            # argmax finds the first valid gate, or picks a NaN gate if there is none
+            chosen = np.argmax(valid, axis=2)
+        return np.ascontiguousarray(np.take_along_axis(gates, chosen[:, :, np.newaxis], axis=2)[:, :, 0])
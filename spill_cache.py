@@ -0,0 +1,253 @@
+import os
+import json
+import time
+import hashlib
+import zipfile
+import threading
+import weakref
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+from functools import partial
+from radar_volume import RadarVolume, LazyProducts
+from volume_file_cache import VolumeFileCache
+
+# Spill layout, in a local directory (by default in the user's home, not next to the scan):
+#
+# <spill dir>/
+#   HRUS_240428_020051000_100-3f2a9c0d1b7e4a65.npz
+#   ...
+#
+# Each entry is a zip archive of .npy members (readable with np.load): one member per
+# product cube plus a small JSON header holding the source key and the volume metadata.
+# The suffix is a hash of the absolute source path, so files with the same name in
+# different scans don't collide.
+
+class SpillCache(object):
+    """
+    Second tier behind the in-memory volume cache. Volumes evicted from memory are
+    compressed into a local spill directory and restored from there when they are
+    needed again, which is much cheaper than parsing the .mat file.
+
+    Only volumes without an up-to-date volume file cache entry need to be spilled, e.g.
+    when the scan directory is read-only. The tier has its own size cap and evicts the
+    least recently used entries first. Entries are written atomically, so a crash never
+    leaves a half-written entry behind. Safe to use from several threads.
+
+    Restored volumes read their products from the entry when they are first accessed
+    (and again after they were dropped), so an entry is never deleted while a volume
+    restored from it is alive: eviction skips it, and removing it is deferred.
+    """
+    DEFAULT_DIR = Path.home() / '.cache' / 'pardataviz' / 'spill'
+    HEADER_KEY = '__header__'
+    # zlib level 1: most of the size reduction of the higher levels at a fraction of the CPU cost
+    COMPRESS_LEVEL = 1
+    # Temporary files older than this are left over from a crashed process
+    STALE_TMP_AGE_S = 3600
+
+    def __init__(self, spill_dir=None, budget_bytes=8 * 1024**3):
+        self.spill_dir = Path(spill_dir) if spill_dir is not None else SpillCache.DEFAULT_DIR
+        self.budget_bytes = budget_bytes
+        self.lock = threading.Lock()
+        # entry name -> size on disk, least recently used first
+        self.entries = OrderedDict()
+        # entry name -> number of restored volumes which read their products from the entry
+        self.readers = {}
+        # Entries removed while they still had readers, deleted once the last one is gone
+        self.removed = set()
+        self.spills = 0
+        self.restores = 0
+        self.evictions = 0
+        self.enabled = self._scan_spill_dir()
+
+    def entry_path(self, file_path) -> Path:
+        file_path = Path(file_path)
+        digest = hashlib.sha1(str(file_path.resolve()).encode()).hexdigest()[:16]
+        return self.spill_dir / f'{file_path.stem}-{digest}.npz'
+
+    def contains(self, file_path) -> bool:
+        """True if there is a spilled entry for the file. The entry may still turn out to be stale."""
+        with self.lock:
+            return self.entry_path(file_path).name in self.entries
+
+    def put(self, r_volume: RadarVolume) -> bool:
+        """
+        Spill a volume. Products which are not built are built one at a time from the volume's
+        source data and written without being kept. Returns False if the volume could not be written.
+        """
+        if not self.enabled:
+            return False
+        path = self.entry_path(r_volume.filename)
+        if self.contains(r_volume.filename) and self._read_header(path, r_volume.filename) is not None:
+            # Unchanged since it was last spilled
+            self._touch(path)
+            return True
+
+        header = {
+            'source': VolumeFileCache.source_key(r_volume.filename),
+            'products': list(r_volume.products),
+            'metadata': {key: VolumeFileCache._to_json(value) for key, value in r_volume.metadata().items()}
+        }
+        try:
+            VolumeFileCache._atomic_write(path, partial(SpillCache._write_entry, header, r_volume.products.iter_built()))
+            size = path.stat().st_size
+        except (OSError, ValueError) as e:
+            print(f'Spill Cache: could not spill "{r_volume.filename}": {e}')
+            return False
+
+        with self.lock:
+            self.entries[path.name] = size
+            self.entries.move_to_end(path.name)
+            self.removed.discard(path.name)
+            self.spills += 1
+        self.evict(keep=path.name)
+        return True
+
+    def restore(self, file_path, dtype=np.float32):
+        """
+        Restore a spilled volume. Returns None if there is no entry, or if the entry is stale
+        (the source file changed). Products are decompressed the first time they are accessed.
+        """
+        path = self.entry_path(file_path)
+        with self.lock:
+            if path.name not in self.entries:
+                return None
+            # Keeps the entry from being evicted while it is read
+            self.readers[path.name] = self.readers.get(path.name, 0) + 1
+        header = self._read_header(path, file_path)
+        if header is None:
+            self._release(path.name)
+            self.remove(file_path)
+            return None
+
+        builders = {p_type: partial(SpillCache._read_product, path, p_type, dtype) for p_type in header['products']}
+        r_volume = RadarVolume.from_metadata(Path(file_path), header['metadata'], LazyProducts(builders))
+        # The products are read from the entry for as long as the volume lives
+        weakref.finalize(r_volume, self._release, path.name)
+        self._touch(path)
+        with self.lock:
+            self.restores += 1
+        return r_volume
+
+    def remove(self, file_path):
+        path = self.entry_path(file_path)
+        with self.lock:
+            self.entries.pop(path.name, None)
+            if path.name in self.readers:
+                self.removed.add(path.name)
+                return
+        try:
+            path.unlink(missing_ok=True)
+        except OSError:
+            pass
+
+    def evict(self, keep=None):
+        """Delete the least recently used entries until the tier fits its size cap."""
+        evicted = []
+        with self.lock:
+            total = sum(self.entries.values())
+            for name in list(self.entries):
+                if total <= self.budget_bytes:
+                    break
+                if name == keep or name in self.readers:
+                    # Restored volumes still read from the entry, the next spill tries again
+                    continue
+                total -= self.entries.pop(name)
+                self.evictions += 1
+                evicted.append(name)
+
+        for name in evicted:
+            try:
+                (self.spill_dir / name).unlink(missing_ok=True)
+            except OSError:
+                # E.g. being read by another thread on Windows, deleted when the directory is scanned again
+                pass
+        return evicted
+
+    def _release(self, name):
+        # A restored volume is gone (or was never handed out)
+        with self.lock:
+            self.readers[name] -= 1
+            if self.readers[name] > 0:
+                return
+            del self.readers[name]
+            if name not in self.removed:
+                return
+            self.removed.discard(name)
+        try:
+            (self.spill_dir / name).unlink(missing_ok=True)
+        except OSError:
+            pass
+
+    def total_bytes(self) -> int:
+        with self.lock:
+            return sum(self.entries.values())
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'bytes': sum(self.entries.values()),
+                'budget_bytes': self.budget_bytes,
+                'spills': self.spills,
+                'restores': self.restores,
+                'evictions': self.evictions,
+                'in_use': len(self.readers)
+            }
+
+    def _scan_spill_dir(self) -> bool:
+        """Pick up the entries of previous sessions, least recently used first. Returns False if the directory is unusable."""
+        try:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+            now = time.time()
+            entries = []
+            for path in self.spill_dir.iterdir():
+                stat = path.stat()
+                if path.suffix == '.tmp':
+                    if now - stat.st_mtime > SpillCache.STALE_TMP_AGE_S:
+                        path.unlink(missing_ok=True)
+                elif path.suffix == '.npz':
+                    entries.append((stat.st_mtime, path.name, stat.st_size))
+        except OSError as e:
+            print(f'Spill Cache: spill directory "{self.spill_dir}" is not usable, spilling is disabled: {e}')
+            return False
+
+        for (_, name, size) in sorted(entries):
+            self.entries[name] = size
+        self.evict()
+        return True
+
+    def _touch(self, path: Path):
+        with self.lock:
+            if path.name in self.entries:
+                self.entries.move_to_end(path.name)
+        try:
+            # The modification time keeps the LRU order across sessions
+            os.utime(path)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _write_entry(header: dict, products, f):
+        with zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_DEFLATED, compresslevel=SpillCache.COMPRESS_LEVEL) as archive:
+            with archive.open(f'{SpillCache.HEADER_KEY}.npy', 'w') as member:
+                np.lib.format.write_array(member, np.array(json.dumps(header)))
+            for (p_type, p_data) in products:
+                with archive.open(f'{p_type}.npy', 'w', force_zip64=True) as member:
+                    np.lib.format.write_array(member, np.ascontiguousarray(p_data))
+
+    @staticmethod
+    def _read_header(path: Path, file_path):
+        try:
+            with np.load(path) as archive:
+                header = json.loads(str(archive[SpillCache.HEADER_KEY]))
+            if header.get('source') != VolumeFileCache.source_key(file_path):
+                return None
+            return header
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            return None
+
+    @staticmethod
+    def _read_product(path: Path, p_type, dtype) -> np.ndarray:
+        with np.load(path) as archive:
+            return archive[p_type].astype(dtype, copy=False)
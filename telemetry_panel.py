@@ -0,0 +1,141 @@
+from PySide6.QtWidgets import QWidget, QGridLayout, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QFileDialog, QSizePolicy
+from PySide6.QtCore import Qt, QTimer, QRectF, Slot
+from PySide6.QtGui import QPainter, QColor, QPen
+from redraw_scheduler import RedrawScheduler
+
+class HistogramWidget(QWidget):
+    """
+    A small bar chart of the recent samples of a single telemetry metric, with the
+    median and 90th percentile in the title.
+    """
+    def __init__(self, title, scale=1000.0, unit='ms', bins=20):
+        super().__init__()
+        self.title = title
+        # Factor and unit the samples are displayed in, e.g. seconds -> milliseconds
+        self.scale = scale
+        self.unit = unit
+        self.bins = bins
+        self.histogram = None
+        self.summary = {'count': 0}
+        self.setMinimumSize(220, 110)
+        self.setSizePolicy(QSizePolicy.Policy.Expanding, QSizePolicy.Policy.Expanding)
+
+    def set_data(self, histogram, summary):
+        self.histogram = histogram
+        self.summary = summary
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        text_height = painter.fontMetrics().height()
+
+        if self.summary['count'] == 0:
+            painter.drawText(4, text_height, f'{self.title}: no samples')
+            return
+        painter.drawText(4, text_height, f'{self.title}: p50 {self.summary["p50"] * self.scale:.1f} {self.unit}, '
+                                         f'p90 {self.summary["p90"] * self.scale:.1f} {self.unit} (n={self.summary["count"]})')
+
+        (counts, edges) = self.histogram
+        plot = QRectF(4, text_height + 4, self.width() - 8, self.height() - 2 * text_height - 12)
+        bar_width = plot.width() / len(counts)
+        max_count = max(counts.max(), 1)
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(QColor(70, 130, 180))
+        for (i, count) in enumerate(counts):
+            bar_height = plot.height() * count / max_count
+            painter.drawRect(QRectF(plot.left() + i * bar_width, plot.bottom() - bar_height, max(bar_width - 1, 1), bar_height))
+
+        painter.setPen(QPen(self.palette().text().color()))
+        painter.drawLine(plot.bottomLeft(), plot.bottomRight())
+        painter.drawText(QRectF(plot.left(), plot.bottom() + 2, plot.width(), text_height), Qt.AlignmentFlag.AlignLeft, f'{edges[0] * self.scale:.1f}')
+        painter.drawText(QRectF(plot.left(), plot.bottom() + 2, plot.width(), text_height), Qt.AlignmentFlag.AlignRight, f'{edges[-1] * self.scale:.1f} {self.unit}')
+
+class TelemetryPanel(QWidget):
+    """
+    Rolling histograms of the loading pipeline's telemetry (see load_telemetry.py), the
+    cache counters of a Data_Manager and the redraw counters of the RedrawScheduler.
+    Refreshes itself while it is visible, and can dump the loading telemetry to JSON for
+    offline comparisons, e.g. between releases.
+    """
+    HISTOGRAMS = (
+        ('queue_wait_s', 'Queue wait', 1000.0, 'ms'),
+        ('read_s', 'Read', 1000.0, 'ms'),
+        ('decode_s', 'Decode', 1000.0, 'ms'),
+        ('assemble_s', 'Assemble', 1000.0, 'ms'),
+        ('load_s', 'Load (total)', 1000.0, 'ms'),
+        ('index_to_render_s', 'Index -> render', 1000.0, 'ms'),
+    )
+
+    def __init__(self, data_manager, refresh_ms=1000):
+        super().__init__()
+        self.data_manager = data_manager
+        self.main_layout = QVBoxLayout(self)
+
+        self.histograms = {}
+        grid_layout = QGridLayout()
+        for (i, (metric, title, scale, unit)) in enumerate(TelemetryPanel.HISTOGRAMS):
+            self.histograms[metric] = HistogramWidget(title, scale, unit)
+            grid_layout.addWidget(self.histograms[metric], i // 3, i % 3)
+        self.main_layout.addLayout(grid_layout)
+
+        self.cache_label = QLabel()
+        self.main_layout.addWidget(self.cache_label)
+        self.redraw_label = QLabel()
+        self.main_layout.addWidget(self.redraw_label)
+
+        button_layout = QHBoxLayout()
+        self.dump_button = QPushButton("Dump JSON...")
+        self.dump_button.clicked.connect(self.dump_json)
+        button_layout.addWidget(self.dump_button)
+        self.reset_button = QPushButton("Reset")
+        self.reset_button.clicked.connect(self.reset)
+        button_layout.addWidget(self.reset_button)
+        button_layout.addStretch()
+        self.main_layout.addLayout(button_layout)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(refresh_ms)
+        self.timer.timeout.connect(self.refresh)
+
+    def showEvent(self, event):
+        self.refresh()
+        self.timer.start()
+        super().showEvent(event)
+
+    def hideEvent(self, event):
+        self.timer.stop()
+        super().hideEvent(event)
+
+    @Slot()
+    def refresh(self):
+        telemetry = self.data_manager.telemetry
+        for (metric, histogram) in self.histograms.items():
+            histogram.set_data(telemetry.histogram(metric, histogram.bins), telemetry.summary(metric))
+
+        stats = self.data_manager.get_cache_stats()
+        spill = stats['spill']
+        sources = ', '.join(f'{source} {count}' for (source, count) in sorted(telemetry.load_sources().items()))
+        self.cache_label.setText(
+            f'Resident: {stats["volumes"]} volumes, {stats["bytes"] / 1024**2:.0f}/{stats["budget_bytes"] / 1024**2:.0f} MB | '
+            f'Hit rate {stats["hit_rate"] * 100:.0f}% ({stats["hits"]} hits, {stats["misses"]} misses, {stats["evictions"]} evictions) | '
+            f'Spill: {spill["entries"]} entries, {spill["bytes"] / 1024**2:.0f} MB, {spill["restores"]} restores | '
+            f'Loaded from: {sources or "-"}')
+
+        redraws = RedrawScheduler.instance().get_stats()
+        self.redraw_label.setText(
+            f'Redraws: {redraws["requested"]} requested, {redraws["executed"]} executed in {redraws["frames"]} frames, '
+            f'{redraws["coalesced"]} coalesced')
+
+    @Slot()
+    def dump_json(self):
+        (path, _) = QFileDialog.getSaveFileName(self, "Dump Telemetry", "telemetry.json", "JSON files (*.json)")
+        if path:
+            self.data_manager.telemetry.dump_json(path, self.data_manager.get_cache_stats())
+            print(f'Telemetry Panel: dumped telemetry to "{path}"')
+
+    @Slot()
+    def reset(self):
+        self.data_manager.telemetry.reset()
+        RedrawScheduler.instance().reset_stats()
+        self.refresh()
@@ -0,0 +1,155 @@
+import time
+import threading
+import numpy as np
+import pytest
+import scipy.io as scio
+from PySide6.QtCore import QCoreApplication
+from background_loader import BackgroundLoader, CancelFlag
+from load_telemetry import LoadTelemetry
+from radar_volume import RadarVolume
+from volume_file_cache import VolumeFileCache
+
+@pytest.fixture(scope='module', autouse=True)
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+def write_volume(path, num_elevations=3, num_azimuths=5, num_ranges=7):
+    rng = np.random.default_rng(0)
+    types = ['Z', 'V', 'R']
+    volume = np.zeros((1, num_elevations), dtype=[('time', 'O'), ('vcp', 'O'), ('start_range_km', 'O'), ('az_deg', 'O'),
+                                                  ('sweep_el_deg', 'O'), ('prod', 'O')])
+    for el_idx in range(num_elevations):
+        prod = np.zeros((1, len(types)), dtype=[('type', 'O'), ('dr', 'O'), ('data', 'O')])
+        for (p_idx, p_type) in enumerate(types):
+            data = rng.normal(size=(num_ranges, num_azimuths))
+            prod[0, p_idx] = (p_type, 30.0, data + 1j * data if p_type == 'R' else data)
+        volume[0, el_idx] = (739370.08, 100, 2.1, np.linspace(-45, 45, num_azimuths), 0.5 + el_idx, prod)
+    scio.savemat(path, {'volume': volume})
+
+@pytest.fixture
+def process_loader():
+    telemetry = LoadTelemetry()
+    loader = BackgroundLoader(backend='process', max_workers=1, telemetry=telemetry)
+    (loaded, failed) = ([], [])
+    loader.volume_loaded.connect(loaded.append)
+    loader.volume_failed.connect(failed.append)
+    yield (loader, loaded, failed, telemetry)
+    # Let the worker exit before the next test spawns its own
+    loader.process_pool.shutdown(wait=True)
+    loader.shutdown()
+
+def wait_for(loaded, count, timeout_s=60.0):
+    deadline = time.perf_counter() + timeout_s
+    while len(loaded) < count and time.perf_counter() < deadline:
+        QCoreApplication.processEvents()
+        time.sleep(0.01)
+    # Nothing else arrives afterwards
+    QCoreApplication.processEvents()
+    return loaded
+
+def test_process_backend_loads_through_the_cache(tmp_path, process_loader):
+    (loader, loaded, failed, telemetry) = process_loader
+    path = tmp_path / 'HRUS_240428_020000000_100.mat'
+    write_volume(path)
+    loader.load_volume(path)
+    (r_volume,) = wait_for(loaded, 1)
+
+    assert r_volume is not None
+    assert r_volume.filename == path
+    assert r_volume.shape == (3, 5, 7)
+    assert r_volume.load_time_s > 0
+    # The worker process wrote the cache entry, the volume was mapped back in from it
+    assert VolumeFileCache.is_valid(path)
+    assert isinstance(r_volume.products['Z'], np.memmap)
+    expected = RadarVolume.build_radar_volume_from_matlab_file(path, use_cache=False)
+    for p_type in expected.products:
+        np.testing.assert_array_equal(r_volume.products[p_type], expected.products[p_type], err_msg=p_type)
+    # The timings travelled back from the worker process
+    assert telemetry.load_sources() == {'matlab': 1}
+    assert len(telemetry.values('read_s')) == 1
+    assert not loader.is_loading(path)
+
+def test_process_backend_reports_failed_loads(tmp_path, process_loader):
+    (loader, loaded, failed, telemetry) = process_loader
+    path = tmp_path / 'HRUS_240428_020000000_100.mat'
+    path.write_bytes(b'not a MATLAB file')
+    loader.load_volume(path)
+    # The worker fails, the in-process fallback too, and the failure is reported once
+    assert wait_for(loaded, 1) == [None]
+    assert failed == [path]
+    assert not VolumeFileCache.is_valid(path)
+    assert not loader.is_loading(path)
+
+def test_cancel_flag_can_be_revived_until_the_load_sees_it():
+    flag = CancelFlag()
+    flag.set()
+    assert flag.revive()
+    assert not flag.is_set()
+    flag.set()
+    assert flag.is_set()
+    # The load is giving up, too late to take it back
+    assert not flag.revive()
+    assert flag.is_set()
+
+class GatedBuild(object):
+    """Stands in for build_radar_volume_from_matlab_file, holding each load at its cancellation point."""
+    def __init__(self):
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+        self.checked = threading.Event()
+        self.release = threading.Event()
+        self.calls = 0
+        self.build = RadarVolume.build_radar_volume_from_matlab_file
+
+    def __call__(self, file_path, cancel_flag=None, timings=None):
+        self.calls += 1
+        self.entered.set()
+        self.gate.wait(10)
+        cancelled = cancel_flag.is_set()
+        self.checked.set()
+        self.release.wait(10)
+        return None if cancelled else self.build(file_path, use_cache=False)
+
+@pytest.fixture
+def thread_loader(tmp_path, monkeypatch):
+    gated_build = GatedBuild()
+    monkeypatch.setattr(RadarVolume, 'build_radar_volume_from_matlab_file', staticmethod(gated_build))
+    loader = BackgroundLoader(backend='thread')
+    (loaded, failed) = ([], [])
+    loader.volume_loaded.connect(loaded.append)
+    loader.volume_failed.connect(failed.append)
+    path = tmp_path / 'HRUS_240428_020000000_100.mat'
+    write_volume(path)
+    yield (loader, loaded, failed, gated_build, path)
+    (gated_build.gate.set(), gated_build.release.set())
+    loader.thread_pool.waitForDone()
+    loader.shutdown()
+
+def test_requesting_a_cancelled_load_again_revives_it(thread_loader):
+    (loader, loaded, failed, gated_build, path) = thread_loader
+    loader.load_volume(path)
+    assert gated_build.entered.wait(10)
+    loader.cancel(path)
+    loader.load_volume(path, priority=-1)
+    (gated_build.gate.set(), gated_build.release.set())
+    # The load carried on, the file wasn't decoded a second time
+    (r_volume,) = wait_for(loaded, 1)
+    assert r_volume is not None and r_volume.filename == path
+    assert gated_build.calls == 1
+    assert not loader.is_loading(path)
+
+def test_a_load_which_gave_up_is_queued_again(thread_loader):
+    (loader, loaded, failed, gated_build, path) = thread_loader
+    loader.load_volume(path)
+    assert gated_build.entered.wait(10)
+    loader.cancel(path)
+    gated_build.gate.set()
+    assert gated_build.checked.wait(10)
+    # The load saw the cancellation and is giving up
+    loader.load_volume(path, priority=-1)
+    gated_build.release.set()
+    (r_volume,) = wait_for(loaded, 1)
+    assert r_volume is not None
+    assert gated_build.calls == 2
+    # Giving up on a cancelled load isn't a failure
+    assert failed == []
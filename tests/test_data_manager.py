@@ -0,0 +1,44 @@
+import pytest
+from pathlib import Path
+from PySide6.QtCore import QCoreApplication
+from data_manager import Data_Manager
+
+@pytest.fixture(scope='module', autouse=True)
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+@pytest.fixture
+def data_manager(tmp_path):
+    data_manager = Data_Manager(num_files_to_load=2)
+    # A scan of files which don't exist, nothing ever loads
+    data_manager.mat_files = [tmp_path / f'HRUS_240428_0200{i:02d}000_100.mat' for i in range(5)]
+    data_manager.file_positions = {mat_file: i for (i, mat_file) in enumerate(data_manager.mat_files)}
+    requested = []
+    data_manager.loader.load_volume = lambda filename, priority=0: requested.append(filename)
+    yield (data_manager, requested)
+    data_manager.shutdown()
+
+def test_failed_volumes_are_reported_and_not_prefetched_again(data_manager):
+    (data_manager, requested) = data_manager
+    failed = []
+    data_manager.volume_failed.connect(failed.append)
+    data_manager.on_volume_failed(data_manager.mat_files[1])
+    assert failed == [1]
+    assert data_manager.is_volume_failed(1)
+    assert not data_manager.is_volume_failed(2)
+
+    data_manager.set_current_index(0)
+    assert data_manager.mat_files[1] not in requested
+    assert data_manager.mat_files[2] in requested
+    # Unless the user moves onto it
+    requested.clear()
+    data_manager.set_current_index(1)
+    assert requested[0] == data_manager.mat_files[1]
+
+def test_failures_outside_the_scan_are_only_recorded(data_manager, tmp_path):
+    (data_manager, requested) = data_manager
+    failed = []
+    data_manager.volume_failed.connect(failed.append)
+    data_manager.on_volume_failed(tmp_path / 'elsewhere.mat')
+    assert failed == []
+    assert not any(data_manager.is_volume_failed(i) for i in range(5))
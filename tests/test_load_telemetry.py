@@ -0,0 +1,22 @@
+import numpy as np
+from load_telemetry import LoadTelemetry
+
+def test_histogram_of_recent_samples():
+    telemetry = LoadTelemetry(history=5)
+    assert telemetry.histogram('load_s') is None
+    for seconds in (9.0, 9.0, 0.1, 0.2, 0.3, 0.4, 0.5):
+        telemetry.record('load_s', seconds)
+    (counts, edges) = telemetry.histogram('load_s', bins=4)
+    # The two oldest samples fell out of the history
+    assert counts.sum() == 5
+    assert (edges[0], edges[-1]) == (0.1, 0.5)
+
+def test_record_load_splits_the_stages():
+    telemetry = LoadTelemetry()
+    telemetry.record_load(0.5, 2.0, {'read_s': 1.5, 'assemble_s': 0.25, 'source': 'matlab'})
+    telemetry.record_load(0.0, 0.1, {'read_s': 0.1, 'source': 'cache'})
+    np.testing.assert_array_equal(telemetry.values('read_s'), [1.5, 0.1])
+    np.testing.assert_array_equal(telemetry.values('assemble_s'), [0.25])
+    assert telemetry.histogram('decode_s') is None
+    assert telemetry.load_sources() == {'matlab': 1, 'cache': 1}
+    assert telemetry.summary('load_s')['max'] == 2.0
@@ -0,0 +1,199 @@
+import pytest
+from PySide6.QtCore import QCoreApplication
+import playback_engine
+from playback_engine import PlaybackEngine
+from volume_timeline import VolumeTimeline
+
+@pytest.fixture(scope='module', autouse=True)
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+class FakeClock(object):
+    """Stands in for time.perf_counter(), so the real-time steps are deterministic."""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(playback_engine.time, 'perf_counter', fake)
+    return fake
+
+def make_engine(num_volumes, ready, policy, mode=PlaybackEngine.FRAMES, times_s=None, failed=()):
+    """An engine which is playing, with a set of the indices which are ready (and which failed to load)."""
+    engine = PlaybackEngine(ready_probe=lambda index: index in ready, policy=policy, mode=mode, failed_probe=lambda index: index in failed)
+    engine.set_num_volumes(num_volumes)
+    if times_s is not None:
+        engine.set_timeline(VolumeTimeline(times_s))
+    shown = []
+    engine.index_changed.connect(shown.append)
+    engine.start()
+    return (engine, shown)
+
+def tick(engine, clock, seconds):
+    clock.now += seconds
+    engine.step()
+
+def test_frames_wait_holds_until_ready():
+    ready = {0, 1}
+    (engine, shown) = make_engine(4, ready, PlaybackEngine.WAIT)
+    engine.step()
+    engine.step()
+    engine.step()
+    assert shown == [1]
+    assert (engine.stalls, engine.dropped) == (1, 0)
+    ready.add(2)
+    engine.on_volume_ready()
+    assert shown == [1, 2]
+    assert engine.stalled_since is None
+
+def test_frames_wait_wraps_around():
+    (engine, shown) = make_engine(3, {0, 1, 2}, PlaybackEngine.WAIT)
+    for _ in range(4):
+        engine.step()
+    assert shown == [1, 2, 0, 1]
+
+def test_frames_drop_jumps_to_latest_ready():
+    ready = {0, 3}
+    (engine, shown) = make_engine(10, ready, PlaybackEngine.DROP)
+    engine.step()
+    engine.step()
+    assert shown == []
+    # Three volumes are due by now, 1 and 2 are skipped
+    engine.step()
+    assert shown == [3]
+    assert (engine.dropped, engine.lag, engine.stalls) == (2, 0, 1)
+
+def test_frames_drop_never_moves_onto_unready_volumes():
+    (engine, shown) = make_engine(10, {0}, PlaybackEngine.DROP)
+    for _ in range(20):
+        engine.step()
+    assert shown == []
+    # Catching up is limited to half the loop, beyond that it would wrap onto the volumes behind
+    assert engine.lag == 5
+
+@pytest.mark.parametrize('policy', PlaybackEngine.POLICIES)
+def test_frames_skip_failed_volumes(policy):
+    (engine, shown) = make_engine(5, {0, 3}, policy, failed={1, 2})
+    engine.step()
+    assert shown == [3]
+    assert (engine.dropped, engine.stalls) == (2, 0)
+
+def test_wait_resumes_when_the_awaited_volume_fails():
+    (ready, failed) = ({0, 2}, set())
+    (engine, shown) = make_engine(4, ready, PlaybackEngine.WAIT, failed=failed)
+    engine.step()
+    assert shown == []
+    assert engine.stalled_since is not None
+    # Loading volume 1 failed, it would never become ready
+    failed.add(1)
+    engine.on_volume_ready()
+    assert shown == [2]
+    assert engine.dropped == 1
+    assert engine.stalled_since is None
+
+def test_real_time_follows_the_timestamps(clock):
+    times_s = [0.0, 1.0, 3.0, 10.0]
+    (engine, shown) = make_engine(4, {0, 1, 2, 3}, PlaybackEngine.WAIT, PlaybackEngine.REAL_TIME, times_s)
+    tick(engine, clock, 0.5)
+    assert shown == []
+    tick(engine, clock, 0.6)
+    assert shown == [1]
+    tick(engine, clock, 1.0)
+    assert shown == [1]
+    tick(engine, clock, 1.0)
+    assert shown == [1, 2]
+
+def test_real_time_runs_at_a_multiple_of_real_time(clock):
+    (engine, shown) = make_engine(4, {0, 1, 2, 3}, PlaybackEngine.WAIT, PlaybackEngine.REAL_TIME, [0.0, 10.0, 20.0, 30.0])
+    engine.set_speed(10.0)
+    tick(engine, clock, 1.0)
+    assert shown == [1]
+    assert engine.clock_s == pytest.approx(10.0)
+
+def test_real_time_wait_stops_the_clock_at_an_unready_volume(clock):
+    ready = {0}
+    (engine, shown) = make_engine(3, ready, PlaybackEngine.WAIT, PlaybackEngine.REAL_TIME, [0.0, 1.0, 2.0])
+    tick(engine, clock, 5.0)
+    assert shown == []
+    assert engine.clock_s == 1.0
+    ready.add(1)
+    engine.on_volume_ready()
+    # Volume 2 gets its whole interval, the clock didn't run on while waiting
+    assert shown == [1]
+    assert engine.dropped == 0
+
+def test_real_time_drop_skips_unready_volumes(clock):
+    ready = {0, 3}
+    (engine, shown) = make_engine(5, ready, PlaybackEngine.DROP, PlaybackEngine.REAL_TIME, [0.0, 1.0, 2.0, 3.0, 4.0])
+    tick(engine, clock, 2.5)
+    assert shown == []
+    tick(engine, clock, 1.0)
+    assert shown == [3]
+    assert engine.dropped == 2
+
+@pytest.mark.parametrize('policy', PlaybackEngine.POLICIES)
+def test_real_time_wrap_waits_for_the_start_of_the_loop(clock, policy):
+    ready = {1, 2, 3}
+    (engine, shown) = make_engine(4, ready, policy, PlaybackEngine.REAL_TIME, [0.0, 1.0, 2.0, 3.0])
+    engine.seek(3)
+    # Past the end of the loop (3 + one mean interval), volume 0 isn't ready
+    tick(engine, clock, 1.25)
+    assert shown == []
+    assert engine.wrapped
+    # Later ticks still offer the start of the loop, instead of waiting for the clock to come round again
+    tick(engine, clock, 0.25)
+    ready.add(0)
+    engine.on_volume_ready()
+    assert shown == [0]
+    assert not engine.wrapped
+    tick(engine, clock, 1.0)
+    assert shown == [0, 1]
+
+def test_real_time_wrap_counts_the_volumes_never_shown(clock):
+    (engine, shown) = make_engine(4, {0, 1, 2, 3}, PlaybackEngine.DROP, PlaybackEngine.REAL_TIME, [0.0, 1.0, 2.0, 3.0])
+    engine.seek(1)
+    # From 1 past the end of the loop (4) into 0.5 of the next one: 2 and 3 were skipped
+    tick(engine, clock, 3.5)
+    assert shown == [0]
+    assert engine.dropped == 2
+
+def test_seek_moves_the_clock(clock):
+    (engine, shown) = make_engine(4, {0, 1, 2, 3}, PlaybackEngine.WAIT, PlaybackEngine.REAL_TIME, [0.0, 5.0, 10.0, 15.0])
+    engine.seek(2)
+    assert engine.clock_s == 10.0
+    tick(engine, clock, 5.0)
+    assert shown == [3]
+
+def test_set_timeline_rebases_the_clock(clock):
+    (engine, shown) = make_engine(3, {0, 1, 2}, PlaybackEngine.WAIT, PlaybackEngine.REAL_TIME)
+    tick(engine, clock, 1.0)
+    assert shown == [1]
+    # The actual times arrive while playing
+    engine.set_timeline(VolumeTimeline([100.0, 110.0, 120.0]))
+    assert engine.clock_s == 110.0
+    tick(engine, clock, 10.0)
+    assert shown == [1, 2]
+
+def test_real_time_skips_failed_volumes_in_their_own_time(clock):
+    (engine, shown) = make_engine(4, {0, 2, 3}, PlaybackEngine.WAIT, PlaybackEngine.REAL_TIME, [0.0, 1.0, 2.0, 3.0], failed={1})
+    tick(engine, clock, 1.25)
+    # Volume 0 stays on screen until volume 2 is due
+    assert shown == []
+    assert engine.dropped == 1
+    tick(engine, clock, 1.0)
+    assert shown == [2]
+    assert engine.stalls == 0
+
+def test_real_time_skips_a_failed_start_of_the_loop(clock):
+    (engine, shown) = make_engine(3, {1, 2}, PlaybackEngine.WAIT, PlaybackEngine.REAL_TIME, [0.0, 1.0, 2.0], failed={0})
+    engine.seek(2)
+    tick(engine, clock, 1.25)
+    assert shown == []
+    assert engine.wrapped
+    tick(engine, clock, 1.0)
+    assert shown == [1]
+    assert engine.dropped == 1
@@ -0,0 +1,54 @@
+import pytest
+from prefetch_policy import PrefetchPolicy
+
+@pytest.mark.parametrize('files_per_side', [0, 1, 2, 10])
+def test_paused_window_is_symmetric(files_per_side):
+    policy = PrefetchPolicy(num_workers=4)
+    policy.record_load_time(5.0)
+    assert policy.window(files_per_side) == (files_per_side, files_per_side)
+
+def test_playing_leans_ahead():
+    policy = PrefetchPolicy(num_workers=2)
+    policy.set_playback(True, 1, 1000)
+    # Without load times, the window is the budget's share ahead and a single volume behind
+    assert policy.window(5) == (1, 5)
+
+@pytest.mark.parametrize('interval_ms, expected_ahead', [
+    # 0.5 s loads: ceil(load / interval) volumes are played while one loads, plus one per worker
+    (1000, 5),    # max(files_per_side, 1 + 2)
+    (200, 5),     # max(files_per_side, 3 + 2)
+    (100, 7),     # 5 + 2
+    (50, 9),      # 10 + 2, limited to the rest of the window
+    (10, 9),
+])
+def test_ahead_grows_with_speed(interval_ms, expected_ahead):
+    policy = PrefetchPolicy(num_workers=2)
+    policy.set_playback(True, 1, interval_ms)
+    policy.record_load_time(0.5)
+    assert policy.window(5) == (1, expected_ahead)
+
+def test_ahead_follows_measured_load_times():
+    policy = PrefetchPolicy(num_workers=1, history=4)
+    policy.set_playback(True, -1, 100)
+    for seconds in (2.0, 2.0, 2.0, 2.0):
+        policy.record_load_time(seconds)
+    assert policy.volumes_needed_ahead() == 21
+    # Faster loads push the slow ones out of the history
+    for seconds in (0.1, 0.1, 0.1, 0.1):
+        policy.record_load_time(seconds)
+    assert policy.volumes_needed_ahead() == 2
+    assert policy.direction == -1
+
+@pytest.mark.parametrize('files_per_side, expected', [
+    # Data_Manager scales files_per_side by the memory pressure, down to 0 when it is critical
+    (10, (1, 19)),
+    (5, (1, 9)),
+    (1, (1, 1)),
+    # Playback waits for the next volume, so it is requested even when nothing fits
+    (0, (0, 1)),
+])
+def test_window_under_memory_pressure(files_per_side, expected):
+    policy = PrefetchPolicy(num_workers=8)
+    policy.set_playback(True, 1, 50)
+    policy.record_load_time(1.0)
+    assert policy.window(files_per_side) == expected
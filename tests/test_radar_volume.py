@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+import scipy.io as scio
+from radar_volume import LazyProducts, RadarVolume
+
+NUM_ELEVATIONS = 3
+NUM_AZIMUTHS = 5
+NUM_RANGES = 7
+
+def make_sweep(rng, p_type):
+    """One sweep of a product as it is stored in the file (range x az)."""
+    data = rng.normal(size=(NUM_RANGES, NUM_AZIMUTHS))
+    if p_type == 'Z':
+        # Gates without a return
+        data[rng.random(data.shape) < 0.2] = np.nan
+    elif p_type == 'D':
+        # Integer storage, cast up
+        data = (data * 100).astype(np.int16)
+    elif p_type in ('R', 'S'):
+        # Complex storage: the magnitude is kept for 'R', the other products drop the imaginary part
+        data = data + 1j * rng.normal(size=data.shape)
+    return data
+
+def write_volume(path):
+    rng = np.random.default_rng(0)
+    types = ['Z', 'V', 'D', 'R', 'S']
+    volume = np.zeros((1, NUM_ELEVATIONS), dtype=[('time', 'O'), ('vcp', 'O'), ('type', 'O'), ('start_range_km', 'O'),
+                                                  ('az_deg', 'O'), ('sweep_el_deg', 'O'), ('prod', 'O')])
+    for el_idx in range(NUM_ELEVATIONS):
+        prod = np.zeros((1, len(types)), dtype=[('type', 'O'), ('dr', 'O'), ('data', 'O')])
+        for (p_idx, p_type) in enumerate(types):
+            prod[0, p_idx] = (p_type, 30.0, make_sweep(rng, p_type))
+        volume[0, el_idx] = (739370.08, 100, 'ppi', 2.1, np.linspace(-45, 45, NUM_AZIMUTHS), 0.5 + 1.5 * el_idx, prod)
+    scio.savemat(path, {'volume': volume})
+
+def baseline_volume(path):
+    """The per-elevation loop products and geometry were built with before the cubes were stacked."""
+    volume = scio.loadmat(path, squeeze_me=True)['volume']
+    first_slice = volume[0]
+    product_types = [entry['type'] for entry in first_slice['prod']]
+    products = {}
+    for (p_idx, p_type) in enumerate(product_types):
+        p_data = np.zeros((NUM_ELEVATIONS, NUM_AZIMUTHS, NUM_RANGES))
+        for el_idx in range(NUM_ELEVATIONS):
+            prods = volume[el_idx]['prod']
+            if p_type == 'R':
+                p_data[el_idx, :, :] = np.abs(prods[p_idx]['data']).astype(np.float32).T
+            else:
+                p_data[el_idx, :, :] = prods[p_idx]['data'].astype(np.float32).T
+        products[p_type] = p_data.astype(np.float32)
+    start_range_km = first_slice['start_range_km']
+    doppler_resolution_km = first_slice['prod'][0]['dr'] / 1000.0
+    geometry = {
+        'azimuths_rad': [(az * np.pi / 180.0) for az in first_slice['az_deg']],
+        'elevations_rad': [(entry['sweep_el_deg'] * np.pi / 180.0) for entry in volume],
+        'ranges_km': [(start_range_km + (doppler_resolution_km * i)) for i in range(NUM_RANGES)]
+    }
+    return (products, geometry)
+
+@pytest.fixture(scope='module')
+def mat_file(tmp_path_factory):
+    path = tmp_path_factory.mktemp('scan') / 'HRUS_240428_020000000_100.mat'
+    write_volume(path)
+    return str(path)
+
+@pytest.mark.filterwarnings('ignore::numpy.exceptions.ComplexWarning')
+def test_products_match_the_per_elevation_loop(mat_file):
+    (expected, _) = baseline_volume(mat_file)
+    r_volume = RadarVolume.build_radar_volume_from_matlab_file(mat_file, use_cache=False)
+    assert list(r_volume.products) == list(expected)
+    for (p_type, cube) in expected.items():
+        assert r_volume.products[p_type].dtype == np.float32
+        # Exact, NaN gates included
+        np.testing.assert_array_equal(r_volume.products[p_type], cube, err_msg=p_type)
+    assert np.isnan(r_volume.products['Z']).any()
+
+@pytest.mark.filterwarnings('ignore::numpy.exceptions.ComplexWarning')
+def test_float64_cubes_keep_full_precision(mat_file):
+    r_volume = RadarVolume.build_radar_volume_from_matlab_file(mat_file, dtype=np.float64, use_cache=False)
+    volume = scio.loadmat(mat_file, squeeze_me=True)['volume']
+    prods = volume[1]['prod']
+    assert r_volume.products['V'].dtype == np.float64
+    np.testing.assert_array_equal(r_volume.products['V'][1], prods[1]['data'].T)
+    np.testing.assert_array_equal(r_volume.products['S'][1], prods[4]['data'].real.T)
+
+@pytest.mark.filterwarnings('ignore::numpy.exceptions.ComplexWarning')
+def test_geometry_matches_the_per_elevation_loop(mat_file):
+    (_, expected) = baseline_volume(mat_file)
+    r_volume = RadarVolume.build_radar_volume_from_matlab_file(mat_file, use_cache=False)
+    assert r_volume.shape == (NUM_ELEVATIONS, NUM_AZIMUTHS, NUM_RANGES)
+    for (name, values) in expected.items():
+        np.testing.assert_allclose(getattr(r_volume, name), values, rtol=1e-15, err_msg=name)
+
+def test_downcast_releases_products_which_can_be_built_again():
+    cube = np.arange(6, dtype=np.float32).reshape(1, 2, 3)
+    products = LazyProducts({'Z': lambda: cube.copy(), 'V': lambda: cube.copy()})
+    (products['Z'], products['V'])
+    products.downcast({'Z'})
+    assert products.loaded() == ['Z']
+    assert products['V'].dtype == np.float32
+
+def test_downcast_shrinks_products_with_a_single_source():
+    sweeps = np.linspace(0.0, 1.0, 6).reshape(1, 2, 3)
+    products = LazyProducts({'Z': lambda: sweeps.astype(np.float32), 'V': lambda: sweeps.astype(np.float32)},
+                            {'Z': sweeps.nbytes, 'V': sweeps.nbytes})
+    products['Z']
+    products.downcast(set())
+    # Built or not, both products end up as float16 cubes without their sources
+    for p_type in ('Z', 'V'):
+        assert products.get_built(p_type).dtype == np.float16
+        np.testing.assert_allclose(products[p_type], sweeps, rtol=1e-3)
+    assert products.nbytes == 2 * sweeps.size * 2
+
+@pytest.mark.filterwarnings('ignore::numpy.exceptions.ComplexWarning')
+def test_downcast_products_are_sliced_as_float32(mat_file):
+    r_volume = RadarVolume.build_radar_volume_from_matlab_file(mat_file, use_cache=False)
+    expected = r_volume.ppi_slice('V', 1).copy()
+    nbytes = r_volume.nbytes
+    r_volume.downcast_products({'Z'})
+    assert r_volume.products['V'].dtype == np.float16
+    assert r_volume.products['Z'].dtype == np.float32
+    assert r_volume.nbytes < nbytes
+    data = r_volume.ppi_slice('V', 1)
+    assert data.dtype == np.float32 and data.flags['C_CONTIGUOUS']
+    np.testing.assert_allclose(data, expected, rtol=1e-3, atol=1e-3)
@@ -0,0 +1,65 @@
+from resident_volume_cache import ResidentVolumeCache
+
+class FakeVolume(object):
+    """Stands in for a RadarVolume, the cache only looks at its size."""
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+
+def make_cache(budget_bytes, filenames, nbytes=100, distance_weight=1.0):
+    cache = ResidentVolumeCache(budget_bytes, distance_weight)
+    for filename in filenames:
+        cache.put(filename, FakeVolume(nbytes))
+    return cache
+
+def test_no_eviction_within_budget():
+    cache = make_cache(300, ['a', 'b', 'c'])
+    assert cache.evict(lambda filename: 0) == []
+    assert len(cache) == 3
+    assert cache.evictions == 0
+
+def test_evicts_until_within_budget():
+    cache = make_cache(250, ['a', 'b', 'c', 'd', 'e'])
+    evicted = cache.evict(lambda filename: 0)
+    # Oldest first, and no more than needed to get from 500 down to 250 bytes
+    assert [filename for (filename, r_volume) in evicted] == ['a', 'b', 'c']
+    assert list(cache.volumes) == ['d', 'e']
+    assert cache.total_bytes() <= cache.budget_bytes
+    assert cache.evictions == 3
+
+def test_recently_used_volumes_survive():
+    cache = make_cache(200, ['a', 'b', 'c'])
+    cache.get('a')
+    evicted = cache.evict(lambda filename: 0)
+    assert [filename for (filename, r_volume) in evicted] == ['b']
+    assert 'a' in cache
+
+def test_peek_does_not_count_as_use():
+    cache = make_cache(200, ['a', 'b', 'c'])
+    cache.peek('a')
+    evicted = cache.evict(lambda filename: 0)
+    assert [filename for (filename, r_volume) in evicted] == ['a']
+    assert (cache.hits, cache.misses) == (0, 0)
+
+def test_distance_from_cursor_outweighs_age():
+    # 'c' was used last but is far away from the cursor, 'a' and 'b' are right next to it
+    distances = {'a': 0, 'b': 1, 'c': 10}
+    cache = make_cache(200, ['a', 'b', 'c'], distance_weight=2.0)
+    evicted = cache.evict(distances.get)
+    assert [filename for (filename, r_volume) in evicted] == ['c']
+
+def test_pinned_volumes_are_never_evicted():
+    cache = make_cache(100, ['a', 'b', 'c'])
+    evicted = cache.evict(lambda filename: 0, pinned={'a'})
+    assert sorted(filename for (filename, r_volume) in evicted) == ['b', 'c']
+    assert list(cache.volumes) == ['a']
+    # Nothing left to evict, even though the pinned volume alone is over budget
+    cache.budget_bytes = 50
+    assert cache.evict(lambda filename: 0, pinned={'a'}) == []
+
+def test_budget_follows_volume_sizes():
+    cache = make_cache(300, ['a', 'b', 'c'])
+    # A product was built after the volume went into the cache
+    cache.peek('b').nbytes = 250
+    evicted = cache.evict(lambda filename: 0)
+    assert cache.total_bytes() <= 300
+    assert len(evicted) == 2
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from slice_geometry import SliceGeometry
+
+def rhi_geometry():
+    # 4 elevations over 90 degrees, 5 range gates starting 2 gates (of 1 km) out
+    return SliceGeometry('rhi', num_angles=4, num_ranges=5, radial_swath=np.pi / 2, loc0=0.0, y_start=2, km_per_pixel=1.0)
+
+def at(angle_rad, range_km):
+    return (range_km * np.cos(angle_rad), range_km * np.sin(angle_rad))
+
+@pytest.mark.parametrize('range_km, expected', [
+    (1.999, -1),
+    # A point on the boundary between two gates belongs to the farther one
+    (2.0, 0),
+    (2.999, 0),
+    (3.0, 1),
+    (6.999, 4),
+    (7.0, -1),
+])
+def test_range_gate_edges(range_km, expected):
+    (angle_idx, range_idx) = rhi_geometry().gate_indices(*at(np.pi / 16, range_km))
+    assert range_idx == expected
+    assert angle_idx == (0 if expected >= 0 else -1)
+
+@pytest.mark.parametrize('angle_rad, expected', [
+    (-1e-9, -1),
+    (0.0, 0),
+    (np.pi / 8 - 1e-9, 0),
+    (np.pi / 8 + 1e-9, 1),
+    (np.pi / 2 - 1e-9, 3),
+    (np.pi / 2 + 1e-9, -1),
+])
+def test_angle_edges(angle_rad, expected):
+    (angle_idx, range_idx) = rhi_geometry().gate_indices(*at(angle_rad, 4.5))
+    assert angle_idx == expected
+    assert range_idx == (2 if expected >= 0 else -1)
+
+def test_full_circle_wraps_around():
+    # PPI columns run clockwise, from the edge of the first column at 0
+    geometry = SliceGeometry('ppi', num_angles=8, num_ranges=3, radial_swath=2 * np.pi, loc0=0.0, y_start=0, km_per_pixel=1.0)
+    (angle_idx, range_idx) = geometry.gate_indices(*at(np.array([-1e-9, 1e-9, -np.pi / 2]), 1.5))
+    assert angle_idx.tolist() == [0, 7, 2]
+    assert range_idx.tolist() == [1, 1, 1]
+
+@pytest.mark.parametrize('geometry', [
+    rhi_geometry(),
+    SliceGeometry('ppi', num_angles=90, num_ranges=40, radial_swath=np.deg2rad(90.0), loc0=np.deg2rad(90.0), y_start=12, km_per_pixel=0.25),
+])
+def test_inverse_of_build_transform(geometry):
+    # The center of every pixel of the slice image maps back onto that pixel
+    (cols, rows) = np.meshgrid(np.arange(geometry.num_angles), np.arange(geometry.num_ranges), indexing='ij')
+    pixels = np.stack([cols.ravel() + 0.5, rows.ravel() + 0.5], axis=1)
+    km = geometry.build_transform().map(pixels)
+    (angle_idx, range_idx) = geometry.gate_indices(km[:, 0], km[:, 1])
+    np.testing.assert_array_equal(angle_idx, cols.ravel())
+    np.testing.assert_array_equal(range_idx, rows.ravel())
@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+from slice_geometry import SliceGeometry
+from slice_pyramid import SlicePyramid
+
+def pyramid(num_ranges=256, num_angles=8):
+    # Few enough angles around a full circle that only the range gates are reduced
+    return SlicePyramid(SliceGeometry('ppi', num_angles, num_ranges, 2 * np.pi, 0.0, 0, 1.0))
+
+def blocks_of(values, num_angles=8):
+    """A (range x angle) slice which repeats a block of 2 range gates along both axes."""
+    return np.tile(np.array(values, dtype=np.float32)[:, np.newaxis], (128, num_angles))
+
+def test_level_zero_is_the_slice():
+    slice_data = np.arange(256 * 8, dtype=np.float64).reshape(256, 8)
+    reduced = pyramid().reduce(slice_data, 0, 'V')
+    assert reduced.dtype == np.float32 and reduced.flags.c_contiguous
+    np.testing.assert_array_equal(reduced, slice_data)
+
+@pytest.mark.parametrize('product, block, expected', [
+    # Reflectivity keeps the maximum
+    ('Z', [10.0, 40.0], 40.0),
+    # Velocity keeps the gate of the largest magnitude, across a folding boundary the mean would be ~0
+    ('V', [-30.0, 29.0], -30.0),
+    ('V', [5.0, -2.0], 5.0),
+    # Differential phase keeps a gate, the mean of 350 and 10 degrees would be 180
+    ('P', [350.0, 10.0], 350.0),
+    ('P', [np.nan, 10.0], 10.0),
+    # Continuous fields are averaged
+    ('W', [1.0, 3.0], 2.0),
+    ('R', [0.9, np.nan], 0.9),
+])
+def test_reduction_per_product(product, block, expected):
+    p = pyramid()
+    assert p.factors[1] == (2, 1)
+    reduced = p.reduce(blocks_of(block), 1, product)
+    assert reduced.shape == (128, 8)
+    np.testing.assert_allclose(reduced, expected, rtol=1e-6)
+
+@pytest.mark.parametrize('product', ['Z', 'V', 'P', 'W'])
+def test_blocks_without_valid_gates_stay_missing(product):
+    reduced = pyramid().reduce(blocks_of([np.nan, np.nan]), 1, product)
+    assert np.isnan(reduced).all()
+
+def test_partial_blocks_are_padded():
+    # 262 gates in blocks of 4 at level 2: the last block holds the last 2 gates and 2 padding gates
+    p = pyramid(num_ranges=262)
+    (range_factor, _) = p.factors[2]
+    slice_data = np.tile(np.arange(262, dtype=np.float32)[:, np.newaxis], (1, 8))
+    reduced = p.reduce(slice_data, 2, 'P')
+    assert reduced.shape == (p.geometries[2].num_ranges, 8)
+    np.testing.assert_array_equal(reduced[:, 0], np.arange(0, 262, range_factor))
+    np.testing.assert_array_equal(p.reduce(slice_data, 2, 'Z')[-1], 261.0)
@@ -0,0 +1,92 @@
+import time
+import numpy as np
+import pytest
+from PySide6.QtCore import QCoreApplication
+from radar_volume import RadarVolume
+from thumbnail_cache import ThumbnailCache
+from volume_file_cache import VolumeFileCache
+from test_background_loader import write_volume
+
+@pytest.fixture(scope='module', autouse=True)
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+@pytest.fixture
+def thumbnail_cache():
+    thumbnail_cache = ThumbnailCache()
+    ready = []
+    thumbnail_cache.thumbnail_ready.connect(ready.append)
+    yield (thumbnail_cache, ready)
+    thumbnail_cache.shutdown()
+    if thumbnail_cache.process_pool is not None:
+        # Let the worker exit before the next test spawns its own
+        thumbnail_cache.process_pool.shutdown(wait=True)
+
+def wait_for(ready, count, timeout_s=60.0):
+    deadline = time.perf_counter() + timeout_s
+    while len(ready) < count and time.perf_counter() < deadline:
+        QCoreApplication.processEvents()
+        time.sleep(0.01)
+    QCoreApplication.processEvents()
+    return ready
+
+def test_sweep_order_covers_every_index_coarse_to_fine():
+    assert ThumbnailCache.sweep_order(0) == []
+    assert ThumbnailCache.sweep_order(5) == [0, 4, 2, 1, 3]
+    assert sorted(ThumbnailCache.sweep_order(500)) == list(range(500))
+
+def test_unconverted_files_get_thumbnails_without_being_loaded(tmp_path, thumbnail_cache):
+    (thumbnail_cache, ready) = thumbnail_cache
+    files = [tmp_path / f'HRUS_240428_0200{i:02d}000_100.mat' for i in range(3)]
+    for path in files:
+        write_volume(path, num_azimuths=5, num_ranges=128)
+    thumbnail_cache.set_files(files)
+    assert sorted(wait_for(ready, 3)) == [0, 1, 2]
+
+    for (index, path) in enumerate(files):
+        expected = RadarVolume.build_radar_volume_from_matlab_file(path, use_cache=False)
+        # The lowest tilt, two ranges per cell
+        thumbnail = thumbnail_cache.get(index)
+        assert thumbnail.shape == (5, 64)
+        np.testing.assert_array_equal(thumbnail, ThumbnailCache.reduce(expected.products['Z'][0]))
+        # The worker converted the file on the way, and left the thumbnail for next time
+        assert VolumeFileCache.is_valid(path)
+        np.testing.assert_array_equal(ThumbnailCache.read_sidecar(path), thumbnail)
+
+def test_converted_files_are_not_decoded_again(tmp_path, thumbnail_cache):
+    (thumbnail_cache, ready) = thumbnail_cache
+    path = tmp_path / 'HRUS_240428_020000000_100.mat'
+    write_volume(path)
+    assert RadarVolume.convert_matlab_file_to_cache(path)
+    thumbnail_cache.set_files([path])
+    assert wait_for(ready, 1) == [0]
+    assert thumbnail_cache.process_pool is None
+
+def test_files_which_cannot_be_decoded_get_no_thumbnail(tmp_path, thumbnail_cache):
+    (thumbnail_cache, ready) = thumbnail_cache
+    (bad, good) = (tmp_path / 'HRUS_240428_020000000_100.mat', tmp_path / 'HRUS_240428_020100000_100.mat')
+    bad.write_bytes(b'not a MATLAB file')
+    write_volume(good)
+    thumbnail_cache.set_files([bad, good])
+    assert wait_for(ready, 1) == [1]
+    assert thumbnail_cache.get(0) is None
+
+def test_loaded_volumes_are_not_decoded_again(tmp_path, thumbnail_cache):
+    (thumbnail_cache, ready) = thumbnail_cache
+    files = [tmp_path / f'HRUS_240428_0200{i:02d}000_100.mat' for i in range(3)]
+    for path in files:
+        write_volume(path)
+    r_volume = RadarVolume.build_radar_volume_from_matlab_file(files[1], use_cache=False)
+    r_volume.products['Z']
+    thumbnail_cache.set_files(files)
+    # Starting the worker process takes a while, meanwhile the last file in sweep order waits
+    # behind the two the pool has already queued up for it
+    deadline = time.perf_counter() + 10.0
+    while len(thumbnail_cache.decoding) < 3 and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    future = thumbnail_cache.decoding[files[1]]
+    thumbnail_cache.on_volume_loaded(r_volume)
+    assert future.cancelled()
+    assert sorted(wait_for(ready, 3)) == [0, 1, 2]
+    assert not VolumeFileCache.is_valid(files[1])
+    np.testing.assert_array_equal(thumbnail_cache.get(1), ThumbnailCache.reduce(r_volume.products['Z'][0]))
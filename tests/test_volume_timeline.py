@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from pathlib import Path
+from volume_metadata import ScanIndex, VolumeMetadata
+from volume_timeline import VolumeTimeline
+
+# 2024-04-28 02:00:00 UTC
+START_S = 1714269600.0
+
+def datenum(time_s):
+    return VolumeTimeline.DATENUM_UNIX_EPOCH + time_s / 86400.0
+
+def metadata(filename, time):
+    return VolumeMetadata(filename, time, vcp=100, num_elevations=20, num_azimuths=44, num_ranges=300,
+                          start_range_km=2.0, doppler_resolution_km=0.24)
+
+def test_sorts_irregular_times():
+    timeline = VolumeTimeline([30.0, 0.0, 12.5, 20.0])
+    assert timeline.order.tolist() == [1, 2, 3, 0]
+    assert [timeline.position_of(i) for i in range(4)] == [3, 0, 1, 2]
+    assert [timeline.index_at_position(p) for p in range(4)] == [1, 2, 3, 0]
+    assert (timeline.start_s, timeline.end_s) == (0.0, 30.0)
+    assert timeline.mean_interval_s() == 10.0
+
+@pytest.mark.parametrize('time_s, position', [
+    (-1.0, -1),
+    (0.0, 0),
+    (12.499, 0),
+    # A volume is on screen from its own time on
+    (12.5, 1),
+    (19.0, 1),
+    (30.0, 3),
+    (1000.0, 3),
+])
+def test_position_at(time_s, position):
+    timeline = VolumeTimeline([30.0, 0.0, 12.5, 20.0])
+    assert timeline.position_at(time_s) == position
+    # Before the scan starts the first volume is on screen
+    assert timeline.index_at(time_s) == timeline.index_at_position(max(position, 0))
+
+def test_equal_times_keep_their_order():
+    timeline = VolumeTimeline([5.0, 5.0, 0.0])
+    assert timeline.order.tolist() == [2, 0, 1]
+    assert timeline.index_at(5.0) == 1
+
+def test_mean_interval_of_a_single_volume():
+    assert VolumeTimeline([START_S]).mean_interval_s() == 1.0
+    assert VolumeTimeline([START_S, START_S]).mean_interval_s() == 1.0
+
+@pytest.mark.parametrize('filename, expected', [
+    ('HRUS_240428_020003000_100.mat', START_S + 3.0),
+    ('/data/Scan 12/HRUS_240428_020051250_100.mat', START_S + 51.25),
+    ('volume.mat', None),
+    # Not a valid time of day
+    ('HRUS_240428_250003000_100.mat', None),
+])
+def test_time_from_filename(filename, expected):
+    time_s = VolumeTimeline.time_from_filename(filename)
+    if expected is None:
+        assert np.isnan(time_s)
+    else:
+        assert time_s == pytest.approx(expected)
+
+def test_from_scan_index_fills_in_unknown_times():
+    files = [Path(f'/scan/volume_{i}.mat') for i in range(3)] + [Path('/scan/HRUS_240428_020100000_100.mat')]
+    entries = [metadata(files[0], datenum(START_S)), None, metadata(files[2], datenum(START_S + 40.0)), None]
+    timeline = VolumeTimeline.from_scan_index(ScanIndex(files, entries))
+    # Header times, rounded to milliseconds, an interpolated one and one from the filename
+    np.testing.assert_allclose(timeline.times_s, [START_S, START_S + 20.0, START_S + 40.0, START_S + 60.0])
+    assert timeline.times_s[0] == START_S
+
+def test_from_scan_index_without_any_times():
+    files = [Path(f'/scan/volume_{i}.mat') for i in range(3)]
+    timeline = VolumeTimeline.from_scan_index(ScanIndex(files, [None] * 3))
+    assert timeline.times_s.tolist() == [0.0, 1.0, 2.0]
+
+def test_format_time():
+    timeline = VolumeTimeline([START_S, START_S + 90.5])
+    assert timeline.format_time(0) == '2024-04-28 02:00:00.000 (+0:00.0)'
+    assert timeline.format_time(1) == '2024-04-28 02:01:30.500 (+1:30.5)'
@@ -0,0 +1,154 @@
+import numpy as np
+from collections import OrderedDict
+from vispy.scene.visuals import create_visual_node
+from vispy.visuals import ImageVisual
+try:
+    # Not part of VisPy's public API, see ResidentImageVisual
+    from vispy.visuals._scalable_textures import GPUScaledTexture2D
+except ImportError:
+    GPUScaledTexture2D = None
+
+class TextureCache(object):
+    """
+    Byte-budgeted LRU of slice textures uploaded to the GL context of one canvas (textures
+    can't be shared between canvases). Keys are whatever identifies a slice, e.g.
+    (filename, product, slice type, index).
+
+    Textures are GPU-scaled float textures: the color limits are a uniform of the image
+    shader, so the same texture serves any colormap and color limits. Uploads are queued
+    on the canvas, which sends them to the GPU with its next frame.
+    """
+    def __init__(self, glir_queue, budget_bytes=256 * 1024**2):
+        # Command queue of the canvas' context
+        self.glir_queue = glir_queue
+        self.budget_bytes = budget_bytes
+        # key -> (texture, shape, nbytes), least recently used first
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        # Keys of textures on screen, which are never evicted
+        self.pinned = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        """(texture, shape) of a slice, or None if it hasn't been uploaded."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry[:2]
+
+    def put(self, key, data: np.ndarray, clim):
+        """Upload a (rows x columns) slice and return its (texture, shape)."""
+        if key in self.entries:
+            self._remove(key)
+        texture = GPUScaledTexture2D(data, internalformat='auto', interpolation='nearest')
+        # Otherwise the color limits are computed from the data
+        texture.set_clim(clim)
+        texture.scale_and_set_data(data, copy=False)
+        self.glir_queue.associate(texture.glir)
+        self.entries[key] = (texture, data.shape, data.nbytes)
+        self.total_bytes += data.nbytes
+        self.evict()
+        return (texture, data.shape)
+
+    def pin(self, keys):
+        """Protect the textures of `keys` (and only those) from eviction."""
+        self.pinned = set(keys)
+
+    def evict(self):
+        """Release the least recently used textures until the cache fits into its budget."""
+        for key in list(self.entries):
+            if self.total_bytes <= self.budget_bytes:
+                break
+            if key not in self.pinned:
+                self._remove(key)
+                self.evictions += 1
+
+    def clear(self):
+        for key in list(self.entries):
+            self._remove(key)
+
+    def _remove(self, key):
+        (texture, _, nbytes) = self.entries.pop(key)
+        self.total_bytes -= nbytes
+        texture.delete()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'textures': len(self.entries),
+            'bytes': self.total_bytes,
+            'budget_bytes': self.budget_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+class ResidentImageVisual(ImageVisual):
+    """
+    An ImageVisual which can display a texture of a TextureCache in place of its own, so
+    showing a slice which is already on the GPU is a texture swap (plus a color limit
+    uniform) instead of an upload. set_data() switches back to the visual's own texture.
+
+    VisPy has no public API for swapping the texture of an image, so this relies on
+    ImageVisual internals of the pinned VisPy version (see requirements.txt). If any of
+    them is missing, `resident_textures` is False and the visual is a plain ImageVisual:
+    callers then have to upload every slice with set_data().
+    """
+    # ImageVisual methods and attributes used to swap textures
+    INTERNALS = ('_init_texture', '_update_colortransform_clim', '_texture', '_data',
+                 '_need_texture_upload', '_need_vertex_update', '_need_interpolation_update')
+
+    def __init__(self, *args, **kwargs):
+        self._own_texture = None
+        # Plain uploads until the internals have been checked
+        self.resident_textures = False
+        super().__init__(*args, **kwargs)
+        missing = [name for name in ResidentImageVisual.INTERNALS if not hasattr(self, name)]
+        if GPUScaledTexture2D is None:
+            missing.append('GPUScaledTexture2D')
+        if self._own_texture is None:
+            # _init_texture() was never called
+            missing.append('_init_texture')
+        self.resident_textures = not missing
+        if missing:
+            print(f'ResidentImageVisual: this VisPy version lacks {", ".join(sorted(set(missing)))}, uploading every slice instead')
+
+    def _init_texture(self, data, texture_format, **texture_kwargs):
+        self._own_texture = super()._init_texture(data, texture_format, **texture_kwargs)
+        return self._own_texture
+
+    def show_texture(self, texture, shape):
+        """Display an uploaded texture of a (rows x columns) image."""
+        if self._data is None or self._data.shape[:2] != shape[:2]:
+            self._need_vertex_update = True
+        # Only the shape of the data is needed from here on, the texture holds the values
+        self._data = np.broadcast_to(np.float32(0.0), shape)
+        self._need_texture_upload = False
+        self._swap_texture(texture)
+
+    def set_data(self, image, copy=False):
+        if self.resident_textures:
+            # Never upload into a cached texture
+            self._swap_texture(self._own_texture)
+        super().set_data(image, copy=copy)
+
+    def _swap_texture(self, texture):
+        if texture is self._texture:
+            return
+        texture.set_clim(self._texture.clim)
+        self._texture = texture
+        # Binds the texture to the shader
+        self._need_interpolation_update = True
+        self._update_colortransform_clim()
+        self.update()
+
+ResidentImage = create_visual_node(ResidentImageVisual)
@@ -0,0 +1,245 @@
+import io
+import json
+import multiprocessing
+import os
+import threading
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from PySide6.QtCore import QObject, Signal, Slot
+from radar_volume import RadarVolume
+from volume_file_cache import VolumeFileCache
+
+def build_thumbnail_in_worker(filename):
+    """
+    Worker process entry point for files which aren't in the volume file cache yet. Decodes the
+    .mat file into the cache, so loading the volume later is a cache hit, writes the thumbnail
+    sidecar and returns the thumbnail (None if the file has no reflectivity or can't be decoded).
+    """
+    r_volume = RadarVolume.build_radar_volume_from_matlab_file(filename)
+    if r_volume is None or ThumbnailCache.PRODUCT not in r_volume.products:
+        return None
+    lowest = int(np.argmin(r_volume.elevations_rad))
+    thumbnail = ThumbnailCache.reduce(r_volume.products[ThumbnailCache.PRODUCT][lowest])
+    ThumbnailCache.write_sidecar(filename, thumbnail)
+    return thumbnail
+
+def lower_worker_priority():
+    # The worker decodes whole files, it shouldn't slow down the volumes being looked at
+    if hasattr(os, 'nice'):
+        os.nice(10)
+
+class ThumbnailCache(QObject):
+    """
+    Small previews of the volumes of a scan, for scrubbing through the timeline without
+    loading anything. A thumbnail is the reflectivity of the lowest tilt (azimuth x range),
+    reduced to at most MAX_SIZE x MAX_SIZE cells by keeping the maximum of each block, so
+    cores stay visible.
+
+    Thumbnails are built on a background thread from sources which don't need the .mat
+    file to be parsed: a thumbnail sidecar in the volume's cache directory, the memory-mapped
+    product arrays of the volume file cache, or volumes which finish loading with their
+    reflectivity built. Files without either are decoded by a low priority worker process
+    (see build_thumbnail_in_worker), in the same coarse to fine order, which also converts
+    them into the volume file cache. New thumbnails are written to the sidecar, so reopening
+    a scan is instant. Scans which have been through preconvert_scanset.py get every
+    thumbnail right away, the rest fill in over the first pass of the worker.
+
+    Thumbnails are kept by filename, so scans of a scanset which share files share them.
+    """
+    PRODUCT = 'Z'
+    MAX_SIZE = 64
+    SIDECAR_NAME = 'thumbnail.npz'
+
+    # Emitted with the index (in the current scan) of a volume whose thumbnail is ready
+    thumbnail_ready = Signal(int)
+    # Emitted when the files of the current scan change
+    files_changed = Signal()
+    # Thumbnails built on the worker thread: (filename, thumbnail)
+    _built = Signal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        # filename -> (azimuth x range) float32 thumbnail
+        self.thumbnails = {}
+        # Files of the current scan, and their indices
+        self.files = []
+        self.positions = {}
+        # Builds thumbnails one at a time, so the volume loader keeps the rest of the machine
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='thumbnails')
+        self.pending = []
+        # Decodes the files which aren't in the volume file cache, started on first use. The
+        # parse holds the GIL for its whole duration, so it's kept out of the GUI process.
+        self.process_pool = None
+        # filename -> future of the files handed to the worker process, shared with the worker thread
+        self.lock = threading.Lock()
+        self.decoding = {}
+        self.closed = False
+        self._built.connect(self._on_built)
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, index):
+        """The thumbnail of the volume at `index` in the current scan, None if it isn't built (yet)."""
+        if 0 <= index < len(self.files):
+            return self.thumbnails.get(self.files[index])
+        return None
+
+    def set_files(self, files):
+        """Start building the thumbnails of a scan's files (absolute paths), in place of the previous scan's."""
+        files = list(files)
+        if files == self.files:
+            return
+        for future in self.pending:
+            future.cancel()
+        with self.lock:
+            (decoding, self.decoding) = (self.decoding, {})
+            self.files = files
+            self.positions = {f: i for (i, f) in enumerate(files)}
+        # Cancelling runs the done callbacks, which take the lock
+        for future in decoding.values():
+            future.cancel()
+        self.files_changed.emit()
+        # Spread out over the scan first, so the whole timeline gets coarse coverage quickly
+        self.pending = [self._submit(self._build_from_disk, files[i])
+                        for i in ThumbnailCache.sweep_order(len(files)) if files[i] not in self.thumbnails]
+
+    @staticmethod
+    def sweep_order(n) -> list:
+        """0..n-1 in coarse to fine order: every 2^k-th index for decreasing k."""
+        order = []
+        seen = np.zeros(n, dtype=bool)
+        step = 1 << max(0, n - 1).bit_length()
+        while step >= 1:
+            for i in range(0, n, step):
+                if not seen[i]:
+                    seen[i] = True
+                    order.append(i)
+            step //= 2
+        return order
+
+    @Slot(RadarVolume)
+    def on_volume_loaded(self, r_volume: RadarVolume):
+        """Slot to build the thumbnail of a volume which was loaded anyway."""
+        if r_volume is not None and r_volume.filename not in self.thumbnails:
+            with self.lock:
+                future = self.decoding.pop(r_volume.filename, None)
+            if future is not None:
+                # Unless the worker is already on it
+                future.cancel()
+            self._submit(self._build_from_volume, r_volume)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        with self.lock:
+            self.closed = True
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, build, source):
+        future = self.executor.submit(build, source)
+        future.add_done_callback(ThumbnailCache._report_failure)
+        return future
+
+    @staticmethod
+    def _report_failure(future):
+        # The executor keeps exceptions to itself
+        if not future.cancelled() and future.exception() is not None:
+            print(f'Thumbnail Cache: could not build a thumbnail: {future.exception()}')
+
+    @staticmethod
+    def reduce(sweep: np.ndarray, max_size=MAX_SIZE) -> np.ndarray:
+        """Reduce a 2-D sweep to at most max_size x max_size by the maximum of blocks, ignoring NaN."""
+        sweep = np.asarray(sweep, dtype=np.float32)
+        factors = [max(1, -(-n // max_size)) for n in sweep.shape]
+        shape = [-(-n // f) for (n, f) in zip(sweep.shape, factors)]
+        padded = np.full((shape[0] * factors[0], shape[1] * factors[1]), np.nan, dtype=np.float32)
+        padded[:sweep.shape[0], :sweep.shape[1]] = sweep
+        blocks = padded.reshape(shape[0], factors[0], shape[1], factors[1])
+        # fmax ignores NaN unless a whole block is NaN
+        return np.fmax.reduce(np.fmax.reduce(blocks, axis=3), axis=1)
+
+    def _build_from_disk(self, filename):
+        # Runs on the worker thread
+        thumbnail = ThumbnailCache.read_sidecar(filename)
+        if thumbnail is None:
+            cached = VolumeFileCache.read(filename)
+            if cached is None:
+                self._decode(filename)
+                return
+            (metadata, product_paths) = cached
+            if ThumbnailCache.PRODUCT not in product_paths:
+                return
+            cube = VolumeFileCache.map_product(product_paths[ThumbnailCache.PRODUCT])
+            lowest = int(np.argmin(metadata['elevations_rad']))
+            thumbnail = ThumbnailCache.reduce(cube[lowest])
+            ThumbnailCache.write_sidecar(filename, thumbnail)
+        self._built.emit(filename, thumbnail)
+
+    def _build_from_volume(self, r_volume: RadarVolume):
+        # Runs on the worker thread
+        cube = r_volume.products.get_built(ThumbnailCache.PRODUCT)
+        if cube is None:
+            # Never builds the product just for a thumbnail, it may be the whole cube (or decompressing
+            # it from the spill cache). The lowest sweep is read from the volume file cache, if there is one.
+            self._build_from_disk(r_volume.filename)
+            return
+        lowest = int(np.argmin(r_volume.elevations_rad))
+        thumbnail = ThumbnailCache.reduce(cube[lowest])
+        ThumbnailCache.write_sidecar(r_volume.filename, thumbnail)
+        self._built.emit(r_volume.filename, thumbnail)
+
+    def _decode(self, filename):
+        # Runs on the worker thread, which goes through the files in sweep order
+        with self.lock:
+            if self.closed or filename not in self.positions or filename in self.decoding:
+                return
+            if self.process_pool is None:
+                self.process_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'),
+                                                        initializer=lower_worker_priority)
+            future = self.process_pool.submit(build_thumbnail_in_worker, filename)
+            self.decoding[filename] = future
+        future.add_done_callback(lambda future: self._on_decoded(filename, future))
+
+    def _on_decoded(self, filename, future):
+        # Runs on a thread of the process pool
+        with self.lock:
+            if self.decoding.get(filename) is future:
+                del self.decoding[filename]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            print(f'Thumbnail Cache: could not decode {filename}: {future.exception()}')
+        elif future.result() is not None:
+            self._built.emit(filename, future.result())
+
+    @Slot(object, object)
+    def _on_built(self, filename, thumbnail):
+        self.thumbnails[filename] = thumbnail
+        index = self.positions.get(filename)
+        if index is not None:
+            self.thumbnail_ready.emit(index)
+
+    @staticmethod
+    def read_sidecar(filename):
+        """The thumbnail stored next to the volume's cache entry, None if there is none or the source changed."""
+        sidecar_path = VolumeFileCache.cache_dir_for(filename) / ThumbnailCache.SIDECAR_NAME
+        try:
+            with np.load(sidecar_path) as sidecar:
+                if json.loads(str(sidecar['source'])) != VolumeFileCache.source_key(filename):
+                    return None
+                return sidecar['thumbnail']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    @staticmethod
+    def write_sidecar(filename, thumbnail) -> bool:
+        sidecar_path = VolumeFileCache.cache_dir_for(filename) / ThumbnailCache.SIDECAR_NAME
+        try:
+            sidecar_path.parent.mkdir(parents=True, exist_ok=True)
+            buffer = io.BytesIO()
+            np.savez(buffer, thumbnail=thumbnail, source=json.dumps(VolumeFileCache.source_key(filename)))
+            VolumeFileCache._atomic_write(sidecar_path, lambda f: f.write(buffer.getvalue()))
+            return True
+        except OSError:
+            return False
@@ -1,9 +1,118 @@
-from PySide6.QtWidgets import QApplication, QWidget, QSlider, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QSpacerItem, QSizePolicy
-from PySide6.QtCore import Qt, QSize, Slot, Signal, QTimer
-from PySide6.QtGui import QIcon
+from PySide6.QtWidgets import QApplication, QWidget, QSlider, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QSpacerItem, QSizePolicy, QComboBox, QDateTimeEdit
+from PySide6.QtCore import Qt, QSize, Slot, Signal, QDateTime, QTimeZone, QRectF
+from PySide6.QtGui import QIcon, QImage, QPainter, QPixmap
+from vispy.color import get_colormap
+import numpy as np
+from playback_engine import PlaybackEngine
+from volume_timeline import VolumeTimeline
+from thumbnail_cache import ThumbnailCache
+
+def colorize(values: np.ndarray, cmap, clim) -> QImage:
+    """A (rows x columns) array as an image through a VisPy colormap, transparent where NaN."""
+    normalized = np.clip((values - clim[0]) / (clim[1] - clim[0]), 0.0, 1.0)
+    rgba = (cmap.map(np.nan_to_num(normalized).ravel()) * 255).astype(np.uint8).reshape(values.shape + (4,))
+    rgba[np.isnan(values)] = 0
+    (rows, columns) = values.shape
+    # QImage doesn't own the buffer, copy it before rgba goes away
+    return QImage(np.ascontiguousarray(rgba).data, columns, rows, 4 * columns, QImage.Format.Format_RGBA8888).copy()
+
+class ThumbnailStrip(QWidget):
+    """
+    A strip under the timeline slider with one column per volume: the maximum of the
+    volume's thumbnail (see ThumbnailCache) over the azimuths, range increasing upwards,
+    so storms can be found along the timeline at a glance. The strip is a single image of
+    (MAX_SIZE x volumes) pixels, scaled to the widget, and only columns whose thumbnail
+    arrived are recomputed.
+
+    Hovering over the strip emits the index under the mouse, clicking moves the timeline there.
+    """
+    index_hovered = Signal(int)
+    index_clicked = Signal(int)
+
+    def __init__(self, cmap=None, clim=(-10, 70)):
+        super().__init__()
+        self.cmap = cmap if cmap is not None else get_colormap('viridis')
+        self.clim = clim
+        self.thumbnail_cache = None
+        # (MAX_SIZE x volumes) values of the strip, NaN until a thumbnail arrives
+        self.columns = np.full((ThumbnailCache.MAX_SIZE, 0), np.nan, dtype=np.float32)
+        self.image = None
+        self.setMouseTracking(True)
+        self.setFixedHeight(32)
+
+    def set_thumbnail_cache(self, thumbnail_cache: ThumbnailCache):
+        self.thumbnail_cache = thumbnail_cache
+        thumbnail_cache.files_changed.connect(self.on_files_changed)
+        thumbnail_cache.thumbnail_ready.connect(self.on_thumbnail_ready)
+        self.on_files_changed()
+
+    @Slot()
+    def on_files_changed(self):
+        self.columns = np.full((ThumbnailCache.MAX_SIZE, len(self.thumbnail_cache)), np.nan, dtype=np.float32)
+        for index in range(len(self.thumbnail_cache)):
+            self.set_column(index)
+        self.image = None
+        self.update()
+
+    @Slot(int)
+    def on_thumbnail_ready(self, index: int):
+        self.set_column(index)
+        # Recolored at the next paint, arrivals in between are batched
+        self.image = None
+        self.update()
+
+    def set_column(self, index):
+        thumbnail = self.thumbnail_cache.get(index)
+        if thumbnail is None:
+            return
+        with np.errstate(all='ignore'):
+            profile = np.fmax.reduce(thumbnail, axis=0)
+        # Row 0 is at the top, the far range
+        self.columns[:, index] = np.interp(np.linspace(len(profile) - 1, 0, ThumbnailCache.MAX_SIZE), np.arange(len(profile)), profile)
+
+    def index_at(self, x) -> int:
+        num_volumes = self.columns.shape[1]
+        if num_volumes == 0 or self.width() <= 0:
+            return -1
+        return int(np.clip(x * num_volumes // self.width(), 0, num_volumes - 1))
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        if self.columns.shape[1] == 0:
+            return
+        if self.image is None:
+            self.image = colorize(self.columns, self.cmap, self.clim)
+        painter.drawImage(QRectF(self.rect()), self.image)
+
+    def mouseMoveEvent(self, event):
+        self.index_hovered.emit(self.index_at(event.position().x()))
+
+    def mousePressEvent(self, event):
+        index = self.index_at(event.position().x())
+        if event.button() == Qt.MouseButton.LeftButton and index >= 0:
+            self.index_clicked.emit(index)
+
+    def leaveEvent(self, event):
+        self.index_hovered.emit(-1)
+        super().leaveEvent(event)
+
 
 class TimelineControls(QWidget):
+    """
+    Timeline slider, stepping and playback controls. Playback is driven by a PlaybackEngine,
+    which only steps onto volumes the ready probe (see set_ready_probe) reports as resident,
+    and waits for or drops the others according to the selected policy. The times of the
+    volumes come from the scan index (see on_scan_index_changed), for the timestamp label,
+    seeking to a time and playback in real time.
+
+    With a ThumbnailCache (see set_thumbnail_cache), a strip of the volumes' thumbnails is
+    shown under the slider, and dragging the slider or hovering over the strip previews
+    the volume there. Only the volume where the slider is released gets loaded.
+    """
     timeline_index_changed = Signal(int)
+    # Emitted when playback starts, stops or changes speed: (playing, direction (1 forward/-1 backward), ms between volumes)
+    playback_state_changed = Signal(bool, int, int)
 
     def __init__(self):
         super().__init__()
@@ -40,19 +149,168 @@ class TimelineControls(QWidget):
         self.timeline_slider.setTickPosition(QSlider.TickPosition.TicksBelow)
         self.timeline_slider.setTickInterval(1)
         self.timeline_slider.setTracking(False) # Don't emit an updated value until the user stops dragging the slider.
+        # Preview the volume under the slider while dragging
+        self.timeline_slider.sliderMoved.connect(self.on_preview_index_changed)
+        self.timeline_slider.sliderReleased.connect(lambda: self.on_preview_index_changed(-1))
         # self.timeline_slider.setEnabled(False)  # Disabled until data is loaded
 
-        # Add the slider to the timeline layout
-        self.timeline_button_layout.addWidget(self.timeline_slider)
+        # Thumbnails of the volumes under the slider, hidden until there is a thumbnail cache
+        self.thumbnail_strip = ThumbnailStrip()
+        self.thumbnail_strip.index_hovered.connect(self.on_preview_index_changed)
+        self.thumbnail_strip.index_clicked.connect(self.timeline_slider.setValue)
+        self.thumbnail_strip.hide()
+
+        # Add the slider to the timeline layout, with the strip lined up under it
+        self.slider_layout = QVBoxLayout()
+        self.slider_layout.addWidget(self.timeline_slider)
+        self.slider_layout.addWidget(self.thumbnail_strip)
+        self.timeline_button_layout.addLayout(self.slider_layout)
         self.main_layout.addLayout(self.timeline_button_layout)
 
-        self.timeline_label = QLabel("Selected Time:")
-        self.main_layout.addWidget(self.timeline_label)
+        # Playback mode, speed and what to do when the next volume isn't loaded yet
+        self.playback_layout = QHBoxLayout()
+        self.mode_combo = QComboBox()
+        self.mode_combo.addItem("Evenly spaced", PlaybackEngine.FRAMES)
+        self.mode_combo.addItem("Real time", PlaybackEngine.REAL_TIME)
+        self.mode_combo.currentIndexChanged.connect(self.on_mode_changed)
+        self.playback_layout.addWidget(self.mode_combo)
+
+        self.speed_combo = QComboBox()
+        self.speed_combo.currentIndexChanged.connect(self.on_speed_changed)
+        self.playback_layout.addWidget(self.speed_combo)
+
+        self.policy_combo = QComboBox()
+        self.policy_combo.addItem("Wait for data", PlaybackEngine.WAIT)
+        self.policy_combo.addItem("Drop frames", PlaybackEngine.DROP)
+        self.policy_combo.currentIndexChanged.connect(self.on_policy_changed)
+        self.playback_layout.addWidget(self.policy_combo)
+
+        self.playback_stats_label = QLabel()
+        self.playback_layout.addWidget(self.playback_stats_label)
+        self.playback_layout.addStretch()
+        self.main_layout.addLayout(self.playback_layout)
+
+        self.time_layout = QHBoxLayout()
+        # Thumbnail of the volume being scrubbed over
+        self.preview_label = QLabel()
+        self.preview_label.setFixedSize(2 * ThumbnailCache.MAX_SIZE, 2 * ThumbnailCache.MAX_SIZE)
+        # Pixmaps are kept at the size of the thumbnails
+        self.preview_label.setScaledContents(True)
+        self.preview_label.hide()
+        self.time_layout.addWidget(self.preview_label)
+        self.thumbnail_cache = None
+        # QPixmap of every previewed thumbnail, by index
+        self.preview_pixmaps = {}
+        # Index of the volume in the preview (hovered, dragged to or the slider's)
+        self.preview_index = 0
+        self.timeline_label = QLabel("No volumes")
+        self.time_layout.addWidget(self.timeline_label)
+        self.time_layout.addStretch()
+        # Jump to the volume on screen at a given time
+        self.time_layout.addWidget(QLabel("Go to:"))
+        self.seek_time_edit = QDateTimeEdit()
+        self.seek_time_edit.setTimeZone(QTimeZone.utc())
+        self.seek_time_edit.setDisplayFormat("yyyy-MM-dd HH:mm:ss")
+        self.seek_time_edit.editingFinished.connect(lambda: self.seek_time(self.seek_time_edit.dateTime().toMSecsSinceEpoch() / 1000.0))
+        self.time_layout.addWidget(self.seek_time_edit)
+        self.main_layout.addLayout(self.time_layout)
+
+        # Set up the playback
+        self.playback = PlaybackEngine()
+        self.populate_speeds()
+        self.playback.index_changed.connect(self.timeline_slider.setValue)
+        self.playback.stats_changed.connect(self.on_playback_stats_changed)
+        # Keep playing from wherever the user moves the slider to
+        self.timeline_slider.valueChanged.connect(self.playback.seek)
+        self.timeline_slider.valueChanged.connect(self.on_preview_index_changed)
+        self.on_playback_stats_changed(self.playback.get_stats())
+
+    def set_ready_probe(self, ready_probe, failed_probe=None):
+        """
+        Set the function (index -> bool) playback asks whether a volume is ready to be shown, and
+        optionally the one it asks whether a volume failed to load and should be skipped.
+        """
+        self.playback.ready_probe = ready_probe
+        self.playback.failed_probe = failed_probe
 
-        # Set up the timer
-        self.timer = QTimer()
-        self.timer.setInterval(1000)
-        self.timer.timeout.connect(self.on_forward_button_pressed)
+    def set_thumbnail_cache(self, thumbnail_cache: ThumbnailCache, cmap=None, clim=(-10, 70)):
+        """Show the thumbnails of `thumbnail_cache` (colored by `cmap` over `clim`) under the slider and while scrubbing."""
+        self.thumbnail_cache = thumbnail_cache
+        self.thumbnail_strip.cmap = cmap if cmap is not None else self.thumbnail_strip.cmap
+        self.thumbnail_strip.clim = clim
+        self.thumbnail_strip.set_thumbnail_cache(thumbnail_cache)
+        thumbnail_cache.files_changed.connect(self.preview_pixmaps.clear)
+        thumbnail_cache.thumbnail_ready.connect(self.on_thumbnail_ready)
+        self.thumbnail_strip.show()
+        self.preview_label.show()
+
+    @Slot(int)
+    def on_preview_index_changed(self, index: int):
+        """Preview the volume at `index` (the slider's volume if -1) without loading it."""
+        if index < 0:
+            index = self.timeline_slider.value()
+        self.preview_index = index
+        self.update_time_label(index)
+        self.preview_label.setPixmap(self.preview_pixmap(index))
+
+    @Slot(int)
+    def on_thumbnail_ready(self, index: int):
+        # E.g. the volume under the cursor was loaded while hovering over the strip
+        if index == self.preview_index:
+            self.preview_label.setPixmap(self.preview_pixmap(index))
+
+    def preview_pixmap(self, index) -> QPixmap:
+        """The thumbnail of a volume as a pixmap for the preview, an empty pixmap if it isn't built yet."""
+        pixmap = self.preview_pixmaps.get(index)
+        if pixmap is not None:
+            return pixmap
+        thumbnail = self.thumbnail_cache.get(index) if self.thumbnail_cache is not None else None
+        if thumbnail is None:
+            return QPixmap()
+        # Azimuth across, range upwards
+        image = colorize(thumbnail.T[::-1], self.thumbnail_strip.cmap, self.thumbnail_strip.clim)
+        pixmap = QPixmap.fromImage(image)
+        self.preview_pixmaps[index] = pixmap
+        return pixmap
+
+    def populate_speeds(self):
+        """Fill the speed combo box with the speeds of the current playback mode, starting at 1x."""
+        speeds = PlaybackEngine.SPEEDS[self.playback.mode]
+        self.speed_combo.blockSignals(True)
+        self.speed_combo.clear()
+        for speed in speeds:
+            self.speed_combo.addItem(f'{speed:g}x', speed)
+        self.speed_combo.setCurrentIndex(speeds.index(1.0))
+        self.speed_combo.blockSignals(False)
+        self.playback.set_speed(1.0)
+
+    @Slot(object)
+    def on_scan_index_changed(self, scan_index):
+        """Slot to pick up the times of the volumes of a scan, whenever more of them are known."""
+        timeline = VolumeTimeline.from_scan_index(scan_index)
+        self.playback.set_timeline(timeline)
+        if len(timeline) > 0:
+            self.seek_time_edit.setDateTimeRange(self.to_qdatetime(timeline.start_s), self.to_qdatetime(timeline.end_s))
+        self.update_time_label(self.timeline_slider.value())
+
+    @staticmethod
+    def to_qdatetime(time_s) -> QDateTime:
+        return QDateTime.fromMSecsSinceEpoch(round(time_s * 1000), QTimeZone.utc())
+
+    def seek_time(self, time_s: float):
+        """Move the timeline to the volume on screen at a time (seconds since the Unix epoch)."""
+        if len(self.playback.timeline) > 0:
+            self.timeline_slider.setValue(self.playback.timeline.index_at(time_s))
+
+    @Slot(int)
+    def update_time_label(self, index: int):
+        timeline = self.playback.timeline
+        if not 0 <= index < len(timeline):
+            self.timeline_label.setText("No volumes")
+            return
+        self.timeline_label.setText(f'Volume {index + 1}/{len(timeline)}: {timeline.format_time(index)}')
+        if not self.seek_time_edit.hasFocus():
+            self.seek_time_edit.setDateTime(self.to_qdatetime(timeline.time_of(index)))
     
     @Slot()
     def on_forward_button_pressed(self):
@@ -78,20 +336,91 @@ class TimelineControls(QWidget):
         self.scan_times = num_vols
         print(f"Timeline Slider Updated Range: [{0}, {num_vols})")
         self.timeline_slider.setRange(0, num_vols - 1)
+        self.playback.set_num_volumes(num_vols)
+        self.update_time_label(self.timeline_slider.value())
 
     def toggle_play_pause(self):
-        if self.timer.isActive():
-            self.timer.stop()
+        if self.playback.is_playing():
+            self.playback.stop()
             self.play_button.setIcon(QIcon.fromTheme("media-playback-start")) 
         else:
-            self.timer.start(1000)  # Start timer with 1-second intervals
+            self.playback.reset_stats()
+            self.playback.start()
             self.play_button.setIcon(QIcon.fromTheme("media-playback-pause"))  
+        self.playback_state_changed.emit(self.playback.is_playing(), self.playback.direction, self.playback.volume_interval_ms())
+
+    @Slot(int)
+    def on_mode_changed(self, combo_index: int):
+        self.playback.set_mode(self.mode_combo.itemData(combo_index))
+        self.populate_speeds()
+        self.on_speed_changed(self.speed_combo.currentIndex())
+
+    @Slot(int)
+    def on_speed_changed(self, combo_index: int):
+        self.playback.set_speed(self.speed_combo.itemData(combo_index))
+        if self.playback.is_playing():
+            # Lets the prefetching keep up with the new speed
+            self.playback_state_changed.emit(True, self.playback.direction, self.playback.volume_interval_ms())
+
+    @Slot(int)
+    def on_policy_changed(self, combo_index: int):
+        self.playback.set_policy(self.policy_combo.itemData(combo_index))
+
+    @Slot(object)
+    def on_next_volume_ready(self, r_volume):
+        self.playback.on_volume_ready()
+
+    @Slot(int)
+    def on_volume_failed(self, index):
+        # Playback may be waiting for it
+        self.playback.on_volume_ready()
+
+    @Slot(dict)
+    def on_playback_stats_changed(self, stats: dict):
+        self.playback_stats_label.setText(
+            f'{stats["achieved_fps"]:.1f}/{stats["target_fps"]:.2g} fps, {stats["stalls"]} stalls ({stats["stalled_s"]:.1f} s), '
+            f'{stats["dropped"]} dropped')
+
+def benchmark_scrub(app, timeline_controls, num_volumes):
+    """Milliseconds per slider move while scrubbing over a scan of synthetic thumbnails, the first and second time over."""
+    import time
+    from pathlib import Path
+    thumbnail_cache = ThumbnailCache()
+    files = [Path(f'volume_{i:04d}.mat') for i in range(num_volumes)]
+    rng = np.random.default_rng(0)
+    # Already built, nothing to do in the background
+    thumbnail_cache.thumbnails = {f: rng.uniform(-10, 70, (ThumbnailCache.MAX_SIZE, ThumbnailCache.MAX_SIZE)).astype(np.float32) for f in files}
+    thumbnail_cache.set_files(files)
+    timeline_controls.set_thumbnail_cache(thumbnail_cache)
+    timeline_controls.on_num_volumes_changed(num_volumes)
+    app.processEvents()
+
+    times = []
+    for _ in range(2):
+        start = time.perf_counter()
+        for index in range(num_volumes):
+            timeline_controls.timeline_slider.sliderMoved.emit(index)
+            app.processEvents()
+        times.append((time.perf_counter() - start) / num_volumes * 1000)
+    thumbnail_cache.shutdown()
+    return times
 
 def main():
     """Test the TimelineControls widget."""
     import sys
     app = QApplication(sys.argv)
 
+    if '--benchmark' in sys.argv:
+        # Scrubbing cost should stay flat as scans grow:
+        #   python ./timeline_controls.py --benchmark
+        timeline_controls = TimelineControls()
+        timeline_controls.resize(800, 200)
+        timeline_controls.show()
+        for num_volumes in (50, 500):
+            (cold_ms, warm_ms) = benchmark_scrub(app, timeline_controls, num_volumes)
+            print(f'{num_volumes} volumes: {cold_ms:.2f} ms per scrub step ({warm_ms:.2f} ms previewed before)')
+        sys.exit(0)
+
     timeline_controls = TimelineControls()    
     timeline_controls.setWindowTitle("TimelineControls Test")
     timeline_controls.resize(800, 100)
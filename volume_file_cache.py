@@ -0,0 +1,145 @@
+import os
+import json
+import threading
+import numpy as np
+from pathlib import Path
+
+# Cache layout, next to the source .mat files:
+#
+# <scan dir>/
+#   HRUS_240428_020051000_100.mat
+#   .pardataviz_cache/
+#       HRUS_240428_020051000_100/
+#           header.json
+#           Z.npy
+#           V.npy
+#           ...
+#
+# header.json holds the source key (path, size, mtime), the array dtype and the
+# scalar/geometry metadata of the volume. Each product cube is a plain .npy file
+# so that it can be memory-mapped straight back in with np.load(mmap_mode='r').
+
+class VolumeFileCache(object):
+    """
+    Persistent on-disk cache of decoded radar volumes. The header is written last,
+    so a cache entry only becomes visible once all of its product arrays are on disk.
+    """
+    CACHE_DIR_NAME = '.pardataviz_cache'
+    HEADER_NAME = 'header.json'
+    FORMAT_VERSION = 1
+
+    @staticmethod
+    def cache_dir_for(file_path) -> Path:
+        file_path = Path(file_path)
+        return file_path.parent / VolumeFileCache.CACHE_DIR_NAME / file_path.stem
+
+    @staticmethod
+    def source_key(file_path) -> dict:
+        """The identity of a source file: its absolute path, size and modification time."""
+        stat = os.stat(file_path)
+        return {
+            'path': str(Path(file_path).resolve()),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns
+        }
+
+    @staticmethod
+    def read_header(file_path, dtype=None):
+        """
+        Read the header of the cache entry for `file_path`. Returns None if there is
+        no entry, or if the entry is stale (the source changed) or has a different dtype.
+        """
+        header_path = VolumeFileCache.cache_dir_for(file_path) / VolumeFileCache.HEADER_NAME
+        try:
+            with header_path.open("r") as header_file:
+                header = json.load(header_file)
+            if header.get('version') != VolumeFileCache.FORMAT_VERSION:
+                return None
+            if header.get('source') != VolumeFileCache.source_key(file_path):
+                return None
+            if dtype is not None and header.get('dtype') != np.dtype(dtype).str:
+                return None
+            return header
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def is_valid(file_path, dtype=None) -> bool:
+        return VolumeFileCache.read_header(file_path, dtype) is not None
+
+    @staticmethod
+    def read(file_path, dtype=None):
+        """
+        Look up a cached volume. Returns a (metadata, product_paths) tuple, where each
+        product path can be memory-mapped with `map_product`, or None on a cache miss.
+        """
+        header = VolumeFileCache.read_header(file_path, dtype)
+        if header is None:
+            return None
+
+        cache_dir = VolumeFileCache.cache_dir_for(file_path)
+        product_paths = {p_type: cache_dir / f'{p_type}.npy' for p_type in header['products']}
+        if not all(path.exists() for path in product_paths.values()):
+            return None
+        return (header['metadata'], product_paths)
+
+    @staticmethod
+    def map_product(product_path: Path) -> np.ndarray:
+        """Memory-map a cached product cube (read-only)."""
+        return np.load(product_path, mmap_mode='r')
+
+    @staticmethod
+    def write(file_path, metadata: dict, products) -> bool:
+        """
+        Write a decoded volume to the cache. `products` is an iterable of (product type,
+        cube) pairs, so cubes can be produced and written one at a time. Returns False
+        (and leaves no valid entry behind) if the cache directory is not writable.
+        """
+        cache_dir = VolumeFileCache.cache_dir_for(file_path)
+        header_path = cache_dir / VolumeFileCache.HEADER_NAME
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            # Invalidate any previous entry before touching the product arrays.
+            header_path.unlink(missing_ok=True)
+
+            product_types = []
+            dtypes = set()
+            for p_type, p_data in products:
+                VolumeFileCache._atomic_write(cache_dir / f'{p_type}.npy', lambda f, a=p_data: np.save(f, a))
+                product_types.append(p_type)
+                dtypes.add(np.asarray(p_data).dtype.str)
+
+            header = {
+                'version': VolumeFileCache.FORMAT_VERSION,
+                'source': VolumeFileCache.source_key(file_path),
+                'dtype': dtypes.pop() if len(dtypes) == 1 else None,
+                'products': product_types,
+                'metadata': {key: VolumeFileCache._to_json(value) for key, value in metadata.items()}
+            }
+            VolumeFileCache._atomic_write(header_path, lambda f: f.write(json.dumps(header, indent=1).encode()))
+            return True
+        except OSError as e:
+            print(f'Volume cache: could not write cache for "{file_path}": {e}')
+            return False
+
+    @staticmethod
+    def _atomic_write(path: Path, write_fn):
+        """Write to a temporary file next to `path` and rename it into place."""
+        tmp_path = path.with_name(f'{path.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+        try:
+            with tmp_path.open("wb") as tmp_file:
+                write_fn(tmp_file)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def _to_json(value):
+        """Convert MATLAB/NumPy scalars and arrays into JSON-friendly values."""
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, np.generic):
+            return value.item()
+        if value is None or isinstance(value, (str, int, float, bool, list)):
+            return value
+        return str(value)
@@ -0,0 +1,107 @@
+import numpy as np
+from volume_file_cache import VolumeFileCache
+
+class VolumeMetadata(object):
+    """
+    The scalar metadata of a single volume: its time, VCP and geometry. This is all
+    that is needed to lay out the timeline, the volume slice selector grid and the
+    plot extents, without touching any product data.
+    """
+    FIELDS = ('time', 'vcp', 'num_elevations', 'num_azimuths', 'num_ranges', 'start_range_km', 'doppler_resolution_km')
+
+    def __init__(self, filename, time, vcp, num_elevations, num_azimuths, num_ranges, start_range_km, doppler_resolution_km):
+        self.filename = filename
+        self.time = time
+        self.vcp = vcp
+        self.num_elevations = num_elevations
+        self.num_azimuths = num_azimuths
+        self.num_ranges = num_ranges
+        self.start_range_km = start_range_km
+        self.doppler_resolution_km = doppler_resolution_km
+
+    @property
+    def max_range_km(self) -> float:
+        return self.start_range_km + self.doppler_resolution_km * (self.num_ranges - 1)
+
+    def geometry(self) -> tuple:
+        """Everything which determines the layout of the grid and plots, handy for change detection."""
+        return (self.num_elevations, self.num_azimuths, self.num_ranges, self.start_range_km, self.doppler_resolution_km)
+
+    def to_dict(self) -> dict:
+        return {field: getattr(self, field) for field in VolumeMetadata.FIELDS}
+
+    @staticmethod
+    def from_radar_volume(r_volume):
+        return VolumeMetadata(
+            filename=r_volume.filename,
+            time=VolumeFileCache._to_json(r_volume.time),
+            vcp=VolumeFileCache._to_json(r_volume.vcp),
+            num_elevations=len(r_volume.elevations_rad),
+            num_azimuths=len(r_volume.azimuths_rad),
+            num_ranges=len(r_volume.ranges_km),
+            start_range_km=float(r_volume.start_range_km),
+            doppler_resolution_km=float(r_volume.doppler_resolution_km))
+
+    @staticmethod
+    def from_cache_header(file_path):
+        """
+        Read the metadata from the volume file cache header, a small JSON file.
+        Returns None if the volume has no up to date cache entry.
+        """
+        header = VolumeFileCache.read_header(file_path)
+        if header is None:
+            return None
+        metadata = header['metadata']
+        return VolumeMetadata(
+            filename=file_path,
+            time=metadata['time'],
+            vcp=metadata['vcp'],
+            num_elevations=len(metadata['elevations_rad']),
+            num_azimuths=len(metadata['azimuths_rad']),
+            num_ranges=len(metadata['ranges_km']),
+            start_range_km=metadata['start_range_km'],
+            doppler_resolution_km=metadata['doppler_resolution_km'])
+
+class ScanIndex(object):
+    """
+    Per-scan index of volume metadata, one (possibly unknown) entry per volume file.
+    Entries which are not known up front are filled in as volumes finish loading.
+    """
+    def __init__(self, files: list, entries: list):
+        self.files = list(files)
+        self.entries = list(entries)
+        self.positions = {f: i for (i, f) in enumerate(self.files)}
+
+    @staticmethod
+    def build(files):
+        return ScanIndex(files, [VolumeMetadata.from_cache_header(f) for f in files])
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, index):
+        """Metadata of the volume at `index`, or None if it is not known (yet)."""
+        if 0 <= index < len(self.entries):
+            return self.entries[index]
+        return None
+
+    def set(self, metadata: VolumeMetadata) -> bool:
+        """Fill in the entry of a volume, returns False if the file is not part of the scan."""
+        index = self.positions.get(metadata.filename)
+        if index is None:
+            return False
+        self.entries[index] = metadata
+        return True
+
+    def num_known(self) -> int:
+        return sum(1 for entry in self.entries if entry is not None)
+
+    def first_known(self):
+        return next((entry for entry in self.entries if entry is not None), None)
+
+    def column(self, field, default=np.nan) -> np.ndarray:
+        """One metadata field for the whole scan as an array, `default` where unknown."""
+        return np.array([default if entry is None or getattr(entry, field) is None else getattr(entry, field) for entry in self.entries])
+
+    def times(self) -> np.ndarray:
+        return self.column('time').astype(np.float64)
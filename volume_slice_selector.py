@@ -1,58 +1,173 @@
-from PySide6.QtWidgets import QApplication, QWidget, QGraphicsView, QGraphicsScene, QGraphicsEllipseItem, QGraphicsTextItem, QLabel, QVBoxLayout
-from PySide6.QtCore import Qt, Signal, QObject, Slot, QEvent
+import math
+import numpy as np
+from PySide6.QtWidgets import QApplication, QWidget, QGraphicsView, QGraphicsScene, QGraphicsItem, QGraphicsObject, QGraphicsTextItem, QLabel, QVBoxLayout
+from PySide6.QtCore import Qt, Signal, QObject, Slot, QEvent, QRectF, QPointF
 from PySide6.QtGui import QBrush, QPen
 from radar_volume import RadarVolume
 
-class CircleItem(QObject, QGraphicsEllipseItem):
+class SliceGridItem(QGraphicsObject):
     """
-    A circle glyph rendered in the volume slice selector which visually
-    encodes the position within a grid of angular extents in both azimuth and
-    elevation. The row index "i" of each glyph represents the selected PPI slice
-    (a planar horizontal slice at the given elevation angle), and the column 
-    index "j" of each glyph represents the selected RHI slice (a planar vertical
-    slice at the given azimuth angle).
+    The grid of circle glyphs rendered in the volume slice selector, as a single item.
+    Each glyph visually encodes a position within the grid of angular extents in both
+    azimuth and elevation. The row index "i" of each glyph represents the selected PPI
+    slice (a planar horizontal slice at the given elevation angle), and the column
+    index "j" of each glyph represents the selected RHI slice (a planar vertical slice
+    at the given azimuth angle).
+
+    All glyphs are drawn in one paint call and hit-testing is plain arithmetic on the
+    grid layout, so there is no per-glyph item (or QObject) to create when the grid
+    is laid out.
+
+    The highlight and selection state is kept per row and per column as bits of two
+    small arrays, the state of a glyph is the union of its row's and column's bits.
+    The grid itself only draws the plain glyphs and is cached by the view as a pixmap,
+    the highlighted and selected rows and columns are drawn on top of it by a child
+    SliceLinesItem. Moving the highlight or selection only invalidates the strips of
+    the rows and columns which changed, which are restored from the cache and redrawn
+    line by line, so hovering costs O(rows + columns) rather than O(rows x columns).
     """
-    mouse_hovered = Signal(int, int)
-
-    def __init__(self, i, j, x, y, radius, *args, **kwargs):
-        QObject.__init__(self)
-        QGraphicsEllipseItem.__init__(self, x, y, radius * 2, radius * 2, *args, **kwargs)
-        self.i = i
-        self.j = j
+    HIGHLIGHTED = 1
+    SELECTED = 2
+    def __init__(self, rows, cols, x_spacing, y_spacing, radius):
+        super().__init__()
+        self.rows = rows
+        self.cols = cols
+        self.x_spacing = x_spacing
+        self.y_spacing = y_spacing
+        self.radius = radius
+        # Row 0 is drawn at the bottom
+        self.total_height = (rows - 1) * y_spacing
+        # Highlighted (hovered) and selected row and column, -1 for none
+        self.highlighted_row = -1
+        self.highlighted_col = -1
+        self.selected_row = -1
+        self.selected_col = -1
+        # HIGHLIGHTED/SELECTED bits of every row and column
+        self.row_state = np.zeros(rows, dtype=np.uint8)
+        self.col_state = np.zeros(cols, dtype=np.uint8)
         self.default_brush = QBrush(Qt.lightGray)
         self.highlight_brush = QBrush(Qt.red)
         self.selected_brush = QBrush(Qt.blue)
-        self.selected = False
-        self.setBrush(self.default_brush)
-        self.setPen(QPen(Qt.black))
-        # self.setAcceptHoverEvents(True)
+        self.pen = QPen(Qt.black)
+        # Have paint() told which part of the item needs repainting
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+        # The plain glyphs only change with the layout
+        self.setCacheMode(QGraphicsItem.CacheMode.DeviceCoordinateCache)
+        self.lines = SliceLinesItem(self)
+
+    def boundingRect(self) -> QRectF:
+        return QRectF(0, 0, (self.cols - 1) * self.x_spacing + 2 * self.radius,
+                      self.total_height + 2 * self.radius).adjusted(-1, -1, 1, 1)
+
+    def glyph_rect(self, i, j) -> QRectF:
+        return QRectF(j * self.x_spacing, self.total_height - i * self.y_spacing, 2 * self.radius, 2 * self.radius)
+
+    def cell_at(self, pos: QPointF):
+        """The (row, column) of the grid cell at a position, which may lie outside of the grid."""
+        col = math.floor(pos.x() / self.x_spacing)
+        row = math.floor((self.total_height + self.y_spacing - pos.y()) / self.y_spacing)
+        return (row, col)
+
+    def glyph_at(self, pos: QPointF):
+        """The (row, column) of the glyph at a position, None if there is no glyph there."""
+        (row, col) = self.cell_at(pos)
+        if not (0 <= row < self.rows and 0 <= col < self.cols):
+            return None
+        center = self.glyph_rect(row, col).center()
+        if (pos.x() - center.x()) ** 2 + (pos.y() - center.y()) ** 2 > self.radius ** 2:
+            return None
+        return (row, col)
+
+    def row_rect(self, i) -> QRectF:
+        return QRectF(0, self.total_height - i * self.y_spacing, (self.cols - 1) * self.x_spacing + 2 * self.radius, 2 * self.radius)
+
+    def col_rect(self, j) -> QRectF:
+        return QRectF(j * self.x_spacing, 0, 2 * self.radius, self.total_height + 2 * self.radius)
+
+    def cells_in(self, rect: QRectF):
+        """The (first row, end row, first column, end column) of the glyphs which may intersect a rectangle."""
+        diameter = 2 * self.radius
+        i0 = max(0, math.floor((self.total_height - rect.bottom()) / self.y_spacing))
+        i1 = min(self.rows, math.floor((self.total_height - rect.top() + diameter) / self.y_spacing) + 1)
+        j0 = max(0, math.floor((rect.left() - diameter) / self.x_spacing))
+        j1 = min(self.cols, math.floor(rect.right() / self.x_spacing) + 1)
+        return (i0, i1, j0, j1)
+
+    def brush(self, state) -> QBrush:
+        # Selected wins over highlighted
+        if state & SliceGridItem.SELECTED:
+            return self.selected_brush
+        if state & SliceGridItem.HIGHLIGHTED:
+            return self.highlight_brush
+        return self.default_brush
+
+    def set_highlighted(self, row, col):
+        self._move_lines(SliceGridItem.HIGHLIGHTED, (self.highlighted_row, self.highlighted_col), (row, col))
+        (self.highlighted_row, self.highlighted_col) = (row, col)
+
+    def set_selected(self, row, col):
+        self._move_lines(SliceGridItem.SELECTED, (self.selected_row, self.selected_col), (row, col))
+        (self.selected_row, self.selected_col) = (row, col)
+
+    def _move_lines(self, bit, old, new):
+        """Move a state bit from the old (row, column) to the new one, and invalidate the lines which changed."""
+        for (state, old_index, new_index, line_rect) in ((self.row_state, old[0], new[0], self.row_rect),
+                                                         (self.col_state, old[1], new[1], self.col_rect)):
+            if old_index == new_index:
+                continue
+            for (index, set_bit) in ((old_index, False), (new_index, True)):
+                if 0 <= index < len(state):
+                    state[index] = state[index] | bit if set_bit else state[index] & (0xFF ^ bit)
+                    self.lines.update(line_rect(index).adjusted(-1, -1, 1, 1))
+
+    def paint(self, painter, option, widget=None):
+        painter.setPen(self.pen)
+        painter.setBrush(self.default_brush)
+        (i0, i1, j0, j1) = self.cells_in(option.exposedRect)
+        for i in range(i0, i1):
+            for j in range(j0, j1):
+                painter.drawEllipse(self.glyph_rect(i, j))
 
     def mousePressEvent(self, event):
-        if event.button() == Qt.LeftButton:
-            self.scene().on_circle_selected(self.i, self.j)
-
-    # def hoverEnterEvent(self, event):
-    #     self.mouse_hovered.emit(self.i, self.j)
-    #     super().hoverEnterEvent(event)
-
-    # def hoverLeaveEvent(self, event):
-    #     self.scene().clear_highlights()
-    #     super().hoverLeaveEvent(event)
-
-    def set_highlighted(self, highlighted):
-        if self.selected:
-            self.setBrush(self.selected_brush)
-        elif highlighted:
-            self.setBrush(self.highlight_brush)
+        glyph = self.glyph_at(event.pos())
+        if event.button() == Qt.LeftButton and glyph is not None:
+            self.scene().on_circle_selected(*glyph)
         else:
-            self.setBrush(self.default_brush)
+            event.ignore()
 
-    def set_selected(self, selected):
-        self.selected = selected
-        if selected:
-            self.setBrush(self.selected_brush)
-        else:
-            self.setBrush(self.default_brush)
+class SliceLinesItem(QGraphicsItem):
+    """
+    Draws the highlighted and selected rows and columns of a SliceGridItem (its parent)
+    over the plain glyphs. Only rows and columns with state bits set are visited, so a
+    repaint costs O(rows + columns) whatever the size of the exposed area.
+    """
+    def __init__(self, grid: SliceGridItem):
+        super().__init__(grid)
+        self.grid = grid
+        self.setFlag(QGraphicsItem.GraphicsItemFlag.ItemUsesExtendedStyleOption)
+        # Clicks go to the grid
+        self.setAcceptedMouseButtons(Qt.NoButton)
+
+    def boundingRect(self) -> QRectF:
+        return self.grid.boundingRect()
+
+    def paint(self, painter, option, widget=None):
+        grid = self.grid
+        painter.setPen(grid.pen)
+        (i0, i1, j0, j1) = grid.cells_in(option.exposedRect)
+        rows = (np.flatnonzero(grid.row_state[i0:i1]) + i0).tolist()
+        cols = (np.flatnonzero(grid.col_state[j0:j1]) + j0).tolist()
+        for i in rows:
+            for j in range(j0, j1):
+                painter.setBrush(grid.brush(grid.row_state[i] | grid.col_state[j]))
+                painter.drawEllipse(grid.glyph_rect(i, j))
+        for j in cols:
+            for i in range(i0, i1):
+                # The crossings were drawn with the rows
+                if grid.row_state[i]:
+                    continue
+                painter.setBrush(grid.brush(grid.col_state[j]))
+                painter.drawEllipse(grid.glyph_rect(i, j))
 
 class MouseLeaveFilter(QObject):
     """
@@ -83,7 +198,9 @@ class CircleScene(QGraphicsScene):
         super().__init__(*args, **kwargs)
         self.label = label
         self.selector_widget = selector_widget
-        self.circles = []
+        # The grid of glyphs (None until the grid is laid out) and the row/column labels
+        self.grid = None
+        self.labels = []
         self.last_hover_x = -1
         self.last_hover_y = -1
         self.selected_row = 0
@@ -93,50 +210,52 @@ class CircleScene(QGraphicsScene):
         self.leave_filter.mouse_left.connect(self.on_mouse_left)
         self.installEventFilter(self.leave_filter)
 
-    def addItem(self, item):
-        super().addItem(item)
-        if isinstance(item, CircleItem):
-            self.circles.append(item)
+    def set_grid(self, rows, cols, x_spacing, y_spacing, radius):
+        """Lay the grid out, keeping the selection (as far as it is still within the grid)."""
+        for item in self.labels:
+            self.removeItem(item)
+        if self.grid is not None:
+            self.removeItem(self.grid)
+
+        self.grid = SliceGridItem(rows, cols, x_spacing, y_spacing, radius)
+        self.addItem(self.grid)
+        if 0 <= self.selected_row < rows and 0 <= self.selected_col < cols:
+            self.grid.set_selected(self.selected_row, self.selected_col)
+        self.add_labels(rows, cols, x_spacing, y_spacing, radius, self.grid.total_height)
+        self.setSceneRect(self.itemsBoundingRect())
 
     def add_labels(self, rows, cols, x_spacing, y_spacing, radius, total_height):
-        # Store values in attributes to be used by mouse move event
-        self.rows = rows
-        self.cols = cols
-        self.x_spacing = x_spacing
-        self.y_spacing = y_spacing
-        self.total_height = total_height
-        
+        self.labels = []
         for i in range(rows):
             y = total_height - (i * y_spacing) + radius - 10
             label = QGraphicsTextItem(str(i))
             label.setPos(-30, y)
             self.addItem(label)
+            self.labels.append(label)
         for j in range(cols):
             label = QGraphicsTextItem(str(j))
             label.setPos(j * x_spacing + radius / 2, rows * y_spacing)
             self.addItem(label)
+            self.labels.append(label)
 
     def highlight_row_and_column(self, row, col):
-        for circle in self.circles:
-            if circle.i == row or circle.j == col:
-                circle.set_highlighted(True)
-            else:
-                circle.set_highlighted(False)
+        if self.grid is not None:
+            self.grid.set_highlighted(row, col)
 
     def clear_highlights(self):
-        for circle in self.circles:
-            circle.set_highlighted(False)
+        self.highlight_row_and_column(-1, -1)
 
     def mouseMoveEvent(self, event):
+        if self.grid is None:
+            return super().mouseMoveEvent(event)
+
         # Map the scene position to the nearest grid indices
-        pos = event.scenePos()
-        col = int(pos.x() / self.x_spacing)
-        row = int((self.total_height - pos.y()) / self.y_spacing) + 1
+        (row, col) = self.grid.cell_at(self.grid.mapFromScene(event.scenePos()))
 
         self.highlight_row_and_column(row, col)
 
         # Check if the indices are within the grid bounds
-        if 0 <= row < self.rows and 0 <= col < self.cols:
+        if 0 <= row < self.grid.rows and 0 <= col < self.grid.cols:
             if self.last_hover_x != col or self.last_hover_y != row:
                 # print(f"New hover location! ({col}, {row})")
                 self.mouse_hovered.emit(row, col)
@@ -159,11 +278,8 @@ class CircleScene(QGraphicsScene):
         """Slot to handle circle selection."""
         self.selected_row = i
         self.selected_col = j
-        for circle in self.circles:
-            if circle.i == i or circle.j == j:
-                circle.set_selected(True)
-            else:
-                circle.set_selected(False)
+        if self.grid is not None:
+            self.grid.set_selected(i, j)
         self.label.setText(f"Selected Indices: ({i}, {j})")
         self.selector_widget.selection_changed.emit(i, j)
 
@@ -207,29 +323,19 @@ class VolumeSliceSelector(QWidget):
 
     @Slot(int, int, int, int)
     def on_grid_updated(self, rows, cols, x_spacing, y_spacing, radius):
-        """Dynamically update the grid with new parameters."""
+        """
+        Dynamically update the grid with new parameters. The grid is only laid out again
+        if they changed, so it costs nothing to call this for every rendered volume.
+        """
+        if (rows, cols, x_spacing, y_spacing, radius) == (self.rows, self.cols, self.x_spacing, self.y_spacing, self.radius) \
+                and self.scene.grid is not None:
+            return
         self.rows = rows
         self.cols = cols
         self.x_spacing = x_spacing
         self.y_spacing = y_spacing
         self.radius = radius
-
-        # Clear the existing scene
-        self.scene.clear()
-        self.scene.circles = []
-
-        # Calculate the total height for flipping the y-axis
-        total_height = (rows - 1) * y_spacing
-
-        # Add updated grid
-        self.scene.add_labels(rows, cols, x_spacing, y_spacing, radius, total_height)
-        for i in range(rows):
-            for j in range(cols):
-                x = j * x_spacing
-                y = total_height - (i * y_spacing)
-                circle = CircleItem(i, j, x, y, radius)
-                # circle.mouse_hovered.connect(self.scene.highlight_row_and_column)
-                self.scene.addItem(circle)
+        self.scene.set_grid(rows, cols, x_spacing, y_spacing, radius)
 
     @Slot(RadarVolume)
     def on_render_volume(self, r_volume: RadarVolume):
@@ -244,13 +350,38 @@ class VolumeSliceSelector(QWidget):
     def on_hover(self, i, j):
         self.slice_hovered.emit(i, j)
 
+def benchmark_hover(app, widget, rows, cols, moves=200):
+    """Average milliseconds per hover move (state update and repaint) over a grid of the given size."""
+    import time
+    widget.on_grid_updated(rows, cols, 20, 20, 10)
+    widget.on_selection(rows // 2, cols // 2)
+    app.processEvents()
+
+    start = time.perf_counter()
+    for k in range(moves):
+        # Sweep diagonally through the visible part of the grid
+        widget.scene.highlight_row_and_column(k % rows, (k * 7) % min(cols, 40))
+        app.processEvents()
+    return (time.perf_counter() - start) / moves * 1000
+
 if __name__ == "__main__":
     import sys
 
+    app = QApplication(sys.argv)
+
+    if '--benchmark' in sys.argv:
+        # Hover cost should stay flat as the grid grows:
+        #   python ./volume_slice_selector.py --benchmark
+        widget = VolumeSliceSelector()
+        widget.resize(1000, 600)
+        widget.show()
+        for (rows, cols) in ((20, 44), (20, 360), (40, 720)):
+            print(f'{rows} x {cols}: {benchmark_hover(app, widget, rows, cols):.2f} ms per hover move')
+        sys.exit(0)
+
     def on_selection_changed(i, j):
         print(f'Circle selected: ({i}, {j})')
 
-    app = QApplication(sys.argv)
     widget = VolumeSliceSelector()
     widget.selection_changed.connect(on_selection_changed)
 
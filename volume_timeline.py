@@ -0,0 +1,117 @@
+import re
+import numpy as np
+from datetime import datetime, timedelta
+from pathlib import Path
+from volume_metadata import ScanIndex
+
+class VolumeTimeline(object):
+    """
+    The times of the volumes of a scan, for seeking and real-time playback. PAR volumes
+    come at irregular intervals, so the timeline keeps the time of every volume (seconds
+    since the Unix epoch) and the volumes sorted by time, and maps a wall-clock time to
+    the volume on screen at that time with a binary search.
+
+    Times come from the scan index (MATLAB datenums from the volume headers). Volumes
+    whose header isn't known yet fall back to the time in their filename, e.g.
+    HRUS_240428_020003000_100.mat -> 2024-04-28 02:00:03.000, and failing that are
+    interpolated from their neighbours.
+    """
+    # MATLAB datenum of 1970-01-01
+    DATENUM_UNIX_EPOCH = 719529.0
+    FILENAME_TIME = re.compile(r'_(\d{6})_(\d{9})_')
+
+    def __init__(self, times_s):
+        # Time of every volume, by index in the scan
+        self.times_s = np.asarray(times_s, dtype=np.float64)
+        # Indices sorted by time, the times in that order, and where each index is in that order
+        self.order = np.argsort(self.times_s, kind='stable')
+        self.sorted_times_s = self.times_s[self.order]
+        self.positions = np.empty_like(self.order)
+        self.positions[self.order] = np.arange(len(self.order))
+
+    @staticmethod
+    def from_scan_index(scan_index: ScanIndex):
+        times_s = np.full(len(scan_index), np.nan)
+        for (i, filename) in enumerate(scan_index.files):
+            metadata = scan_index.get(i)
+            datenum = VolumeTimeline._to_float(metadata.time) if metadata is not None else None
+            if datenum is not None:
+                # Datenums only resolve ~10 microseconds, the volume times are whole milliseconds
+                times_s[i] = round((datenum - VolumeTimeline.DATENUM_UNIX_EPOCH) * 86400.0, 3)
+            else:
+                times_s[i] = VolumeTimeline.time_from_filename(filename)
+
+        known = ~np.isnan(times_s)
+        if not known.any():
+            # Evenly spaced, one second apart
+            times_s = np.arange(len(times_s), dtype=np.float64)
+        elif not known.all():
+            indices = np.arange(len(times_s))
+            times_s[~known] = np.interp(indices[~known], indices[known], times_s[known])
+        return VolumeTimeline(times_s)
+
+    @staticmethod
+    def _to_float(value):
+        try:
+            value = float(np.ravel(value)[0]) if np.ndim(value) > 0 else float(value)
+        except (TypeError, ValueError, IndexError):
+            return None
+        return None if np.isnan(value) else value
+
+    @staticmethod
+    def time_from_filename(filename) -> float:
+        """Time encoded in a volume filename (seconds since the Unix epoch), NaN if there is none."""
+        match = VolumeTimeline.FILENAME_TIME.search(Path(filename).name)
+        if match is None:
+            return np.nan
+        try:
+            (date, clock) = match.groups()
+            parsed = datetime.strptime(date + clock[:6], '%y%m%d%H%M%S') + timedelta(milliseconds=int(clock[6:]))
+        except ValueError:
+            return np.nan
+        return (parsed - datetime(1970, 1, 1)).total_seconds()
+
+    def __len__(self):
+        return len(self.times_s)
+
+    @property
+    def start_s(self) -> float:
+        return self.sorted_times_s[0]
+
+    @property
+    def end_s(self) -> float:
+        return self.sorted_times_s[-1]
+
+    def time_of(self, index) -> float:
+        return self.times_s[index]
+
+    def position_of(self, index) -> int:
+        """Position of a volume in time order."""
+        return int(self.positions[index])
+
+    def index_at_position(self, position) -> int:
+        return int(self.order[position])
+
+    def position_at(self, time_s) -> int:
+        """Position (in time order) of the latest volume at or before `time_s`, -1 before the first one."""
+        return int(np.searchsorted(self.sorted_times_s, time_s, side='right')) - 1
+
+    def index_at(self, time_s) -> int:
+        """Index of the volume on screen at a wall-clock time, the first volume before the scan starts."""
+        return self.index_at_position(max(0, self.position_at(time_s)))
+
+    def mean_interval_s(self) -> float:
+        """Average time between volumes, 1 second for scans of a single volume."""
+        if len(self) < 2 or self.end_s <= self.start_s:
+            return 1.0
+        return (self.end_s - self.start_s) / (len(self) - 1)
+
+    @staticmethod
+    def to_datetime(time_s) -> datetime:
+        return datetime(1970, 1, 1) + timedelta(seconds=float(time_s))
+
+    def format_time(self, index) -> str:
+        """Timestamp of a volume and how far into the scan it is, e.g. '2024-04-28 02:00:33.500 (+0:30.5)'."""
+        time_s = self.time_of(index)
+        (minutes, seconds) = divmod(time_s - self.start_s, 60.0)
+        return f'{VolumeTimeline.to_datetime(time_s).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]} (+{int(minutes)}:{seconds:04.1f})'